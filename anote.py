@@ -2,6 +2,7 @@
 import copy
 import re
 import tools
+from bisect import bisect_left
 
 
 class Anote(object):
@@ -13,7 +14,8 @@ class Anote(object):
         lyric: 歌詞
         phonetic: 発音記号
         dynamics: ベロシティ（VEL）
-        vibrato: ビブラート情報（ディクショナリ）
+        vibrato: ビブラート情報（Vibrato（vibratoinfo.pyを参照）、
+            またはディクショナリ）
             {"IconID": ビブラートの形式を識別するID,
              "IDS": ビブラートの形式名,
              "Caption": 不明,
@@ -40,6 +42,7 @@ class Anote(object):
         event: テキストベントの形式にフォーマットされたディクショナリ
         lyric_event: 同上。歌詞イベントを扱う
         vibrato_event: 同上。ビブラートイベントを扱う
+        vibrato_delay: ノートの開始からビブラートの開始までの時間
     ビブラート周りを除いて数値になるべきところは数値として扱う
     """
     #デフォルトプロパティ
@@ -127,6 +130,21 @@ class Anote(object):
     def is_prolong(self):
         return self._is_prolong
 
+    def copy(self):
+        """プロパティとビブラート情報も複製したAnoteを取得する
+        （アンパース結果が変わらないように項目の順序を保つ）
+        Returns:
+            Anoteインスタンス
+        """
+        from vibratoinfo import Vibrato
+        anote = copy.copy(self)
+        anote.prop = tools.copy_dict(self.prop)
+        if isinstance(self.vibrato, Vibrato):
+            anote.vibrato = self.vibrato.copy()
+        else:
+            anote.vibrato = tools.copy_dict(self.vibrato)
+        return anote
+
     @property
     def event(self):
         """音符イベント形式の音符データを取得する
@@ -144,11 +162,19 @@ class Anote(object):
             self.prop[key] = str(value)
         event.update(self.prop)
         if self.vibrato:
-            vd = int((1 - int(self.vibrato['Length']) / 100.0) *
-                    self.length / 5) * 5
-            event['VibratoDelay'] = str(vd)
+            event['VibratoDelay'] = str(self.vibrato_delay)
+        else:
+            event.pop('VibratoDelay', None)
         return event
 
+    @property
+    def vibrato_delay(self):
+        """ノートの開始からビブラートの開始までの時間を取得する
+        ビブラートはノートの終端までかかるので、ノートの長さから
+        ビブラートの長さ（Length）を引いたものになる
+        """
+        return max(0, self.length - int(self.vibrato['Length']))
+
     @property
     def lyric_event(self):
         """詳細イベント形式の歌詞データを取得する
@@ -191,6 +217,14 @@ class AnoteList(list):
         lyrics: 格納されているAnoteインスタンス間の歌詞を連結したもの
         phonetic: 格納されているAnoteインスタンス間の発音記号を連結したもの
         relative_notes: 格納されているAnoteインスタンス間の相対音階
+        interval_index: 格納されているAnoteインスタンスの時間範囲の索引
+            （IntervalIndex）。NormalTrack.writable_note, writable_anotesで
+            取得したAnoteを書き換える場合は次に使うときに作り直される。
+            それ以外でAnoteの時間を直接書き換えた場合はreindex()を呼ぶ
+        contour_index: 格納されているAnoteインスタンス間の音程差の索引
+            （ContourIndex）。interval_indexと同じく、writable_note,
+            writable_anotesで取得したAnoteの音高を書き換える場合は
+            作り直され、それ以外で直接書き換えた場合はreindex()を呼ぶ
 
     Exaples:
         anotes = AnoteList()
@@ -200,6 +234,9 @@ class AnoteList(list):
         anotes.phonetics => "g aa"
         anotes.relative_notes => [0, 2]
     """
+    _index = None
+    _contour = None
+
     def __init__(self, other_list=[]):
         """コンストラクタ
         Args:
@@ -212,33 +249,48 @@ class AnoteList(list):
         """Anoteインスタンスを追加する
         リストのappend()と同じ挙動。追加時に、
             ・型のチェック（Anoteインスタンスであるか）
-            ・時間順ソート
+            ・時間順の位置への挿入
             ・歌詞が伸ばし棒関連の場合の処理
         を行う
 
         Args:
             anote: 追加するAnoteインスタンス
         """
+        self.add(anote)
+
+    def add(self, anote):
+        """Anoteインスタンスを追加し、追加した位置を返す
+        Args:
+            anote: 追加するAnoteインスタンス
+
+        Returns:
+            追加したAnoteインスタンスのインデックス
+        """
         if not anote.__class__.__name__ is 'Anote':
             raise TypeError("AnoteList support only Anote class for contents")
 
         #共通の参照のAnoteインスタンスを格納しない
         _anote = copy.deepcopy(anote) if anote in self else anote
-        super(AnoteList, self).append(_anote)
-        self.sort(key=lambda x: x.start)
+
+        #同じ時間のAnoteの後ろに挿入する
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if _anote.start < self[mid].start:
+                hi = mid
+            else:
+                lo = mid + 1
+        self.insert(lo, _anote)
 
         #歌詞が伸ばし棒だった場合
-        if _anote.is_prolong:
-            prev = self.index(_anote) - 1
-            if prev >= 0:
-                _anote.phonetic = self[prev].phonetic[-1]
+        if _anote.is_prolong and lo > 0:
+            _anote.phonetic = self[lo - 1].phonetic[-1]
 
         #挿入したAnoteの次の歌詞が伸ばし棒だった場合
-        if self[-1] != _anote:
-            next = self.index(_anote) + 1
-            if self[next].is_prolong:
-                self[next].phonetic = _anote.phonetic[-1]
-            
+        if lo + 1 < len(self) and self[lo + 1].is_prolong:
+            self[lo + 1].phonetic = _anote.phonetic[-1]
+        return lo
+
     def extend(self, other_list):
         """他のAnoteインスタンスのリスト、AnoteListを連結する
         Args:
@@ -264,10 +316,16 @@ class AnoteList(list):
         """
         s = start if start else 0
         e = end if end else self[-1].end
+
+        #時間のみの指定は索引を使う
+        if not lyric_start and lyric_end is None:
+            return AnoteList(self.interval_index.query(s, e))
+
         lyric_s = lyric_start if lyric_start else 0
         lyric_e = lyric_end if lyric_end else len(self.lyrics)
 
-        l2i = self.__lyric_index2index
+        offsets = self.lyric_offsets()
+        l2i = lambda i: bisect_left(offsets, i)
 
         temp = self[l2i(lyric_s):l2i(lyric_e)]
         temp = [a for a in temp if s <= a.end and a.start <= e]
@@ -279,8 +337,61 @@ class AnoteList(list):
 
     def map(self, formula):
         map(formula, self)
+        self.reindex()
         return self
 
+    @property
+    def interval_index(self):
+        """時間範囲の索引を取得する
+        Returns:
+            IntervalIndex（各要素はAnoteインスタンス）
+        """
+        if self._index is None:
+            from interval import IntervalIndex
+            self._index = IntervalIndex(self,
+                                        [a.start for a in self],
+                                        [a.end for a in self])
+        return self._index
+
+    @property
+    def contour_index(self):
+        """音程差の索引を取得する
+        Returns:
+            ContourIndex
+        """
+        if self._contour is None:
+            from contour import ContourIndex
+            self._contour = ContourIndex([a.note for a in self])
+        return self._contour
+
+    def find_contour(self, pattern, lyric=None):
+        """音程差のパターンにマッチする部分を取得する
+        Args:
+            pattern: 音程差の条件のリスト（ContourIndexを参照）
+            lyric: 指定すると、マッチした部分の歌詞全体が
+                この正規表現にマッチするものだけを返す
+
+        Returns:
+            マッチした部分（len(pattern) + 1個のAnoteを持つAnoteList）の
+            リスト（時間順）
+        """
+        n = len(pattern) + 1
+        found = [self[i:i + n] for i in self.contour_index.find(pattern)
+                 if i + n <= len(self)]
+        if lyric is not None:
+            if isinstance(lyric, str):
+                lyric = lyric.decode('utf-8')
+            rxp = re.compile(u"(?:%s)\Z" % lyric)
+            found = [anotes for anotes in found if rxp.match(anotes.lyrics)]
+        return found
+
+    def reindex(self):
+        """時間範囲と音程差の索引を破棄する
+        Anoteの時間や音高を直接書き換えた後に呼ぶ
+        """
+        self._index = None
+        self._contour = None
+
     def lyric_index(self, anote):
         """歌詞文字列上のインデックスを取得する
         Args:
@@ -300,15 +411,70 @@ class AnoteList(list):
             anotes.lyric_index(anote) => 6
         """
         i = self.index(anote)
-        string = u''.join([a.lyric for a in self[:i]])
-        return i + len(re.findall(u"[ぁぃぅぇぉゃゅょ]", string))
+        return self.lyric_offsets()[i]
 
-    def __lyric_index2index(self, i):
-        return i - len(re.findall(u"[ぁぃぅぇぉゃゅょ]", self.lyrics[:i]))
+    def lyric_offsets(self):
+        """各Anoteの歌詞がlyrics上で始まるインデックスを取得する
+        Returns:
+            インデックスのリスト（末尾にlyricsの長さを含む）
+            lyrics上のインデックスiを含むAnoteは
+            bisect_left(offsets, i + 1) - 1 番目となる
+        """
+        offsets = [0]
+        for a in self:
+            offsets.append(offsets[-1] + len(a.lyric))
+        return offsets
 
     def __getslice__(self, i, j):
         return AnoteList(super(AnoteList, self).__getslice__(i, j))
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_index'] = None
+        state['_contour'] = None
+        return state
+
+    #リストを変更する操作では索引を破棄する
+    def insert(self, i, anote):
+        self.reindex()
+        return super(AnoteList, self).insert(i, anote)
+
+    def remove(self, anote):
+        self.reindex()
+        return super(AnoteList, self).remove(anote)
+
+    def pop(self, *args):
+        self.reindex()
+        return super(AnoteList, self).pop(*args)
+
+    def sort(self, *args, **kwargs):
+        self.reindex()
+        return super(AnoteList, self).sort(*args, **kwargs)
+
+    def reverse(self):
+        self.reindex()
+        return super(AnoteList, self).reverse()
+
+    def __setitem__(self, i, anote):
+        self.reindex()
+        return super(AnoteList, self).__setitem__(i, anote)
+
+    def __delitem__(self, i):
+        self.reindex()
+        return super(AnoteList, self).__delitem__(i)
+
+    def __setslice__(self, i, j, anotes):
+        self.reindex()
+        return super(AnoteList, self).__setslice__(i, j, anotes)
+
+    def __delslice__(self, i, j):
+        self.reindex()
+        return super(AnoteList, self).__delslice__(i, j)
+
+    def __iadd__(self, other_list):
+        self.extend(other_list)
+        return self
+
     def split(self, distance=50):
         """distance時間以上離れているAnoteで区切る
         Args:
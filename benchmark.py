@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""VSQEditorのベンチマーク
+vsqgen.pyで生成したVSQファイルに対して、規模ごとに各処理の時間と
+ピークメモリを計測する。規模ごとに別プロセスで計測する。
+あわせて新しいプロセスでのimport vsqの時間（コールドスタートの時間）を計測し、
+IMPORT_BUDGETを超えていれば終了コード1にする
+
+使い方:
+    python benchmark.py                        # 計測結果を表示
+    python benchmark.py --save bench.json      # ベースラインとして保存
+    python benchmark.py --compare bench.json   # ベースラインと比較し、
+                                               # 閾値を超えて遅くなって
+                                               # いれば終了コード1
+"""
+import json
+import multiprocessing
+import optparse
+import random
+import resource
+import subprocess
+import sys
+import time
+import vsqgen
+
+#計測する規模（vsqgen.generateの引数）
+SCALES = [
+    ("small", {"notes": 200, "bp_density": 8, "tracks": 1}),
+    ("medium", {"notes": 2000, "bp_density": 16, "tracks": 2}),
+    ("large", {"notes": 5000, "bp_density": 16, "tracks": 4}),
+]
+PHASES = ["parse", "parse_cached", "get_rule_cands", "apply_rule", "unapply_rule",
+          "curve_query", "unparse"]
+#計測誤差として許容する差（秒, KB）
+MIN_DELTA = 0.005
+MIN_DELTA_KB = 2048
+#import vsqにかけてよい時間（秒）
+#遅延importを入れる前（import時に歌詞の表を作っていた頃）の約12msを上限とし、
+#コールドスタートがそれより遅くならないようにする
+IMPORT_BUDGET = 0.012
+IMPORT_SCRIPT = ("import time; t = time.time(); import vsq; "
+                 "print time.time() - t")
+
+
+def run_scale(params, repeat=3, queries=200):
+    """1つの規模について各処理を計測する
+    Args:
+        params: vsqgen.generateの引数
+        repeat: 各処理を繰り返す回数（最小値を採用する）
+        queries: curve_queryで取得する時間窓の数
+
+    Returns:
+        処理名をキーとし、時間（秒）を値とするディクショナリ
+        peak_kbにピークメモリ（KB）が入る
+    """
+    from vsq import VSQEditor
+    from parsecache import ParseCache
+    from vsq_rules import zuii_rule, san_rule, port_rule, n_accent_rule
+    rules = [zuii_rule, san_rule, port_rule, n_accent_rule]
+    binary = vsqgen.generate(**params)
+    results = dict((phase, None) for phase in PHASES)
+
+    def measure(phase, func):
+        t = time.time()
+        value = func()
+        elapsed = time.time() - t
+        if results[phase] is None or elapsed < results[phase]:
+            results[phase] = elapsed
+        return value
+
+    def apply_all():
+        with editor.batch():
+            for c in cands:
+                editor.apply_rule(c)
+
+    def unapply_all():
+        with editor.batch():
+            for c in cands:
+                editor.unapply_rule(c)
+
+    def parse_cached():
+        #1回目でキャッシュに入り、2回目はメモリ上のキャッシュから復元される
+        VSQEditor.parse_cache = ParseCache()
+        try:
+            VSQEditor(binary=binary)
+            measure("parse_cached", lambda: VSQEditor(binary=binary))
+        finally:
+            VSQEditor.parse_cache = None
+
+    rand = random.Random(0)
+    for i in range(repeat):
+        editor = measure("parse", lambda: VSQEditor(binary=binary))
+        parse_cached()
+        cands = measure("get_rule_cands",
+                        lambda: editor.get_rule_cands(*rules))
+        measure("apply_rule", apply_all)
+        measure("unapply_rule", unapply_all)
+
+        windows = []
+        for n in range(queries):
+            s = rand.randint(editor.start_time, editor.end_time)
+            windows.append((s, s + rand.randint(0, 4 * 480)))
+
+        def query():
+            for s, e in windows:
+                editor.get_pitch_curve(s, e)
+                editor.get_dynamics_curve(s, e)
+                editor.anotes.filter(s, e)
+        measure("curve_query", query)
+        measure("unparse", editor.unparse)
+
+    results["peak_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+
+def measure_import(repeat=5):
+    """新しいプロセスでimport vsqにかかる時間を計測する
+    Args:
+        repeat: 計測する回数（最小値を採用する）
+
+    Returns:
+        {"import_vsq": 時間（秒）}
+    """
+    times = []
+    for i in range(repeat):
+        output = subprocess.check_output([sys.executable, "-c",
+                                          IMPORT_SCRIPT])
+        times.append(float(output))
+    return {"import_vsq": min(times)}
+
+
+def run(scales=None, repeat=3):
+    """規模ごとに別プロセスで計測する
+    Args:
+        scales: 計測する規模名のリスト（省略時は全て）
+        repeat: 各処理を繰り返す回数
+
+    Returns:
+        規模名をキーとし、run_scaleの結果を値とするディクショナリ
+    """
+    results = {}
+    for name, params in SCALES:
+        if scales and not name in scales:
+            continue
+        pool = multiprocessing.Pool(1)
+        try:
+            results[name] = pool.apply(run_scale, (params, repeat))
+        finally:
+            pool.terminate()
+    results["import"] = measure_import()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ベースラインより閾値を超えて悪化した項目を調べる
+    Args:
+        results: runの結果
+        baseline: 保存されていたrunの結果
+        threshold: 許容する悪化の割合（0.2なら20%）
+
+    Returns:
+        (規模名, 処理名, ベースラインの値, 今回の値)のリスト
+    """
+    regressions = []
+    for name, phases in sorted(results.items()):
+        base = baseline.get(name, {})
+        for phase, value in sorted(phases.items()):
+            if base.get(phase) is None or value is None:
+                continue
+            delta = MIN_DELTA_KB if phase == "peak_kb" else MIN_DELTA
+            if value > base[phase] * (1 + threshold) + delta:
+                regressions.append((name, phase, base[phase], value))
+    return regressions
+
+
+def report(results, out=sys.stdout):
+    """計測結果を表形式で表示する"""
+    names = [name for name, params in SCALES if name in results]
+    out.write("%-16s" % "" + "".join(["%14s" % n for n in names]) + "\n")
+    for phase in PHASES:
+        out.write("%-16s" % phase)
+        for name in names:
+            out.write("%13.1fms" % (results[name][phase] * 1000))
+        out.write("\n")
+    out.write("%-16s" % "peak_kb")
+    for name in names:
+        out.write("%14d" % results[name]["peak_kb"])
+    out.write("\n")
+    if "import" in results:
+        out.write("%-16s%13.1fms (budget %.1fms)\n" % (
+            "import_vsq", results["import"]["import_vsq"] * 1000,
+            IMPORT_BUDGET * 1000))
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--scale", action="append", dest="scales",
+                      help="scale to run (small, medium, large)")
+    parser.add_option("--repeat", type="int", default=3)
+    parser.add_option("--save", metavar="FILE",
+                      help="save results as a JSON baseline")
+    parser.add_option("--compare", metavar="FILE",
+                      help="compare results with a JSON baseline")
+    parser.add_option("--threshold", type="float", default=0.25,
+                      help="allowed regression ratio (default 0.25)")
+    options, args = parser.parse_args(argv)
+
+    results = run(options.scales, options.repeat)
+    report(results)
+    status = 0
+    if results["import"]["import_vsq"] > IMPORT_BUDGET:
+        print "OVER BUDGET import_vsq: %.4f > %.4f" % (
+            results["import"]["import_vsq"], IMPORT_BUDGET)
+        status = 1
+    if options.save:
+        json.dump(results, open(options.save, "w"), indent=2, sort_keys=True)
+    if options.compare:
+        baseline = json.load(open(options.compare))
+        regressions = compare(results, baseline, options.threshold)
+        for name, phase, base, value in regressions:
+            print "REGRESSION %s %s: %.4f -> %.4f" % (name, phase, base, value)
+        if regressions:
+            return 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
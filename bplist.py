@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+class BPList(object):
+    """パラメータカーブ（BPList）を扱うクラス
+    時間と値をそれぞれ時間順に並べたarrayとして保持する。
+    各点はディクショナリ {"time": 時間, "value": 値} として取り出せる。
+    書き換えの際はarrayをその場で変更せず新しいarrayに置き換えるので、
+    copy()したBPList同士はarrayを共有できる
+
+    Attributes:
+        times: 各点の時間（array）
+        values: 各点の値（array）
+
+    Examples:
+        bp = BPList([{"time": 100, "value": 10},
+                     {"time": 200, "value": 20}])
+        bp.select(150, 300) => [{"time": 200, "value": 20}]
+        bp.value_at(150) => 10
+        bp.splice(100, 200, [120, 180], [0, 5])
+        bp.select() => [{"time": 120, "value": 0},
+                        {"time": 180, "value": 5}]
+    """
+    def __init__(self, points=[]):
+        """コンストラクタ
+        Args:
+            points: {"time": 時間, "value": 値}のリスト
+        """
+        points = sorted((p['time'], p['value']) for p in points)
+        self.times = array('i', [int(t) for t, v in points])
+        self.values = array('i', [int(v) for t, v in points])
+
+    @classmethod
+    def from_arrays(cls, times, values):
+        """時間と値のリストからBPListを作る
+        時間順に並んでいなければソートする
+        Args:
+            times: 各点の時間のリスト
+            values: 各点の値のリスト
+
+        Returns:
+            BPListインスタンス
+        """
+        bp = cls()
+        if all(times[i] <= times[i + 1] for i in xrange(len(times) - 1)):
+            bp.times = array('i', times)
+            bp.values = array('i', values)
+        else:
+            bp.times, bp.values = _sorted_points(times, values)
+        return bp
+
+    def copy(self):
+        """時間と値のarrayを共有したBPListを作る
+        どちらかを書き換えても、もう一方には影響しない
+        Returns:
+            BPListインスタンス
+        """
+        bp = BPList.__new__(BPList)
+        bp.times = self.times
+        bp.values = self.values
+        return bp
+
+    def __len__(self):
+        return len(self.times)
+
+    def __iter__(self):
+        for t, v in zip(self.times, self.values):
+            yield {'time': t, 'value': v}
+
+    def __getitem__(self, i):
+        return {'time': self.times[i], 'value': self.values[i]}
+
+    def __repr__(self):
+        return "BPList(%r)" % list(self)
+
+    def index_range(self, s=None, e=None):
+        """s以上e以下の時間にある点のインデックスの範囲を取得する
+        Args:
+            s: 選択開始時間
+            e: 選択終了時間
+
+        Returns:
+            (開始インデックス, 終了インデックス)
+        """
+        i = bisect_left(self.times, s) if s is not None else 0
+        j = bisect_right(self.times, e) if e is not None else len(self.times)
+        return i, max(i, j)
+
+    def select(self, s=None, e=None):
+        """sからeまでの点を取得する
+        Args:
+            s: 選択開始時間
+            e: 選択終了時間
+
+        Returns:
+            {"time": 時間, "value": 値}のリスト
+        """
+        i, j = self.index_range(s, e)
+        return [{'time': t, 'value': v}
+                for t, v in zip(self.times[i:j], self.values[i:j])]
+
+    def value_at(self, t):
+        """時間tでの値（t以前で最後の点の値）を取得する
+        Args:
+            t: 時間
+
+        Returns:
+            値
+        t以前に点がなければIndexErrorを送出する
+        """
+        i = bisect_right(self.times, t) - 1
+        if i < 0:
+            raise IndexError("no breakpoint before %d" % t)
+        return self.values[i]
+
+    def splice(self, s, e, times, values):
+        """sからeまでの点をtimes, valuesで置き換える
+        Args:
+            s: 置き換え開始時間
+            e: 置き換え終了時間
+            times: 新しい点の時間のリスト
+            values: 新しい点の値のリスト
+        """
+        self.merge([(s, e, times, values)])
+
+    def merge(self, edits):
+        """複数の範囲の置き換えを一度の走査でまとめて行う
+        Args:
+            edits: (s, e, times, values)のリスト
+                sの昇順で、互いに範囲が重ならないこと
+        範囲外の時間を持つ新しい点は、元の点とマージされる
+        """
+        src_t = self.times
+        src_v = self.values
+        times = array('i')
+        values = array('i')
+        pos = 0
+        for s, e, ts, vs in edits:
+            if ts and not all(ts[i] <= ts[i + 1]
+                              for i in xrange(len(ts) - 1)):
+                ts, vs = _sorted_points(ts, vs)
+            lo = min(s, ts[0]) if ts else s
+            hi = max(e, ts[-1]) if ts else e
+            i = bisect_left(src_t, lo, pos)
+            i1 = bisect_left(src_t, s, i)
+            j = max(i1, bisect_right(src_t, e, i1))
+            k = max(j, bisect_right(src_t, hi, j))
+            times.extend(src_t[pos:i])
+            values.extend(src_v[pos:i])
+            kept_t = src_t[i:i1] + src_t[j:k]
+            kept_v = src_v[i:i1] + src_v[j:k]
+            if kept_t:
+                mt, mv = _merge_points(kept_t, kept_v, ts, vs)
+                times.extend(mt)
+                values.extend(mv)
+            else:
+                times.extend(int(t) for t in ts)
+                values.extend(int(v) for v in vs)
+            pos = k
+        times.extend(src_t[pos:])
+        values.extend(src_v[pos:])
+        self.times = times
+        self.values = values
+
+    def apply_edits(self, edits):
+        """編集をまとめて反映する
+        範囲が重ならない編集は一度のマージで反映し、
+        重なる編集は該当範囲内だけで指定順に反映してからマージする
+
+        Args:
+            edits: (s, e, times, values, hold)のリスト（指定順に反映される）
+                hold: Trueのとき、置き換え前のeでの値をe+1に追加して
+                      範囲外への影響を抑制する
+
+        Returns:
+            範囲が重なっていた編集の範囲のリストのリスト
+            example:
+            [[(100, 200), (150, 300)]]
+        """
+        order = sorted(range(len(edits)),
+                       key=lambda n: self.__edit_range(edits[n])[0])
+        clusters = []
+        for n in order:
+            lo, hi = self.__edit_range(edits[n])
+            if clusters and lo <= clusters[-1][1]:
+                clusters[-1][1] = max(hi, clusters[-1][1])
+                clusters[-1][2].append(n)
+            else:
+                clusters.append([lo, hi, [n]])
+
+        merged = []
+        conflicts = []
+        for lo, hi, members in clusters:
+            if len(members) == 1:
+                s, e, ts, vs, hold = edits[members[0]]
+                if hold:
+                    ts = list(ts) + [e + 1]
+                    vs = list(vs) + [self.value_at(e)]
+                merged.append((s, e, ts, vs))
+                continue
+
+            #重なる編集は指定順に反映する
+            conflicts.append([edits[n][:2] for n in sorted(members)])
+            i, j = self.index_range(lo, hi)
+            part = BPList()
+            part.times = self.times[i:j]
+            part.values = self.values[i:j]
+            for n in sorted(members):
+                s, e, ts, vs, hold = edits[n]
+                if hold:
+                    try:
+                        end_value = part.value_at(e)
+                    except IndexError:
+                        end_value = self.value_at(lo - 1)
+                    ts = list(ts) + [e + 1]
+                    vs = list(vs) + [end_value]
+                part.splice(s, e, ts, vs)
+            merged.append((lo, hi, part.times, part.values))
+        self.merge(merged)
+        return conflicts
+
+    def __edit_range(self, edit):
+        s, e, ts, vs, hold = edit
+        lo = min([s] + list(ts[:1]))
+        hi = max([e + 1 if hold else e] + list(ts[-1:]))
+        return lo, hi
+
+
+def simplify(times, values, tolerance=0):
+    """点列から、値の変化がtolerance以下の点を取り除く
+    BPListの値は次の点まで保持されるので、残した点の値との差が
+    toleranceを超えた点だけを残せば、どの時間でも値の誤差はtolerance以下になる
+    （tolerance=0なら同じ値が続く点だけを取り除く）
+    Args:
+        times: 各点の時間のリスト（時間順）
+        values: 各点の値のリスト
+        tolerance: 許容する値の誤差
+
+    Returns:
+        (時間のarray, 値のarray)
+    """
+    kept_t = array('i')
+    kept_v = array('i')
+    last = None
+    for t, v in zip(times, values):
+        if last is None or abs(v - last) > tolerance:
+            kept_t.append(int(t))
+            kept_v.append(int(v))
+            last = v
+    return kept_t, kept_v
+
+
+def _sorted_points(times, values):
+    points = sorted(zip(times, values))
+    return (array('i', [int(t) for t, v in points]),
+            array('i', [int(v) for t, v in points]))
+
+
+def _merge_points(t1, v1, t2, v2):
+    """時間順に並んだ2つの点列を(時間, 値)の順にマージする"""
+    times = array('i')
+    values = array('i')
+    i = j = 0
+    n1 = len(t1)
+    n2 = len(t2)
+    while i < n1 and j < n2:
+        if (t1[i], v1[i]) <= (t2[j], v2[j]):
+            times.append(t1[i])
+            values.append(v1[i])
+            i += 1
+        else:
+            times.append(int(t2[j]))
+            values.append(int(v2[j]))
+            j += 1
+    times.extend(t1[i:])
+    values.extend(v1[i:])
+    times.extend(int(t) for t in t2[j:])
+    values.extend(int(v) for v in v2[j:])
+    return times, values
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""時間範囲のノート・パラメータカーブ・歌手変更をまとめたクリップ
+VSQEditor.extractで切り出し、VSQEditor.pasteで同じエディタの別の時間や
+別のトラック、別のエディタに貼り付ける。時間は範囲の開始時間からの
+相対時間で持つので、pickleしてプロセス間で受け渡せる
+
+Examples:
+    clip = editor.extract(19200, 26880)      # サビの8小節
+    editor.paste(clip, 42240)                # 2回目のサビに貼り付ける
+    other.paste(clip, 1920, track=1)         # 別のファイルのトラックに
+"""
+import tools
+from array import array
+from bplist import BPList
+from normaltrack import _start_index
+from singer import Singer
+
+
+class Clip(object):
+    """切り出した時間範囲
+    Attributes:
+        length: 範囲の長さ
+        time_div: 4分音符分のデルタタイム（貼り付け先と同じであること）
+        anotes: Anoteのリスト（開始時間は相対時間、範囲の終端で切り詰める）
+        curves: カーブ名をキーとし、(相対時間のarray, 値のarray)を値とする
+            ディクショナリ（範囲の開始時に続いている値を時間0の点として含む）
+        singers: (相対時間, 歌手変更のパラメータ)のリスト
+    """
+    def __init__(self, length, time_div):
+        self.length = length
+        self.time_div = time_div
+        self.anotes = []
+        self.curves = {}
+        self.singers = []
+
+    def __repr__(self):
+        return "Clip(length=%d, notes=%d, curves=%d, singers=%d)" % (
+            self.length, len(self.anotes), len(self.curves),
+            len(self.singers))
+
+    @classmethod
+    def extract(cls, track, s, e, time_div):
+        """トラックのsからeまで（eを含まない）を切り出す
+        Args:
+            track: NormalTrackインスタンス
+            s: 開始時間
+            e: 終了時間
+            time_div: 4分音符分のデルタタイム
+
+        Returns:
+            Clipインスタンス
+        """
+        clip = cls(e - s, time_div)
+        anotes = track.anotes
+        i = _start_index(anotes, s)
+        j = _start_index(anotes, e)
+        for anote in list.__getslice__(anotes, i, j):
+            anote = anote.copy()
+            anote.start -= s
+            anote.length = min(anote.length, clip.length - anote.start)
+            clip.anotes.append(anote)
+
+        for key, bp in track.data.items():
+            if not isinstance(bp, BPList):
+                continue
+            i, j = bp.index_range(s, e - 1)
+            times = array('i', [t - s for t in bp.times[i:j]])
+            values = bp.values[i:j]
+            if i > 0 and not (times and times[0] == 0):
+                times.insert(0, 0)
+                values.insert(0, bp.values[i - 1])
+            if times:
+                clip.curves[key] = (times, values)
+
+        clip.singers = [(int(singer.start) - s,
+                         tools.copy_dict(singer.params))
+                        for singer in track.singers
+                        if s <= int(singer.start) < e]
+        return clip
+
+    def curve_edit(self, ptype, at):
+        """カーブをatに貼り付ける書き換え (s, e, 時間, 値) を求める
+        （カーブがなければNone）
+        """
+        if not ptype in self.curves:
+            return None
+        times, values = self.curves[ptype]
+        return (at, at + self.length - 1, [at + t for t in times], values)
+
+    def placed_anotes(self, at):
+        """atに貼り付けるAnoteのリストを作る（時間順）"""
+        anotes = []
+        for anote in self.anotes:
+            anote = anote.copy()
+            anote.start += at
+            anotes.append(anote)
+        return anotes
+
+    def placed_singers(self, at):
+        """atに貼り付けるSingerのリストを作る（時間順）"""
+        return [Singer(str(at + t), tools.copy_dict(params))
+                for t, params in self.singers]
+
+
+def splice_singers(singers, s, e, new):
+    """sからeまで（eを含まない）の歌手変更をnewで置き換えたリストを作る"""
+    kept = [singer for singer in singers if not s <= int(singer.start) < e]
+    return sorted(kept + new, key=lambda x: int(x.start))
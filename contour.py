@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+from array import array
+
+#接尾辞の長さを超えた位置の値（どの音程よりも小さい）
+_END = float('-inf')
+#音程差として現れない大きさ（範囲の条件の省略時の値）
+_END_VALUE = 1 << 30
+
+
+class ContourIndex(object):
+    """音程の変化（旋律の輪郭）の索引
+    隣り合うノートの音程差の列に対する接尾辞配列を持つ。
+    音程差の条件の列（パターン）にマッチする位置の検索が、
+    条件を満たす音程差の種類数をgとして O(g log n + k) で行える
+
+    パターンの各要素は次のいずれか
+        整数: その音程差に一致する
+        (下限, 上限): 下限以上上限以下の音程差（Noneなら制限しない）
+        None: 任意の音程差
+
+    Attributes:
+        intervals: 各ノートと次のノートの音程差（array）
+        suffixes: 接尾辞配列（音程差の列の接尾辞を辞書順に並べた開始位置）
+
+    Examples:
+        index = ContourIndex([60, 62, 67, 65, 72, 71])
+        index.intervals => array('i', [2, 5, -2, 7, -1])
+        #5半音以上上がった後に1〜2半音下がる
+        index.find([(5, None), (-2, -1)]) => [1, 3]
+        index.find([2, 5]) => [0]
+    """
+    def __init__(self, notes):
+        """コンストラクタ
+        Args:
+            notes: 各ノートの音高のリスト
+        """
+        self.intervals = array('i', [notes[i + 1] - notes[i]
+                                     for i in xrange(len(notes) - 1)])
+        self.suffixes = _suffix_array(self.intervals)
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def find(self, pattern):
+        """パターンにマッチする位置を取得する
+        Args:
+            pattern: 音程差の条件のリスト
+
+        Returns:
+            マッチした音程差の列の開始位置（最初のノートの番号）のリスト（昇順）
+            空のパターンは全てのノートにマッチする
+        """
+        if not pattern:
+            return range(len(self.intervals) + 1)
+        conditions = [_condition(c) for c in pattern]
+        found = []
+        self.__search(conditions, 0, 0, len(self.suffixes), found)
+        found.sort()
+        return found
+
+    def count(self, pattern):
+        """パターンにマッチする位置の数を数える"""
+        return len(self.find(pattern))
+
+    def __value(self, i, d):
+        #i番目の接尾辞のd番目の音程差
+        j = self.suffixes[i] + d
+        return self.intervals[j] if j < len(self.intervals) else _END
+
+    def __bound(self, lo, hi, d, value, right):
+        #d番目の音程差がvalue以上（rightならvalueより大きい）になる最初の位置
+        while lo < hi:
+            mid = (lo + hi) // 2
+            v = self.__value(mid, d)
+            if v < value or (right and v == value):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def __search(self, conditions, d, lo, hi, found):
+        #接尾辞配列のlo:hiの範囲は先頭d個の音程差が等しい
+        if lo >= hi:
+            return
+        if d == len(conditions):
+            found.extend(self.suffixes[lo:hi])
+            return
+        low, high = conditions[d]
+        lo = self.__bound(lo, hi, d, low, False)
+        hi = self.__bound(lo, hi, d, high, True)
+        if low == high:
+            self.__search(conditions, d + 1, lo, hi, found)
+            return
+        #範囲の条件は音程差の値ごとに分けて次の条件を調べる
+        while lo < hi:
+            end = self.__bound(lo, hi, d, self.__value(lo, d), True)
+            self.__search(conditions, d + 1, lo, end, found)
+            lo = end
+
+
+def _condition(c):
+    #パターンの要素を(下限, 上限)にする
+    if c is None:
+        return (-_END_VALUE, _END_VALUE)
+    if isinstance(c, tuple):
+        low, high = c
+        return (-_END_VALUE if low is None else low,
+                _END_VALUE if high is None else high)
+    return (c, c)
+
+
+def _suffix_array(seq):
+    """列の接尾辞配列を求める（ダブリング）
+    Args:
+        seq: 整数の列
+
+    Returns:
+        接尾辞の開始位置を辞書順に並べたarray（短い接尾辞は前に来る）
+    """
+    n = len(seq)
+    suffixes = range(n)
+    rank = list(seq)
+    k = 1
+    while n:
+        key = lambda i: (rank[i], rank[i + k] if i + k < n else _END)
+        suffixes.sort(key=key)
+        new_rank = [0] * n
+        for j in xrange(1, n):
+            new_rank[suffixes[j]] = new_rank[suffixes[j - 1]] + \
+                (key(suffixes[j - 1]) < key(suffixes[j]))
+        rank = new_rank
+        if rank[suffixes[-1]] == n - 1 or k >= n:
+            break
+        k *= 2
+    return array('i', suffixes)
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""VSQファイル群に対するルール適用候補の統計
+ファイルごとにプロセスプールのワーカーでパースと候補の取得を行い、
+ワーカーからはマージできる小さな集計（件数、ヒストグラム、分位点のスケッチ）
+だけを親プロセスに返す。ルールは適用しない
+
+使い方:
+    python corpusstats.py corpus/*.vsq
+    python corpusstats.py --processes 4 corpus/*.vsq
+
+Examples:
+    stats = corpus_stats(['a.vsq', 'b.vsq'], [zuii_rule, san_rule])
+    stats['rules']['R1']['cands'] => 12
+    stats['rules']['R1']['lengths'].quantile(0.5) => 240.0
+    stats['rules']['R1']['dynamics'].quantile(0.9) => 80
+"""
+import math
+import multiprocessing
+import sys
+
+
+class Histogram(object):
+    """値ごとの出現回数（マージできる）
+    Attributes:
+        counts: 値をキーとし、回数を値とするディクショナリ
+    """
+    def __init__(self):
+        self.counts = {}
+
+    def add(self, value, n=1):
+        self.counts[value] = self.counts.get(value, 0) + n
+
+    def merge(self, other):
+        """otherの回数を加える"""
+        for value, n in other.counts.items():
+            self.add(value, n)
+        return self
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def most_common(self, limit=None):
+        """(値, 回数)のリスト（回数の多い順）"""
+        items = sorted(self.counts.items(), key=lambda x: (-x[1], x[0]))
+        return items[:limit] if limit else items
+
+    def quantile(self, q):
+        """値の分位点（値が順序付けられる場合）
+        Args:
+            q: 0から1までの割合
+
+        Returns:
+            値（空ならNone）
+        """
+        total = self.total()
+        if not total:
+            return None
+        rank = q * (total - 1)
+        seen = 0
+        for value, n in sorted(self.counts.items()):
+            seen += n
+            if seen > rank:
+                return value
+        return value
+
+
+class QuantileSketch(object):
+    """分位点を相対誤差alpha以内で求めるスケッチ（マージできる）
+    正の値を対数の幅のバケットに数える。0以下の値は0として数える
+
+    Attributes:
+        alpha: 相対誤差
+        count: 値の数
+        zeros: 0以下の値の数
+        buckets: バケット番号をキーとし、回数を値とするディクショナリ
+        min: 最小値
+        max: 最大値
+    """
+    def __init__(self, alpha=0.01):
+        self.alpha = alpha
+        self._gamma = (1 + alpha) / (1 - alpha)
+        self._log_gamma = math.log(self._gamma)
+        self.count = 0
+        self.zeros = 0
+        self.buckets = {}
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if value <= 0:
+            self.zeros += 1
+            return
+        i = int(math.ceil(math.log(value) / self._log_gamma))
+        self.buckets[i] = self.buckets.get(i, 0) + 1
+
+    def merge(self, other):
+        """otherの値を加える（alphaが同じであること）"""
+        if other.alpha != self.alpha:
+            raise ValueError("cannot merge sketches with different alpha")
+        if not other.count:
+            return self
+        self.count += other.count
+        self.zeros += other.zeros
+        for i, n in other.buckets.items():
+            self.buckets[i] = self.buckets.get(i, 0) + n
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    def quantile(self, q):
+        """値の分位点
+        Args:
+            q: 0から1までの割合
+
+        Returns:
+            分位点（空ならNone）
+        """
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if seen > rank:
+            return 0.0
+        for i in sorted(self.buckets):
+            seen += self.buckets[i]
+            if seen > rank:
+                value = 2 * self._gamma ** i / (self._gamma + 1)
+                return min(max(value, self.min), self.max)
+        return float(self.max)
+
+
+def rule_aggregate(rule):
+    """1つのルールの集計の初期値"""
+    return {"rule_id": rule['rule_id'], "name": rule['name'],
+            "cands": 0, "files": 0,
+            "lengths": QuantileSketch(),
+            "relative_notes": Histogram(),
+            "dynamics": Histogram()}
+
+
+def merge_aggregates(total, part):
+    """ルールごとの集計をマージする
+    Args:
+        total: マージ先（ルールIDをキーとするディクショナリ）
+        part: マージする集計
+    """
+    for rule_id, agg in part.items():
+        if not rule_id in total:
+            total[rule_id] = agg
+            continue
+        dest = total[rule_id]
+        dest["cands"] += agg["cands"]
+        dest["files"] += agg["files"]
+        for key in ["lengths", "relative_notes", "dynamics"]:
+            dest[key].merge(agg[key])
+    return total
+
+
+def file_stats(job):
+    """1ファイル分の集計を行う
+    プロセスプールのワーカーから呼ばれる
+    Args:
+        job: (VSQファイルのパス, ルール定義のリスト)
+
+    Returns:
+        (パス, ルールIDをキーとする集計)
+        パースできなかった場合は(パス, None)
+    """
+    from vsq import VSQEditor
+    from vsq_rules import Rule
+    path, rules = job
+    rules = [Rule.compile(rule) for rule in rules]
+    try:
+        editor = VSQEditor(filename=path)
+    except Exception:
+        return path, None
+
+    aggregates = dict((rule.rule_id, rule_aggregate(rule)) for rule in rules)
+    for n, track in enumerate(editor.normal_tracks):
+        editor.select_track(n)
+        dynamics = track.data['DynamicsBPList']
+        for rule in rules:
+            agg = aggregates[rule.rule_id]
+            for cand in editor.get_rule_cands(rule):
+                agg["cands"] += 1
+                anotes = cand['anotes']
+                agg["relative_notes"].add(tuple(anotes.relative_notes))
+                for anote in anotes:
+                    agg["lengths"].add(anote.length)
+                    try:
+                        agg["dynamics"].add(dynamics.value_at(anote.start))
+                    except IndexError:
+                        pass
+    for agg in aggregates.values():
+        agg["files"] = 1 if agg["cands"] else 0
+    return path, aggregates
+
+
+def corpus_stats(paths, rules, processes=None, chunksize=4):
+    """VSQファイル群のルール適用候補の統計を求める
+    Args:
+        paths: VSQファイルのパスのリスト
+        rules: ルール定義のリスト
+        processes: プロセス数（省略時はCPU数、1ならこのプロセスで処理）
+        chunksize: 1回にワーカーに渡すファイル数
+
+    Returns:
+        {"files": 集計したファイル数,
+         "failed": パースできなかったファイルのパスのリスト,
+         "rules": {ルールID: {"rule_id", "name",
+                              "cands": 候補数,
+                              "files": 候補のあったファイル数,
+                              "lengths": 候補のノートの長さのQuantileSketch,
+                              "relative_notes":
+                                  候補の相対音程（タプル）のHistogram,
+                              "dynamics":
+                                  候補のノートの開始時のダイナミクスの
+                                  Histogram}}}
+    """
+    jobs = [(path, rules) for path in paths]
+    if processes == 1 or len(jobs) <= 1:
+        results = map(file_stats, jobs)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(file_stats, jobs, chunksize)
+
+    total = {"files": 0, "failed": [], "rules": {}}
+    try:
+        for path, aggregates in results:
+            if aggregates is None:
+                total["failed"].append(path)
+                continue
+            total["files"] += 1
+            merge_aggregates(total["rules"], aggregates)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    total["failed"].sort()
+    return total
+
+
+def report(stats, out=sys.stdout):
+    """集計結果を表示する"""
+    out.write("files: %d (failed %d)\n" % (stats["files"],
+                                          len(stats["failed"])))
+    for rule_id, agg in sorted(stats["rules"].items()):
+        out.write("%s %s: %d cands in %d files\n" % (
+            rule_id, agg["name"], agg["cands"], agg["files"]))
+        if not agg["cands"]:
+            continue
+        out.write("  length  p10/p50/p90: %s\n" % "/".join(
+            "%d" % agg["lengths"].quantile(q) for q in (0.1, 0.5, 0.9)))
+        out.write("  dynamics p10/p50/p90: %s\n" % "/".join(
+            "%s" % agg["dynamics"].quantile(q) for q in (0.1, 0.5, 0.9)))
+        out.write("  relative_notes: %s\n" % ", ".join(
+            "%s x%d" % (list(notes), n)
+            for notes, n in agg["relative_notes"].most_common(5)))
+
+
+if __name__ == '__main__':
+    import optparse
+    from vsq_rules import san_rule, zuii_rule, port_rule, n_accent_rule
+    parser = optparse.OptionParser(usage="%prog [options] FILE...")
+    parser.add_option("--processes", type="int", default=None)
+    options, args = parser.parse_args()
+    if not args:
+        parser.error("no input files")
+    report(corpus_stats(args, [san_rule, zuii_rule, port_rule,
+                               n_accent_rule], options.processes))
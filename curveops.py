@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""パラメータカーブ（BPList）の時間範囲に対する演算
+各演算はBPListのarrayをnumpy配列として一度に計算し、
+BPList.apply_editsに渡せる書き換え (s, e, 時間, 値, hold) を返す。
+書き換えはholdするので、範囲の後（e+1以降）の値は変わらない
+
+BPListの値は次の点まで保持されるので、加算・乗算・範囲制限は
+範囲内の点（とsでの値）だけを計算する。平滑化・クロスフェードは
+step間隔の時間で値を求めて点にする（値の変わらない点は除く）
+
+Examples:
+    edit = multiply(bp, 1920, 7680, 0.8)
+    bp.apply_edits([edit])
+    apply(bp, 'smooth', 0, 9600, width=120, kernel='gaussian')
+    #VSQEditorでは（batch内でまとめて反映できる）
+    editor.edit_curve('DynamicsBPList', 'add', 1920, 7680, delta=-10)
+"""
+import numpy
+from array import array
+from bisect import bisect_right
+from vsq_rules import rescale
+
+#平滑化・クロスフェードで値を求める時間の間隔（tick）
+STEP = 5
+
+#カーブ名ごとの値の範囲
+LIMITS = {
+    'PitchBendBPList': (-8192, 8191),
+    'PitchBendSensBPList': (0, 24),
+    'DynamicsBPList': (0, 127),
+    'EpRResidualBPList': (0, 127),
+    'EpRESlopeBPList': (0, 127),
+    'EpRESlopeDepthBPList': (0, 127),
+    'Reso1FreqBPList': (0, 127),
+    'Reso1BWBPList': (0, 127),
+    'Reso1AmpBPList': (0, 127),
+    'BreathinessBPList': (0, 127),
+    'BrightnessBPList': (0, 127),
+    'ClearnessBPList': (0, 127),
+    'OpeningBPList': (0, 127),
+    'GenderFactorBPList': (0, 127),
+    'PortamentoTimingBPList': (0, 127)}
+
+
+def add(bp, s, e, delta, limits=None):
+    """sからeまでの値にdeltaを加える"""
+    times, values = _section(bp, s, e)
+    if times is None:
+        return None
+    return _edit(s, e, times, values + delta, limits)
+
+
+def multiply(bp, s, e, factor, center=0, limits=None):
+    """sからeまでの値をcenterを中心にfactor倍する"""
+    times, values = _section(bp, s, e)
+    if times is None:
+        return None
+    return _edit(s, e, times, center + (values - center) * factor, limits)
+
+
+def clamp(bp, s, e, low=None, high=None, limits=None):
+    """sからeまでの値をlow以上high以下にする（Noneなら制限しない）"""
+    times, values = _section(bp, s, e)
+    if times is None:
+        return None
+    values = numpy.clip(values,
+                        low if low is not None else values.min(),
+                        high if high is not None else values.max())
+    return _edit(s, e, times, values, limits)
+
+
+def smooth(bp, s, e, width, kernel='box', step=STEP, limits=None):
+    """sからeまでの値を平滑化する
+    範囲外の値も窓に含めるので、範囲の境界で値が飛ばない
+    Args:
+        width: 窓の幅（tick）
+        kernel: "box"（移動平均）または"gaussian"（標準偏差width/4）
+        step: 値を求める時間の間隔
+    """
+    n = max(1, int(width) // step)
+    if kernel == 'box':
+        weights = numpy.ones(n)
+    elif kernel == 'gaussian':
+        x = numpy.arange(n) - (n - 1) / 2.0
+        weights = numpy.exp(-0.5 * (x / (n / 4.0)) ** 2)
+    else:
+        raise ValueError("unknown kernel: %s" % kernel)
+    weights /= weights.sum()
+
+    pad = n // 2 + 1
+    count = (e - s) // step + 1
+    ticks = s + numpy.arange(-pad, count + pad) * step
+    times, values = _window(bp, ticks[0], ticks[-1])
+    if times is None:
+        return None
+    smoothed = numpy.convolve(_sample(times, values, ticks), weights, 'same')
+    return _edit(s, e, ticks[pad:pad + count], smoothed[pad:pad + count],
+                 limits, True)
+
+
+def crossfade(bp, s, e, other, step=STEP, limits=None):
+    """sからeまでの値を、bpの値からotherの値へ直線的に移す
+    Args:
+        other: 移り先のBPList
+    """
+    ticks = _ticks(s, e, step, bp, other)
+    a = _window(bp, s, e)
+    b = _window(other, s, e)
+    if a[0] is None or b[0] is None:
+        return None
+    w = (ticks - s) / float(max(1, e - s))
+    values = (1 - w) * _sample(a[0], a[1], ticks) + \
+        w * _sample(b[0], b[1], ticks)
+    return _edit(s, e, ticks, values, limits, True)
+
+
+def blend(bp, s, e, curve, amount=1.0, limits=None):
+    """sからeまでの値に、e-sに伸縮したカーブを混ぜる
+    Args:
+        curve: カーブを表すリスト（ルールのdyn_curves, pit_curvesの要素など）
+        amount: カーブの割合（1ならカーブで置き換える）
+    """
+    if e - s < 0 or not curve:
+        return None
+    offsets, curve_values = rescale(curve, e - s)
+    curve_times = s + numpy.array(offsets, dtype=numpy.int64)
+    curve_values = numpy.array(curve_values, dtype=numpy.float64)
+    times, values = _window(bp, s, e)
+    if times is None:
+        return None
+    ticks = numpy.union1d(curve_times, times[times >= s])
+    values = (1 - amount) * _sample(times, values, ticks) + \
+        amount * _sample(curve_times, curve_values, ticks)
+    return _edit(s, e, ticks, values, limits, True)
+
+
+OPS = {
+    'add': add,
+    'multiply': multiply,
+    'clamp': clamp,
+    'smooth': smooth,
+    'crossfade': crossfade,
+    'blend': blend}
+
+
+def edit(bp, op, s, e, **kwargs):
+    """演算名を指定して書き換えを求める
+    Args:
+        bp: BPListインスタンス
+        op: OPSのキー、または演算の関数
+        s: 開始時間
+        e: 終了時間
+        kwargs: 演算の引数
+
+    Returns:
+        (s, e, 時間のarray, 値のarray, True)
+        範囲が空（e < s）か、範囲以前に点がなく書き換えられない場合はNone
+    """
+    if not callable(op):
+        op = OPS[op]
+    if e < s:
+        return None
+    return op(bp, s, e, **kwargs)
+
+
+def apply(bp, op, s, e, **kwargs):
+    """演算をBPListに反映する（editを参照）
+    Returns:
+        反映したかどうか
+    """
+    result = edit(bp, op, s, e, **kwargs)
+    if result is None:
+        return False
+    bp.apply_edits([result])
+    return True
+
+
+def _window(bp, s, e):
+    """s以前の最後の点からe以下の最後の点までをnumpy配列で取得する
+    Returns:
+        (時間, 値)。e以前に点がなければ(None, None)
+    """
+    i = max(0, bisect_right(bp.times, s) - 1)
+    j = bisect_right(bp.times, e)
+    if j <= i:
+        return None, None
+    return (numpy.frombuffer(bp.times[i:j].tostring(), dtype=numpy.int32),
+            numpy.frombuffer(bp.values[i:j].tostring(),
+                             dtype=numpy.int32).astype(numpy.float64))
+
+
+def _section(bp, s, e):
+    """sからeまでの点を取得する。s以前に点があればsでの値を先頭に加える"""
+    times, values = _window(bp, s, e)
+    if times is None:
+        return None, None
+    if times[0] < s:
+        times = times.copy()
+        times[0] = s
+    return times, values
+
+
+def _sample(times, values, ticks):
+    """各時間での値を求める（最初の点より前は最初の点の値）"""
+    i = numpy.searchsorted(times, ticks, side='right') - 1
+    return values[numpy.maximum(i, 0)]
+
+
+def _ticks(s, e, step, *curves):
+    #step間隔の時間と、範囲内の各カーブの点の時間
+    ticks = [numpy.arange(s, e + 1, step)]
+    for bp in curves:
+        times, values = _window(bp, s, e)
+        if times is not None:
+            ticks.append(times[times >= s])
+    return numpy.union1d(ticks[0], numpy.concatenate(ticks))
+
+
+def _edit(s, e, times, values, limits, dedupe=False):
+    """書き換えのタプルを作る（値は丸めてlimitsの範囲にする）"""
+    values = numpy.rint(values)
+    if limits is not None:
+        values = numpy.clip(values, *limits)
+    times = numpy.asarray(times, dtype=numpy.int32)
+    values = values.astype(numpy.int32)
+    if dedupe and len(values):
+        keep = numpy.concatenate([[True], values[1:] != values[:-1]])
+        times = times[keep]
+        values = values[keep]
+    return (s, e, _array(times), _array(values), True)
+
+
+def _array(a):
+    result = array('i')
+    result.fromstring(a.tostring())
+    return result
@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+"""App Engineの外でmain.pyを動かすための互換層
+google.appengine.ext.webapp（RequestHandler, WSGIApplication, template,
+util.run_wsgi_app）とgoogle.appengine.api.memcacheの、main.pyが使う範囲だけを
+WSGIで実装する。install()は本物のSDKがimportできない場合だけ
+sys.modulesに登録するので、SDKがある環境ではSDKがそのまま使われる
+
+memcacheは同じプロセス内のディクショナリで、App Engineと同じく値を
+pickleして保存し、MAX_VALUE_SIZEを超える値は保存しない。
+main.pyのキーは利用者を区別しないので、負荷試験では利用者ごとに
+namespaceを切り替える（namespace_managerに相当）
+
+Examples:
+    import gaeshim
+    gaeshim.install()
+    import main
+    status, headers, body = gaeshim.call(main.application, 'GET', '/')
+"""
+import cgi
+import cPickle as pickle
+import re
+import sys
+import time
+import traceback
+import types
+import urllib
+import urlparse
+from StringIO import StringIO
+
+#memcacheに保存できる値の大きさ（pickle後のバイト数）
+MAX_VALUE_SIZE = 1000000
+#これより大きいtimeは相対時間ではなく絶対時刻（App Engineと同じ）
+MAX_RELATIVE_TIME = 60 * 60 * 24 * 30
+
+STATUS_TEXT = {200: 'OK', 404: 'Not Found', 405: 'Method Not Allowed',
+               500: 'Internal Server Error'}
+
+
+class Memcache(object):
+    """プロセス内のmemcache
+    Attributes:
+        namespace: キーの名前空間（利用者ごとに切り替える）
+        rejected: 大きすぎて保存しなかった値の数
+    """
+    def __init__(self):
+        self.namespace = ''
+        self.rejected = 0
+        self.__data = {}
+
+    def __key(self, key, key_prefix=''):
+        return (self.namespace, key_prefix + key)
+
+    def __expire(self, t):
+        if not t:
+            return None
+        if t > MAX_RELATIVE_TIME:
+            return t
+        return time.time() + t
+
+    def __lookup(self, key):
+        item = self.__data.get(key)
+        if item is None:
+            return None
+        expire, value = item
+        if expire is not None and expire <= time.time():
+            del self.__data[key]
+            return None
+        return item
+
+    def __store(self, key, value, t, mode):
+        if mode == 'add' and self.__lookup(key) is not None:
+            return False
+        if mode == 'replace' and self.__lookup(key) is None:
+            return False
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(value) > MAX_VALUE_SIZE:
+            self.rejected += 1
+            return False
+        self.__data[key] = (self.__expire(t), value)
+        return True
+
+    def get(self, key, namespace=None):
+        item = self.__lookup(self.__key(key))
+        if item is None:
+            return None
+        return pickle.loads(item[1])
+
+    def get_multi(self, keys, key_prefix='', namespace=None):
+        result = {}
+        for key in keys:
+            item = self.__lookup(self.__key(key, key_prefix))
+            if item is not None:
+                result[key] = pickle.loads(item[1])
+        return result
+
+    def set(self, key, value, time=0, namespace=None):
+        return self.__store(self.__key(key), value, time, 'set')
+
+    def add(self, key, value, time=0, namespace=None):
+        return self.__store(self.__key(key), value, time, 'add')
+
+    def replace(self, key, value, time=0, namespace=None):
+        return self.__store(self.__key(key), value, time, 'replace')
+
+    def __store_multi(self, mapping, t, key_prefix, mode):
+        #保存できなかったキーのリストを返す
+        return [key for key, value in mapping.items()
+                if not self.__store(self.__key(key, key_prefix), value, t,
+                                    mode)]
+
+    def set_multi(self, mapping, time=0, key_prefix='', namespace=None):
+        return self.__store_multi(mapping, time, key_prefix, 'set')
+
+    def add_multi(self, mapping, time=0, key_prefix='', namespace=None):
+        return self.__store_multi(mapping, time, key_prefix, 'add')
+
+    def replace_multi(self, mapping, time=0, key_prefix='', namespace=None):
+        return self.__store_multi(mapping, time, key_prefix, 'replace')
+
+    def delete(self, key, seconds=0, namespace=None):
+        return 2 if self.__data.pop(self.__key(key), None) else 1
+
+    def flush_all(self):
+        self.__data.clear()
+        return True
+
+    def get_stats(self):
+        return {'items': len(self.__data),
+                'bytes': sum(len(v) for e, v in self.__data.values())}
+
+
+class Request(object):
+    """webappのRequestのうちmain.pyが使う部分
+    Attributes:
+        method: "GET", "POST"など
+        path: パス
+        body_file: POSTのフォームを解析した後の本体（varsにフィールド）
+    """
+    def __init__(self, environ):
+        self.environ = environ
+        self.method = environ.get('REQUEST_METHOD', 'GET')
+        self.path = environ.get('PATH_INFO', '/')
+        self.__params = {}
+        query = urlparse.parse_qs(environ.get('QUERY_STRING', ''),
+                                  keep_blank_values=True)
+        for key, values in query.items():
+            self.__params.setdefault(key, []).extend(values)
+        fields = {}
+        if self.method == 'POST':
+            form = cgi.FieldStorage(fp=environ['wsgi.input'],
+                                    environ=environ, keep_blank_values=True)
+            for field in (form.list or []):
+                fields.setdefault(field.name, field)
+                self.__params.setdefault(field.name, []).append(field.value)
+        self.body_file = FormBody(fields)
+
+    def get(self, name, default_value=''):
+        values = self.__params.get(name)
+        return values[0] if values else default_value
+
+    def get_all(self, name):
+        return list(self.__params.get(name, []))
+
+    def arguments(self):
+        return self.__params.keys()
+
+
+class FormBody(object):
+    """解析済みのPOSTの本体（webobのFakeCGIBodyに相当）"""
+    def __init__(self, vars):
+        self.vars = vars
+
+
+class Response(object):
+    """webappのResponseのうちmain.pyが使う部分"""
+    def __init__(self):
+        self.status = 200
+        self.headers = {'Content-Type': 'text/html; charset=utf-8'}
+        self.out = StringIO()
+
+    def _get_content_type(self):
+        return self.headers['Content-Type']
+
+    def _set_content_type(self, value):
+        self.headers['Content-Type'] = value
+
+    content_type = property(_get_content_type, _set_content_type)
+
+    def set_status(self, code):
+        self.status = code
+
+    def clear(self):
+        self.out = StringIO()
+
+    def body(self):
+        body = self.out.getvalue()
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        return body
+
+
+class RequestHandler(object):
+    def initialize(self, request, response):
+        self.request = request
+        self.response = response
+
+    def error(self, code):
+        self.response.set_status(code)
+        self.response.clear()
+
+    def handle_exception(self, exception, debug_mode):
+        self.error(500)
+        if debug_mode:
+            self.response.content_type = 'text/plain'
+            self.response.out.write(traceback.format_exc())
+
+
+class WSGIApplication(object):
+    """パスの正規表現とRequestHandlerの組からなるWSGIアプリケーション"""
+    def __init__(self, url_mapping, debug=False):
+        self.debug = debug
+        self.url_mapping = [(re.compile('^%s$' % regexp), handler)
+                            for regexp, handler in url_mapping]
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        response = Response()
+        for regexp, handler_class in self.url_mapping:
+            match = regexp.match(request.path)
+            if match:
+                break
+        else:
+            response.set_status(404)
+            return self.__respond(response, start_response)
+
+        handler = handler_class()
+        handler.initialize(request, response)
+        method = getattr(handler, request.method.lower(), None)
+        if method is None:
+            handler.error(405)
+        else:
+            try:
+                method(*match.groups())
+            except Exception, e:
+                handler.handle_exception(e, self.debug)
+        return self.__respond(response, start_response)
+
+    def __respond(self, response, start_response):
+        body = response.body()
+        headers = [(k, str(v)) for k, v in response.headers.items()]
+        headers.append(('Content-Length', str(len(body))))
+        start_response('%d %s' % (response.status,
+                                  STATUS_TEXT.get(response.status, '')),
+                       headers)
+        return [body]
+
+
+def render(template_path, template_dict, debug=False):
+    """テンプレートを表示する
+    Djangoがあれば使い、なければ{{ 変数 }}だけを置換する
+    （{% for %}などのタグはそのまま残る）
+    """
+    source = open(template_path).read()
+    try:
+        from django.template import Context, Template
+    except ImportError:
+        pass
+    else:
+        return Template(source).render(Context(template_dict))
+
+    def lookup(match):
+        value = template_dict
+        for name in match.group(1).split('.'):
+            if isinstance(value, dict):
+                value = value.get(name, '')
+            else:
+                value = getattr(value, name, '')
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return str(value)
+    return re.sub(r'{{\s*([\w.]+)\s*}}', lookup, source)
+
+
+def run_wsgi_app(application):
+    from wsgiref.handlers import CGIHandler
+    CGIHandler().run(application)
+
+
+def call(application, method, path, params=None, files=None):
+    """WSGIアプリケーションを呼び出す
+    Args:
+        application: WSGIアプリケーション
+        method: "GET"または"POST"
+        path: パス
+        params: (名前, 値)のリスト（GETではクエリ文字列、POSTではフォーム）
+        files: (名前, ファイル名, 内容)のリスト（POSTのみ）
+
+    Returns:
+        (ステータスコード, ヘッダのディクショナリ, 本体)
+    """
+    params = params or []
+    environ = {'REQUEST_METHOD': method, 'PATH_INFO': path,
+               'QUERY_STRING': '', 'SERVER_NAME': 'localhost',
+               'SERVER_PORT': '80', 'wsgi.url_scheme': 'http',
+               'wsgi.errors': sys.stderr}
+    if method == 'GET':
+        environ['QUERY_STRING'] = urllib.urlencode(params)
+        body = ''
+    else:
+        content_type, body = encode_multipart(params, files or [])
+        environ['CONTENT_TYPE'] = content_type
+    environ['CONTENT_LENGTH'] = str(len(body))
+    environ['wsgi.input'] = StringIO(body)
+
+    result = {}
+
+    def start_response(status, headers):
+        result['status'] = int(status.split()[0])
+        result['headers'] = dict(headers)
+    body = ''.join(application(environ, start_response))
+    return result['status'], result['headers'], body
+
+
+def encode_multipart(params, files):
+    """multipart/form-dataの本体を作る
+    Returns:
+        (Content-Type, 本体)
+    """
+    boundary = '----gaeshim%d' % id(params)
+    lines = []
+    for name, value in params:
+        lines += ['--' + boundary,
+                  'Content-Disposition: form-data; name="%s"' % name,
+                  '', str(value)]
+    for name, filename, content in files:
+        lines += ['--' + boundary,
+                  'Content-Disposition: form-data; name="%s"; filename="%s"'
+                  % (name, filename),
+                  'Content-Type: application/octet-stream', '', content]
+    lines += ['--' + boundary + '--', '']
+    return ('multipart/form-data; boundary=%s' % boundary,
+            '\r\n'.join(lines))
+
+
+#install()で登録するmemcache
+memcache = Memcache()
+
+
+def install():
+    """App EngineのSDKがなければ、この互換層をsys.modulesに登録する
+    Returns:
+        登録したかどうか
+    """
+    try:
+        from google.appengine.ext import webapp
+        return False
+    except ImportError:
+        pass
+
+    def module(name, **attrs):
+        m = sys.modules.get(name) or types.ModuleType(name)
+        m.__dict__.update(attrs)
+        sys.modules[name] = m
+        return m
+
+    template = module('google.appengine.ext.webapp.template', render=render)
+    util = module('google.appengine.ext.webapp.util',
+                  run_wsgi_app=run_wsgi_app)
+    webapp = module('google.appengine.ext.webapp',
+                    RequestHandler=RequestHandler,
+                    WSGIApplication=WSGIApplication,
+                    Request=Request, Response=Response,
+                    template=template, util=util)
+    memcache_module = module('google.appengine.api.memcache')
+    for name in dir(memcache):
+        if not name.startswith('_'):
+            setattr(memcache_module, name, getattr(memcache, name))
+    ext = module('google.appengine.ext', webapp=webapp)
+    api = module('google.appengine.api', memcache=memcache_module)
+    appengine = module('google.appengine', ext=ext, api=api)
+    module('google', appengine=appengine)
+    try:
+        import simplejson
+    except ImportError:
+        import json
+        sys.modules['simplejson'] = json
+    return True
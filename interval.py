@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import heapq
+from array import array
+from bisect import bisect_right
+
+
+class IntervalIndex(object):
+    """区間の集合に対する索引
+    区間を始端時間順に並べ、各部分木の終端時間の最大値を
+    配列上の二分木（セグメント木）として持つ。
+    時間窓と重なる区間の検索が O(log n + k) で行える。
+    区間は始端・終端を含む閉区間として扱う
+
+    Attributes:
+        items: 始端時間順に並べた要素のリスト
+        starts: 各要素の始端時間（array）
+        ends: 各要素の終端時間（array）
+
+    Examples:
+        index = IntervalIndex(["a", "b", "c"], [0, 100, 50], [120, 200, 60])
+        index.query(55, 90) => ["a", "c"]
+        index.overlaps() => [("a", "c"), ("a", "b")]
+    """
+    def __init__(self, items, starts, ends):
+        """コンストラクタ
+        Args:
+            items: 要素のリスト
+            starts: 各要素の始端時間のリスト
+            ends: 各要素の終端時間のリスト
+        """
+        order = sorted(range(len(items)), key=lambda i: starts[i])
+        self.items = [items[i] for i in order]
+        self.starts = array('l', [starts[i] for i in order])
+        self.ends = array('l', [ends[i] for i in order])
+
+        #葉の数を2のべき乗に揃えた二分木
+        size = 1
+        while size < len(order):
+            size *= 2
+        lowest = min(self.ends) if self.ends else 0
+        tree = array('l', [lowest - 1]) * (2 * size)
+        tree[size:size + len(order)] = self.ends
+        for i in xrange(size - 1, 0, -1):
+            tree[i] = max(tree[2 * i], tree[2 * i + 1])
+        self._size = size
+        self._tree = tree
+
+    def __len__(self):
+        return len(self.items)
+
+    def query_positions(self, s, e):
+        """sからeまでの時間窓と重なる要素の位置を取得する
+        Args:
+            s: 時間窓の始端時間
+            e: 時間窓の終端時間
+
+        Returns:
+            itemsにおける位置のリスト（昇順）
+        """
+        hi = bisect_right(self.starts, e)
+        if hi == 0:
+            return []
+        size = self._size
+        tree = self._tree
+        found = []
+        #始端がe以下の範囲[0, hi)を、終端の最大値がs未満の部分木を除いて辿る
+        stack = [(1, 0, size)]
+        while stack:
+            node, lo, width = stack.pop()
+            if lo >= hi or tree[node] < s:
+                continue
+            if width == 1:
+                found.append(lo)
+                continue
+            half = width / 2
+            stack.append((2 * node + 1, lo + half, half))
+            stack.append((2 * node, lo, half))
+        return found
+
+    def query(self, s, e):
+        """sからeまでの時間窓と重なる要素を取得する
+        Args:
+            s: 時間窓の始端時間
+            e: 時間窓の終端時間
+
+        Returns:
+            始端時間順の要素のリスト
+        """
+        return [self.items[i] for i in self.query_positions(s, e)]
+
+    def overlaps(self):
+        """互いに重なっている要素の組を取得する
+        Returns:
+            (先に始まる要素, 後に始まる要素)のリスト
+        """
+        pairs = []
+        active = []  # (終端時間, 位置)のヒープ
+        for i in xrange(len(self.items)):
+            s = self.starts[i]
+            while active and active[0][0] < s:
+                heapq.heappop(active)
+            for end, j in sorted(active, key=lambda x: x[1]):
+                pairs.append((self.items[j], self.items[i]))
+            heapq.heappush(active, (self.ends[i], i))
+        return pairs
@@ -154,13 +154,25 @@ $(document).ready(function(){
             }).addClass("chooseable");
         }
     }
-    var changeGraph = function(){
+    //書き換えられた時間範囲の点だけを差し替える
+    var updateSeries = function(series, updates){
+        var data = $.map(series.data, function(p){ return [[p.x, p.y]]; });
+        for (var i=0; i < updates.length; i++) {
+            var u = updates[i];
+            data = $.grep(data, function(p){ return p[0] < u.s || u.e < p[0]; });
+            data = data.concat(u.points);
+        }
+        data.sort(function(a, b){ return a[0] - b[0]; });
+        series.setData(data);
+    };
+    var changeGraph = function(full){
         var options = {
             success: function(response){
                 dataset = $.evalJSON(response);
-                dynChart.series[0].setData(dataset.dyn);
-                pitChart.series[0].setData(dataset.pit);
+                updateSeries(dynChart.series[0], dataset.dyn);
+                updateSeries(pitChart.series[0], dataset.pit);
             },
+            data: full ? {full: 1} : {},
             url: "/appliedvsq"
         };
         $("#rule-form").ajaxSubmit(options);
@@ -171,7 +183,7 @@ $(document).ready(function(){
     });
     $("select").change(function(){ selectRule($(this).children("option:selected")) });
 
-    changeGraph();
+    changeGraph(true);
     jQuery.getJSON("/appliedlyric", function(anote){
         init_time = anote[0].start_time;
         for (var i=0; i < anote.length; i++) {
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""Webハンドラの負荷試験
+main.applicationをgaeshim（App EngineのSDKがなければWSGIの互換層と
+プロセス内のmemcache）の上で動かし、複数の仮想利用者から
+アップロード → 歌詞の取得 → ルールの切り替え → ダウンロードの
+一連の操作を同時に行う。App Engineのインスタンスと同じく、
+1つのプロセスが1人の利用者のリクエストを順に処理する
+
+エンドポイントごとのレイテンシ（p50, p90, p99）と1リクエストあたりの
+CPU時間、全体のスループットを表示する。エラー（200以外の応答や
+ダウンロードしたファイルの不正）があれば終了コード1にする
+
+使い方:
+    python loadtest.py                        # 計測結果を表示
+    python loadtest.py --users 16             # 利用者の数を変える
+    python loadtest.py --save load.json       # ベースラインとして保存
+    python loadtest.py --compare load.json    # ベースラインと比較し、
+                                              # 閾値を超えて遅くなって
+                                              # いれば終了コード1
+"""
+import json
+import multiprocessing
+import optparse
+import os
+import random
+import resource
+import sys
+import time
+import vsqgen
+
+#アップロードするファイル（名前, 同梱のファイル名またはvsqgen.generateの引数）
+#memcacheに保存できる大きさ（gaeshim.MAX_VALUE_SIZE）に収まる規模にする
+#（同梱のout.vsqはPMbPortamentoUse=Noneを含みパースできないので使わない）
+FILES = [
+    ("test.vsq", "test.vsq"),
+    ("gen_sparse", {"notes": 300, "bp_density": 2, "tracks": 1,
+                    "vibrato": 0.5, "seed": 1}),
+    ("gen_small", {"notes": 200, "bp_density": 8, "tracks": 1}),
+    ("gen_medium", {"notes": 400, "bp_density": 8, "tracks": 1}),
+]
+ENDPOINTS = ["/", "/parse", "/appliedlyric", "/appliedvsq", "/download"]
+#計測誤差として許容する差（秒）
+MIN_DELTA = 0.005
+#比較する値（スループットは小さくなると悪化）
+METRICS = ["p50", "p90", "cpu"]
+
+
+def load_files():
+    """FILESの各ファイルを読み込む
+    Returns:
+        (名前, 内容)のリスト
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    files = []
+    for name, source in FILES:
+        if isinstance(source, dict):
+            binary = vsqgen.generate(**source)
+        else:
+            binary = open(os.path.join(directory, source), 'rb').read()
+        files.append((name, binary))
+    return files
+
+
+class Session(object):
+    """1人の仮想利用者
+    Attributes:
+        records: (エンドポイント, レイテンシ, CPU時間, エラー)のリスト
+    """
+    def __init__(self, application, memcache, user, rand):
+        self.application = application
+        self.memcache = memcache
+        self.user = user
+        self.rand = rand
+        self.records = []
+
+    def request(self, method, path, params=None, files=None):
+        import gaeshim
+        self.memcache.namespace = 'user%d' % self.user
+        t = time.time()
+        cpu = _cpu_time()
+        status, headers, body = gaeshim.call(self.application, method, path,
+                                             params, files)
+        cpu = _cpu_time() - cpu
+        elapsed = time.time() - t
+        error = None if status == 200 else "status %d" % status
+        self.records.append([path, elapsed, cpu, error])
+        return status, body
+
+    def fail(self, error):
+        #直前のリクエストをエラーにする
+        self.records[-1][3] = error
+
+    def run(self, name, binary, toggles, windows):
+        """1つのファイルについて一連の操作を行う"""
+        self.request('GET', '/')
+        status, body = self.request('POST', '/parse',
+                                    files=[('file', name, binary)])
+        if status != 200:
+            return
+        status, body = self.request('GET', '/appliedlyric')
+        if status != 200:
+            return
+        anotes = json.loads(body)
+        ids = sorted(set(r["id"] for a in anotes for r in a["rules"]))
+        if anotes:
+            end = anotes[-1]["start_time"] + anotes[-1]["length"]
+            for i in range(windows):
+                s = self.rand.randint(anotes[0]["start_time"], end)
+                self.request('GET', '/appliedlyric',
+                             [('s', s), ('e', s + 1920)])
+
+        selected = set()
+        for i in range(toggles):
+            if ids:
+                selected ^= set([self.rand.choice(ids)])
+            params = [('rule', id) for id in sorted(selected)]
+            status, body = self.request('POST', '/appliedvsq', params)
+            if status == 200 and not 'dyn' in json.loads(body):
+                self.fail("no curves")
+
+        status, body = self.request('POST', '/download')
+        if status == 200 and body[:4] != 'MThd':
+            self.fail("invalid vsq")
+
+
+def run_user(args):
+    """1人の利用者の操作を別プロセスで行う
+    Args:
+        args: (利用者の番号, セッション数, 切り替えの回数, 歌詞の窓の数,
+            乱数の種)
+
+    Returns:
+        (Session.records, memcacheに保存できなかった値の数)
+    """
+    user, sessions, toggles, windows, seed = args
+    import gaeshim
+    gaeshim.install()
+    import main
+    rand = random.Random(seed + user)
+    files = load_files()
+    session = Session(main.application, gaeshim.memcache, user, rand)
+    for i in range(sessions):
+        name, binary = files[(user + i) % len(files)]
+        session.run(name, binary, toggles, windows)
+    return session.records, gaeshim.memcache.rejected
+
+
+def percentile(values, p):
+    """昇順に並べたvaluesのp%点（最近傍）"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def run(users=8, sessions=3, toggles=5, windows=3, seed=0):
+    """利用者ごとに別プロセスで同時に操作を行う
+    Returns:
+        エンドポイントをキーとし、{"count", "errors", "p50", "p90", "p99",
+        "cpu"}（秒）を値とするディクショナリ
+        "total"に{"requests", "errors", "wall", "throughput", "rejected"}
+    """
+    pool = multiprocessing.Pool(users)
+    try:
+        t = time.time()
+        outputs = pool.map(run_user, [(user, sessions, toggles, windows,
+                                       seed) for user in range(users)])
+        wall = time.time() - t
+    finally:
+        pool.terminate()
+
+    records = [r for rs, rejected in outputs for r in rs]
+    results = {}
+    for path in ENDPOINTS:
+        rs = [r for r in records if r[0] == path]
+        latencies = sorted(r[1] for r in rs)
+        results[path] = {
+            "count": len(rs),
+            "errors": len([r for r in rs if r[3]]),
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "cpu": sum(r[2] for r in rs) / len(rs) if rs else None}
+    results["total"] = {
+        "requests": len(records),
+        "errors": len([r for r in records if r[3]]),
+        "wall": wall,
+        "throughput": len(records) / wall,
+        "rejected": sum(rejected for rs, rejected in outputs)}
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ベースラインより閾値を超えて悪化した項目を調べる
+    Args:
+        results: runの結果
+        baseline: 保存されていたrunの結果
+        threshold: 許容する悪化の割合（0.2なら20%）
+
+    Returns:
+        (エンドポイント, 項目名, ベースラインの値, 今回の値)のリスト
+    """
+    regressions = []
+    for path in ENDPOINTS:
+        base = baseline.get(path, {})
+        for metric in METRICS:
+            value = results[path][metric]
+            if base.get(metric) is None or value is None:
+                continue
+            if value > base[metric] * (1 + threshold) + MIN_DELTA:
+                regressions.append((path, metric, base[metric], value))
+    base = baseline.get("total", {}).get("throughput")
+    value = results["total"]["throughput"]
+    if base is not None and value < base / (1 + threshold):
+        regressions.append(("total", "throughput", base, value))
+    return regressions
+
+
+def report(results, out=sys.stdout):
+    """計測結果を表形式で表示する"""
+    out.write("%-14s%8s%8s" % ("", "count", "errors") +
+              "".join(["%12s" % m for m in ["p50", "p90", "p99", "cpu"]]) +
+              "\n")
+    for path in ENDPOINTS:
+        r = results[path]
+        out.write("%-14s%8d%8d" % (path, r["count"], r["errors"]))
+        for metric in ["p50", "p90", "p99", "cpu"]:
+            if r[metric] is None:
+                out.write("%12s" % "-")
+            else:
+                out.write("%10.1fms" % (r[metric] * 1000))
+        out.write("\n")
+    total = results["total"]
+    out.write("%d requests in %.2fs (%.1f req/s), %d errors, "
+              "%d memcache values rejected\n" % (
+                  total["requests"], total["wall"], total["throughput"],
+                  total["errors"], total["rejected"]))
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--users", type="int", default=8,
+                      help="number of concurrent users (default 8)")
+    parser.add_option("--sessions", type="int", default=3,
+                      help="upload-toggle-download sessions per user")
+    parser.add_option("--toggles", type="int", default=5,
+                      help="rule toggles per session")
+    parser.add_option("--windows", type="int", default=3,
+                      help="windowed lyric queries per session")
+    parser.add_option("--seed", type="int", default=0)
+    parser.add_option("--save", metavar="FILE",
+                      help="save results as a JSON baseline")
+    parser.add_option("--compare", metavar="FILE",
+                      help="compare results with a JSON baseline")
+    parser.add_option("--threshold", type="float", default=0.25,
+                      help="allowed regression ratio (default 0.25)")
+    options, args = parser.parse_args(argv)
+
+    results = run(options.users, options.sessions, options.toggles,
+                  options.windows, options.seed)
+    report(results)
+    status = 0
+    if results["total"]["errors"]:
+        print "ERRORS: %d requests failed" % results["total"]["errors"]
+        status = 1
+    if options.save:
+        json.dump(results, open(options.save, "w"), indent=2, sort_keys=True)
+    if options.compare:
+        baseline = json.load(open(options.compare))
+        regressions = compare(results, baseline, options.threshold)
+        for path, metric, base, value in regressions:
+            print "REGRESSION %s %s: %.4f -> %.4f" % (path, metric, base,
+                                                      value)
+        if regressions:
+            return 1
+    return status
+
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
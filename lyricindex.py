@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""VSQファイル群の歌詞のn-gram索引
+各トラックのAnoteList.lyricsの各位置から始まるn文字（末尾では残りの文字）を
+SQLiteに(ファイル, トラック, ノート番号)のポスティングとして保存する。
+歌詞のパターン（vsq_rulesのregexpと同じ正規表現）の検索では、
+パターンに必ず含まれる文字列で候補のトラックを絞り込んでから
+保存してある歌詞に正規表現を適用するので、VSQファイルをパースしない。
+ファイルの更新時刻とサイズを記録し、変わったファイルだけを索引し直す
+
+使い方:
+    python lyricindex.py index.db update corpus/*.vsq
+    python lyricindex.py index.db query "ずぃ"
+    python lyricindex.py index.db frequent 2
+
+Examples:
+    index = LyricIndex('index.db')
+    index.update(['a.vsq', 'b.vsq'])
+    index.query(u"ずぃ") => [{"path": "a.vsq", "track": 0,
+                              "start": 12, "end": 13, "text": u"ずぃ"}]
+    index.count(zuii_rule) => 1
+"""
+import os
+import re
+import sqlite3
+import sre_constants
+import sre_parse
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+
+#n-gramの文字数
+GRAM = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY, path TEXT UNIQUE, mtime REAL, size INTEGER);
+CREATE TABLE IF NOT EXISTS tracks (
+    file_id INTEGER, track INTEGER, lyrics TEXT, offsets BLOB,
+    PRIMARY KEY (file_id, track));
+CREATE TABLE IF NOT EXISTS grams (
+    gram TEXT, file_id INTEGER, track INTEGER, note INTEGER, pos INTEGER);
+CREATE INDEX IF NOT EXISTS grams_gram ON grams (gram);
+CREATE INDEX IF NOT EXISTS grams_file ON grams (file_id);
+"""
+
+
+class LyricIndex(object):
+    """歌詞のn-gram索引
+    Attributes:
+        path: 索引のデータベースのパス
+        db: sqlite3のコネクション
+    """
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def update(self, paths, prune=False):
+        """ファイルを索引に追加する
+        前回から更新時刻・サイズが変わっていないファイルは索引し直さない
+        Args:
+            paths: VSQファイルのパスのリスト
+            prune: Trueならpathsに含まれないファイルを索引から削除する
+
+        Returns:
+            {"added": 追加したファイル, "updated": 索引し直したファイル,
+             "unchanged": 変更のなかったファイル,
+             "removed": 削除したファイル,
+             "failed": パースできなかったファイル}（それぞれパスのリスト）
+        """
+        from vsq import VSQEditor
+        result = dict((key, []) for key in
+                      ['added', 'updated', 'unchanged', 'removed', 'failed'])
+        known = dict((row[0], row[1:]) for row in self.db.execute(
+            "SELECT path, id, mtime, size FROM files"))
+        for path in paths:
+            st = os.stat(path)
+            if path in known and known[path][1:] == (st.st_mtime, st.st_size):
+                result['unchanged'].append(path)
+                continue
+            try:
+                editor = VSQEditor(filename=path)
+            except Exception:
+                result['failed'].append(path)
+                continue
+            with self.db:
+                if path in known:
+                    self.__delete(known[path][0])
+                    result['updated'].append(path)
+                else:
+                    result['added'].append(path)
+                cur = self.db.execute(
+                    "INSERT INTO files (path, mtime, size) VALUES (?, ?, ?)",
+                    (path, st.st_mtime, st.st_size))
+                for n, track in enumerate(editor.normal_tracks):
+                    self.__add_track(cur.lastrowid, n, track.anotes)
+
+        if prune:
+            paths = set(paths)
+            with self.db:
+                for path, row in known.items():
+                    if not path in paths:
+                        self.__delete(row[0])
+                        result['removed'].append(path)
+        return result
+
+    def __add_track(self, file_id, n, anotes):
+        lyrics = anotes.lyrics
+        offsets = anotes.lyric_offsets()
+        self.db.execute("INSERT INTO tracks VALUES (?, ?, ?, ?)",
+                        (file_id, n, lyrics,
+                         buffer(array('i', offsets).tostring())))
+        #各位置から始まるn-gram（末尾は残りの文字）とその位置のノート
+        postings = []
+        note = 0
+        for pos in xrange(len(lyrics)):
+            while offsets[note + 1] <= pos:
+                note += 1
+            postings.append((lyrics[pos:pos + GRAM], file_id, n, note, pos))
+        self.db.executemany("INSERT INTO grams VALUES (?, ?, ?, ?, ?)",
+                            postings)
+
+    def __delete(self, file_id):
+        for table, key in [('grams', 'file_id'), ('tracks', 'file_id'),
+                           ('files', 'id')]:
+            self.db.execute("DELETE FROM %s WHERE %s = ?" % (table, key),
+                            (file_id,))
+
+    def query(self, pattern, limit=None):
+        """歌詞のパターンにマッチする箇所を検索する
+        Args:
+            pattern: 正規表現（文字列またはRuleインスタンス）
+            limit: 取得する件数の上限
+
+        Returns:
+            {"path": ファイルのパス, "track": トラック番号,
+             "start": マッチした最初の文字を含むノートの番号,
+             "end": マッチした最後の文字を含むノートの次の番号,
+             "text": マッチした文字列}のリスト
+            （ファイル、トラック、位置の順）
+        """
+        rxp = self.__compile(pattern)
+        found = []
+        for path, n, lyrics, offsets in self.__candidates(rxp):
+            for match in rxp.finditer(lyrics):
+                s, e = match.span()
+                if s == e:
+                    continue
+                found.append({"path": path, "track": n,
+                              "start": bisect_right(offsets, s) - 1,
+                              "end": bisect_left(offsets, e),
+                              "text": match.group()})
+                if limit and len(found) >= limit:
+                    return found
+        return found
+
+    def count(self, pattern):
+        """歌詞のパターンにマッチする箇所の数を数える
+        Args:
+            pattern: 正規表現（文字列またはRuleインスタンス）
+
+        Returns:
+            マッチした箇所の数
+        """
+        rxp = self.__compile(pattern)
+        return sum(sum(1 for match in rxp.finditer(lyrics)
+                       if match.end() > match.start())
+                   for path, n, lyrics, offsets in self.__candidates(rxp))
+
+    def frequent(self, length=GRAM, limit=50):
+        """よく現れるlength文字の並びを取得する
+        Args:
+            length: 文字数（GRAM以下）
+            limit: 取得する件数
+
+        Returns:
+            (文字列, 回数)のリスト（回数の多い順）
+        """
+        return self.db.execute(
+            "SELECT substr(gram, 1, ?) AS g, COUNT(*) AS c FROM grams "
+            "WHERE length(gram) >= ? GROUP BY g ORDER BY c DESC, g LIMIT ?",
+            (length, length, limit)).fetchall()
+
+    def __compile(self, pattern):
+        if hasattr(pattern, 'regexp'):
+            pattern = pattern.regexp
+        if isinstance(pattern, str):
+            pattern = pattern.decode('utf-8')
+        return re.compile(pattern)
+
+    def __candidates(self, rxp):
+        """パターンにマッチし得るトラックを取得する
+        Returns:
+            (パス, トラック番号, 歌詞, 各ノートの歌詞の開始位置)のリスト
+        """
+        literal = _required_literal(rxp.pattern)
+        join = ""
+        args = ()
+        if literal:
+            #最も出現の少ないn-gramを含むトラックに絞る
+            grams = [literal[i:i + GRAM]
+                     for i in range(max(1, len(literal) - GRAM + 1))]
+            counts = [(self.db.execute(
+                          "SELECT COUNT(*) FROM grams WHERE " +
+                          _gram_condition(gram), _gram_args(gram)
+                          ).fetchone()[0], gram) for gram in grams]
+            count, gram = min(counts)
+            if not count:
+                return []
+            join = ("JOIN (SELECT DISTINCT file_id, track FROM grams "
+                    "WHERE %s) g ON g.file_id = t.file_id "
+                    "AND g.track = t.track " % _gram_condition(gram))
+            args = _gram_args(gram)
+        rows = self.db.execute(
+            "SELECT f.path, t.track, t.lyrics, t.offsets FROM tracks t "
+            "JOIN files f ON f.id = t.file_id " + join +
+            "ORDER BY f.path, t.track", args)
+        return [(path, n, lyrics, array('i', str(offsets)))
+                for path, n, lyrics, offsets in rows]
+
+
+def _gram_condition(gram):
+    #n文字未満は前方一致（インデックスを使う範囲検索）
+    if len(gram) >= GRAM:
+        return "gram = ?"
+    return "gram >= ? AND gram < ?"
+
+
+def _gram_args(gram):
+    if len(gram) >= GRAM:
+        return (gram,)
+    return (gram, gram[:-1] + unichr(ord(gram[-1]) + 1))
+
+
+def _required_literal(pattern):
+    """正規表現にマッチする文字列に必ず含まれる、最も長い文字列を求める
+    Args:
+        pattern: 正規表現
+
+    Returns:
+        文字列（見つからなければ空文字列）
+    """
+    runs = [[]]
+
+    def walk(items):
+        for op, av in items:
+            if op == sre_constants.LITERAL:
+                runs[-1].append(unichr(av))
+            elif op == sre_constants.SUBPATTERN:
+                walk(av[-1])
+            else:
+                runs.append([])
+    try:
+        walk(sre_parse.parse(pattern))
+    except (sre_constants.error, ValueError):
+        return u''
+    return max([u''.join(run) for run in runs], key=len)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        sys.stderr.write("usage: python lyricindex.py index.db "
+                         "update FILE... | query PATTERN | frequent [N]\n")
+        sys.exit(2)
+    index = LyricIndex(sys.argv[1])
+    command = sys.argv[2]
+    if command == 'update':
+        result = index.update(sys.argv[3:])
+        for key in ['added', 'updated', 'unchanged', 'removed', 'failed']:
+            print "%s: %d" % (key, len(result[key]))
+    elif command == 'query':
+        for m in index.query(sys.argv[3].decode('utf-8')):
+            print "%s\t%d\t%d-%d\t%s" % (m['path'], m['track'], m['start'],
+                                         m['end'], m['text'].encode('utf-8'))
+    elif command == 'frequent':
+        length = int(sys.argv[3]) if len(sys.argv) > 3 else GRAM
+        for gram, count in index.frequent(length):
+            print "%s\t%d" % (gram.encode('utf-8'), count)
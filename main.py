@@ -8,6 +8,43 @@ from google.appengine.ext.webapp.util import run_wsgi_app
 from google.appengine.api import memcache
 import simplejson as json
 from vsq import *
+from parsecache import ParseCache
+
+#VSQ_STATS=1 のとき、各リクエストでの処理時間とカウンタを
+#X-VSQ-Statsヘッダとログに出力する
+STATS_ENABLED = os.environ.get('VSQ_STATS') == '1'
+
+#同じファイルが再アップロードされた場合はパース結果を再利用する
+#（VSQ_PARSE_CACHE_DIRを指定するとディスクにも保存する）
+VSQEditor.parse_cache = ParseCache(
+        directory=os.environ.get('VSQ_PARSE_CACHE_DIR'))
+
+def emit_stats(handler, editor):
+    """エディタに記録された処理時間とカウンタを出力して消去する
+    Args:
+        handler: リクエストハンドラ
+        editor: VSQEditorインスタンス
+    """
+    if not STATS_ENABLED or not editor.stats.enabled:
+        return
+    stats = json.dumps(editor.get_stats(), separators=(',', ':'),
+                       sort_keys=True)
+    handler.response.headers['X-VSQ-Stats'] = stats
+    logging.info('vsq stats %s: %s', handler.request.path, stats)
+    editor.stats.reset()
+
+def curve_update(points, s, e):
+    """時間範囲のカーブをJSONで返す形式にする
+    Args:
+        points: 時間範囲内のカーブの点のリスト
+        s: 時間範囲の始端
+        e: 時間範囲の終端
+
+    Returns:
+        {"s": s, "e": e, "points": [[時間, 値], ...]}
+    """
+    return {"s": s, "e": e,
+            "points": [[p['time'], p['value']] for p in points]}
 
 class MainPage(webapp.RequestHandler):
     def get(self):
@@ -22,10 +59,11 @@ class ParserPage(webapp.RequestHandler):
     def post(self):
         data = self.request.get('file')
         file_name = self.request.body_file.vars['file'].filename
-        editor = VSQEditor(binary = data)
+        editor = VSQEditor(binary = data, stats = STATS_ENABLED)
         rules = [zuii_rule, san_rule, port_rule, n_accent_rule]
 
         cand_ids = [c['id'] for c in editor.get_rule_cands(*rules)]
+        emit_stats(self, editor)
         memcache.set_multi(
                 {"editor": editor, "name": file_name},
                 key_prefix="vsq_",
@@ -44,17 +82,28 @@ class AppliedLyricJSON(webapp.RequestHandler):
         editor = memcache.get("vsq_editor")
         rules = [zuii_rule, san_rule, port_rule, n_accent_rule]
         candidates = editor.get_rule_cands(*rules)
+        cand_index = editor.index_cands(candidates)
+        cand_order = dict((c["id"], i) for i, c in enumerate(candidates))
+
+        #s, eが指定された場合はその時間窓にあるノートだけを返す
+        s = self.request.get('s')
+        e = self.request.get('e')
+        anotes = editor.anotes.filter(int(s) if s else None,
+                                      int(e) if e else None)
 
         anote_list = []
-        for a in editor.anotes:
+        for a in anotes:
+            cands = sorted(cand_index.query(a.start, a.end - 1),
+                           key=lambda c: cand_order[c["id"]])
             rules_for_json = [{"name": c["rule"]["name"], "id": c["id"]}
-                        for c in candidates if a in c["anotes"]]
+                        for c in cands if a in c["anotes"]]
             anote_for_json = {"lyric": a.lyric.encode('utf-8'),
                               "start_time": a.start,
                               "length": a.length,
                               "rules": rules_for_json}
             anote_list.append(anote_for_json)
 
+        emit_stats(self, editor)
         self.response.content_type = 'application/json'
         self.response.out.write(json.dumps(anote_list))
 
@@ -66,20 +115,29 @@ class AppliedVsqJSON(webapp.RequestHandler):
         cands = editor.get_rule_cands(*rules)
         select_ids = self.request.get_all("rule")
 
-        for c in cands:
-            if c['id'] in select_ids:
-                editor.apply_rule(c)
-            else:
-                editor.unapply_rule(c)
-
-        memcache.replace_multi(
-                { "editor": editor,"name": file_name },
-                time=3600,
-                key_prefix="vsq_"
-                )
+        #前回の選択との差分だけを適用・適用解除する
+        result = editor.select_cands(cands, select_ids)
+        if self.request.get('full'):
+            ranges = [(editor.start_time, editor.end_time)]
+            dyn_ranges = pit_ranges = ranges
+        else:
+            dyn_ranges = result['ranges']['DynamicsBPList']
+            pit_ranges = result['ranges']['PitchBendBPList']
+
+        #書き換えた時間範囲のカーブだけを返す
+        dyn_list = [curve_update(editor.get_dynamics_curve(s, e), s, e)
+                    for s, e in dyn_ranges]
+        pit_list = [curve_update(editor.get_pitch_curve(s, e), s, e)
+                    for s, e in pit_ranges]
+        emit_stats(self, editor)
+
+        if result['applied'] or result['unapplied']:
+            memcache.replace_multi(
+                    { "editor": editor,"name": file_name },
+                    time=3600,
+                    key_prefix="vsq_"
+                    )
 
-        dyn_list = [[p['time'],p['value']] for p in editor.get_dynamics_curve()]
-        pit_list = [[p['time'],p['value']] for p in editor.get_pitch_curve()]
         self.response.content_type = 'application/json'
         self.response.out.write(json.dumps({'dyn':dyn_list,'pit':pit_list}))
 
@@ -94,7 +152,9 @@ class DownloadPage(webapp.RequestHandler):
         else:
             self.response.headers['Content-Type'] = 'application/x-vsq; charset=Shift_JIS'
             self.response.headers['Content-disposition'] = 'filename=' + file_name.encode('utf-8')
-            self.response.out.write(editor.unparse())
+            binary = editor.unparse()
+            emit_stats(self, editor)
+            self.response.out.write(binary)
 
 application = webapp.WSGIApplication(
                                         [('/', MainPage),
@@ -15,14 +15,20 @@ class MasterTrack(object):
                   "type": 種類（SMFの企画に基づく）,
                   "data": メタイベントのコンテンツ部分]}
         name: トラックネーム（Master Trackで固定？）
-        tempo: トラックの始端時におけるBPM
+        tempo: トラックの始端時におけるテンポ（4分音符あたりのマイクロ秒）
+            アンパースの際は最初のテンポイベントにこの値を書き出す
         beat: トラックの始端時における拍・拍子を表すリスト
+            アンパースの際は最初の拍子イベントにこの値を書き出す
             [nn,dd,cc,bb]
             nn: 拍子記号の分子
             dd: 2のdd乗で表される分母
             cc: メトロノーム1カウントあたりのMIDIクロック数
             bb: 4分音符中の32分音符数
+        tempos: 全てのテンポイベントの(時間, テンポ)のリスト
+        beats: 全ての拍子イベントの(時間, [nn,dd,cc,bb])のリスト
     """
+    tempo = 500000
+    beat = (4, 2, 24, 8)
     def __init__(self, fp):
         self.parse(fp)
 
@@ -37,10 +43,14 @@ class MasterTrack(object):
             "MTrk": unpack(">4s", fp.read(4))[0],
             "size": unpack('>i', fp.read(4))[0],
             "metaevents": []}
+        self.tempos = []
+        self.beats = []
 
         #MIDIイベントの解析
+        time = 0
         while True:
             dtime = tools.get_dtime(fp)
+            time += dtime
             midi = unpack('3B', fp.read(3))
             mevent = {
                     'dtime': dtime,
@@ -52,30 +62,85 @@ class MasterTrack(object):
             if t == 0x2f:    # End of Trak
                 break
             elif t == 0x51:  # Tempo
-                self.tempo = unpack('>I', '\x00' + mevent['data'])[0]
+                tempo = unpack('>I', '\x00' + mevent['data'])[0]
+                self.tempos.append((time, tempo))
             elif t == 0x03:  # Track Name
                 self.name = mevent['data']
             elif t == 0x58:  # Beat
-                self.beat = unpack('4b', mevent['data'])
+                self.beats.append((time, unpack('4b', mevent['data'])))
+        if self.tempos:
+            self.tempo = self.tempos[0][1]
+        if self.beats:
+            self.beat = self.beats[0][1]
         self.data = data
 
+    def shifted(self, time_map):
+        """時間を挿入・削除したマスタートラックを作る（自身は変更しない）
+        同じ時間に移った同じ種類のイベント（削除された範囲のテンポ・拍子など）
+        は最後のものだけを残す
+        Args:
+            time_map: TimeMapインスタンス（timemap.pyを参照）
+
+        Returns:
+            MasterTrackインスタンス
+        """
+        events = []
+        index = {}
+        time = 0
+        for event in self.__metaevents():
+            time += event['dtime']
+            new_time = time_map.map(time)
+            key = (event['type'], new_time)
+            if key in index:
+                events[index[key]] = (new_time, event)
+            else:
+                index[key] = len(events)
+                events.append((new_time, event))
+
+        metaevents = []
+        prev = 0
+        for new_time, event in events:
+            metaevents.append(dict(event, dtime=new_time - prev))
+            prev = new_time
+        #サイズを計算し直してパースし直す（tempo, beat, tempos, beatsも
+        #求め直す）
+        binary = self.__unparse(metaevents)
+        binary = binary[:4] + pack('>I', len(binary) - 8) + binary[8:]
+        return MasterTrack(tools.FakeFile(binary))
+
+    def __metaevents(self):
+        #最初のテンポ・拍子イベントの内容をtempo, beatの値で置き換える
+        metaevents = []
+        replaced = set()
+        for event in self.data['metaevents']:
+            t = event['type']
+            if t in (0x51, 0x58) and not t in replaced:
+                replaced.add(t)
+                if t == 0x51:    # Tempo
+                    content = pack('>I', self.tempo)[1:]
+                else:            # Beat
+                    content = pack('4b', *self.beat)
+                event = dict(event, data=content)
+            metaevents.append(event)
+        return metaevents
+
     def unparse(self):
         """マスタートラックをアンパースする
         Returns:
             マスタートラックバイナリ
         """
-        data = self.data
-        binary = 'MTrk' + pack('>I', data['size'])
-        for event in data['metaevents']:
+        return self.__unparse(self.__metaevents())
+
+    def __unparse(self, metaevents):
+        binary = 'MTrk' + pack('>I', self.data['size'])
+        for event in metaevents:
             binary += tools.dtime2binary(event['dtime'])
             binary += pack('cBB', '\xff', event['type'], event['len'])
             t = event['type']
             if t == 0x2f:    # End of Track
                 pass
-            elif t == 0x51:  # Tempo
-                binary += pack('>I', self.tempo)[1:]
             elif t == 0x03:  # Track Name
                 binary += self.name
-            elif t == 0x58:  # Beat
-                binary += pack('4b', *self.beat)
+            else:            # Tempo, Beat
+                binary += event['data']
         return binary
@@ -1,12 +1,13 @@
 # -*- coding: utf-8 -*-
+import copy
 import tools
 import re
 from anote import *
 from singer import *
+from stats import NULL_STATS
 from struct import *
 
 
-
 class NormalTrack(object):
     """ノーマルトラック（マスタートラック以外）を扱うクラス
     Attributes:
@@ -15,14 +16,33 @@ class NormalTrack(object):
         singers: 歌手変更イベントのリスト
         phonetics: 各音符イベントの発音記号を連結したもの
         lyrics: 各音符イベントの歌詞を連結したもの
+        unapply_dict: ルール適用を戻すための情報（ルール適用候補IDがキー）
+        applied_ids: 適用中のルール適用候補IDの集合（frozenset。
+            書き換える際は新しいfrozensetに置き換える）
+    fork()で複製したトラックとはdata, anotes, unapply_dictを共有するので、
+    書き換える場合はwritable_curve, writable_note, writable_anotes,
+    writable_unapply_dictで取得したものを書き換える
+    insert_time, delete_timeによる時間のずれは、data, anotes, singersを
+    次に読むときに反映される
     """
-    def __init__(self, fp):
-        self.parse(fp)
+    applied_ids = frozenset()
+    #他のトラックと共有している属性の名前
+    _shared = frozenset()
+    #fork()後にこのトラックで複製したAnoteのid（Noneなら全て専有している）
+    _own_notes = None
+    #複製元のAnoteのidをキーとし、(複製元, 複製)を値とするディクショナリ
+    _note_map = {}
+    #まだ反映していない時間の挿入・削除（timemap.pyを参照）
+    _time_map = None
+
+    def __init__(self, fp, stats=NULL_STATS):
+        self.parse(fp, stats)
 
-    def parse(self, fp):
+    def parse(self, fp, stats=NULL_STATS):
         """vsqファイルのノーマルトラック部分をパースする
         Args:
             fp: vsqファイルポインタ or FakeFileインスタンス
+            stats: 処理時間とカウンタの記録先（stats.pyを参照）
         fpはノーマルトラックのところまでシークしておく必要がある
         """
         #トラックチャンクヘッダの解析
@@ -33,30 +53,275 @@ class NormalTrack(object):
             "cc_data": []}
 
         #MIDIイベントの解析
-        while True:
-            dtime = tools.get_dtime(fp)
-            mevent = unpack('3B', fp.read(3))
-            if mevent[1] == 0x2f:
-                data['eot'] = tools.dtime2binary(dtime) + '\xff\x2f\x00'
-                break
-            #Control Changeイベント
-            if mevent[0] == 0xb0:
-                data['cc_data'].append({'dtime': dtime, 'cc': mevent})
-            else:
-                #TrackNameイベント
-                if mevent[1] == 0x03:
-                    data['name'] = fp.read(mevent[2])
-                #Textイベント
-                elif mevent[1] == 0x01:
-                    fp.read(8)  # skip "DM:xxxx:"
-                    data['text'] += fp.read(mevent[2] - 8)
+        texts = []
+        with stats.timer('read_events'):
+            while True:
+                dtime = tools.get_dtime(fp)
+                mevent = unpack('3B', fp.read(3))
+                if mevent[1] == 0x2f:
+                    data['eot'] = tools.dtime2binary(dtime) + '\xff\x2f\x00'
+                    break
+                #Control Changeイベント
+                if mevent[0] == 0xb0:
+                    data['cc_data'].append({'dtime': dtime, 'cc': mevent})
+                else:
+                    #TrackNameイベント
+                    if mevent[1] == 0x03:
+                        data['name'] = fp.read(mevent[2])
+                    #Textイベント
+                    elif mevent[1] == 0x01:
+                        text = fp.read(mevent[2])
+                        # skip "DM:xxxx:"（10000番目以降は5桁になる）
+                        texts.append(text[text.index(':', 3) + 1:])
+            data['text'] = ''.join(texts)
+        stats.count('bytes_read', data['size'] + 8)
+        stats.count('text_bytes', len(data['text']))
+
+        with stats.timer('decode_text'):
+            data.update(self.__parse_text(data['text']))
+        stats.count('bp_points', sum([len(data[tag]) for tag in data
+                                      if re.compile('.+BPList').match(tag)]))
 
-        data.update(self.__parse_text(data['text']))
-        anotes, singers = self.__pack_events(data['Events'], data['Details'])
+        with stats.timer('pack_events'):
+            anotes, singers = self.__pack_events(data['Events'],
+                                                 data['Details'])
+        stats.count('notes_allocated', len(anotes))
 
         self.data = data
         self.anotes = anotes
         self.singers = singers
+        self.unapply_dict = {}
+
+    @property
+    def data(self):
+        if self._time_map is not None:
+            self.__apply_time_map()
+        return self.__dict__['data']
+
+    @data.setter
+    def data(self, data):
+        self.__dict__['data'] = data
+
+    @property
+    def anotes(self):
+        if self._time_map is not None:
+            self.__apply_time_map()
+        return self.__dict__['anotes']
+
+    @anotes.setter
+    def anotes(self, anotes):
+        self.__dict__['anotes'] = anotes
+
+    @property
+    def singers(self):
+        if self._time_map is not None:
+            self.__apply_time_map()
+        return self.__dict__['singers']
+
+    @singers.setter
+    def singers(self, singers):
+        self.__dict__['singers'] = singers
+
+    def insert_time(self, t, length):
+        """時間tに長さlengthの時間を挿入する（TimeMap.insertを参照）
+        ノートとカーブの点は読むときにずらすので、すぐには書き換えない
+        ルールを元に戻すための情報と適用中の候補IDは破棄する
+        """
+        self.__shift_time(lambda m: m.insert(t, length))
+
+    def delete_time(self, s, e):
+        """時間sからeまで（eを含まない）を削除する（TimeMap.deleteを参照）
+        範囲内で始まって範囲内で終わるノートは削除され、
+        範囲にかかるノートは短くなる
+        """
+        self.__shift_time(lambda m: m.delete(s, e))
+
+    def __shift_time(self, op):
+        from timemap import TimeMap
+        self._time_map = op(self._time_map or TimeMap())
+        self.unapply_dict = {}
+        self.applied_ids = frozenset()
+        self._shared = self._shared - set(['unapply_dict'])
+
+    def __apply_time_map(self):
+        #溜めておいた時間の挿入・削除をノート、歌手変更、カーブに反映する
+        from bplist import BPList
+        time_map = self._time_map
+        self._time_map = None
+        if time_map.is_identity():
+            return
+        state = self.__dict__
+        anotes = []
+        for anote in state['anotes']:
+            start = time_map.map(anote.start)
+            end = time_map.map_end(anote.end)
+            if end <= start:
+                continue
+            if start != anote.start or end != anote.end:
+                new = anote.copy()
+                new.start = start
+                new.length = end - start
+                if self._own_notes is not None:
+                    self._own_notes.add(id(new))
+                    self._note_map[id(anote)] = (anote, new)
+                anote = new
+            anotes.append(anote)
+        state['anotes'] = AnoteList()
+        list.extend(state['anotes'], anotes)
+        singers = []
+        for singer in state['singers']:
+            start = time_map.map(int(singer.start))
+            if start != int(singer.start):
+                singer = Singer(str(start), singer.params)
+            singers.append(singer)
+        state['singers'] = singers
+
+        data = copy.copy(state['data'])
+        for key, value in data.items():
+            if isinstance(value, BPList):
+                data[key] = BPList.from_arrays(
+                    *time_map.map_points(value.times, value.values))
+        data['EOS'] = str(time_map.map(int(data['EOS'])))
+        state['data'] = data
+        self._shared = self._shared - set(['data', 'anotes'])
+
+    def fork(self):
+        """データを共有したままトラックを複製する（コピーオンライト）
+        共有しているデータは、書き換える側のトラックが書き換える前に複製する
+        Returns:
+            NormalTrackインスタンス
+        """
+        track = NormalTrack.__new__(NormalTrack)
+        track.__dict__.update(self.__dict__)
+        for t in (self, track):
+            t._shared = frozenset(['data', 'anotes', 'unapply_dict'])
+            t._own_notes = set()
+            t._note_map = dict(self._note_map)
+        return track
+
+    def writable_curve(self, ptype):
+        """書き換えてよいパラメータカーブを取得する
+        Args:
+            ptype: カーブ名（"PitchBendBPList"など）
+
+        Returns:
+            BPListインスタンス
+        """
+        self.__own('data')
+        return self.data[ptype]
+
+    def writable_unapply_dict(self):
+        """書き換えてよいunapply_dictを取得する"""
+        self.__own('unapply_dict')
+        return self.unapply_dict
+
+    def writable_note(self, anote):
+        """書き換えてよいAnoteを取得する
+        他のトラックと共有しているAnoteは複製してanotesの中で置き換える
+        Args:
+            anote: anotesの中のAnote、またはfork()前にanotesにあったAnote
+
+        Returns:
+            Anoteインスタンス（このトラックのものでなければanoteをそのまま返す）
+        返したAnoteは書き換えられるので、anotesの時間範囲と音程差の索引を
+        破棄する（音高を書き換えた後のget_rule_candsやfind_contourは
+        作り直した索引を使う）
+        """
+        if self._own_notes is None:
+            self.anotes.reindex()
+            return anote
+        #複製済みのAnoteをたどる
+        while True:
+            entry = self._note_map.get(id(anote))
+            if entry is None or entry[0] is not anote:
+                break
+            anote = entry[1]
+        if id(anote) in self._own_notes:
+            self.anotes.reindex()
+            return anote
+        i = self.__note_index(anote)
+        if i is None:
+            return anote
+        #複製したAnoteで置き換えるので、専有したanotesの索引も破棄される
+        self.__own('anotes')
+        return self.__copy_note(i)
+
+    def writable_anotes(self):
+        """書き換えてよいanotesを取得する（全てのAnoteを専有する）
+        writable_noteと同じく、anotesの索引を破棄する
+        """
+        if self._own_notes is not None:
+            self.__own('anotes')
+            for i, anote in enumerate(self.anotes):
+                if not id(anote) in self._own_notes:
+                    self.__copy_note(i)
+        self.anotes.reindex()
+        return self.anotes
+
+    def splice_notes(self, s, e, anotes):
+        """sからeまで（eを含まない）に始まるノートをanotesで置き換える
+        一度の連結で新しいanotesを作るので、ノートごとに挿入位置を探さない。
+        sより前に始まってsにかかるノートはsで終わるように短くする
+        Args:
+            s: 開始時間
+            e: 終了時間
+            anotes: 置き換えるAnoteのリスト（時間順、このトラックのものになる）
+        """
+        current = self.anotes
+        i = _start_index(current, s)
+        j = _start_index(current, e)
+        new = AnoteList()
+        list.extend(new, list.__getslice__(current, 0, i))
+        list.extend(new, anotes)
+        list.extend(new, list.__getslice__(current, j, len(current)))
+        self.anotes = new
+        self._shared = self._shared - set(['anotes'])
+        if self._own_notes is not None:
+            self._own_notes.update(id(anote) for anote in anotes)
+        if i > 0 and new[i - 1].end > s:
+            prev = self.writable_note(new[i - 1])
+            prev.length = s - prev.start
+
+    def __own(self, name):
+        #共有している属性を複製して専有する
+        if not name in self._shared:
+            return
+        from bplist import BPList
+        if name == 'anotes':
+            value = AnoteList()
+            list.extend(value, self.anotes)
+        else:
+            value = copy.copy(getattr(self, name))
+        if name == 'data':
+            for key, bp in value.items():
+                if isinstance(bp, BPList):
+                    value[key] = bp.copy()
+        setattr(self, name, value)
+        self._shared = self._shared - set([name])
+
+    def __copy_note(self, i):
+        anote = self.anotes[i]
+        new = anote.copy()
+        self.anotes[i] = new
+        self._own_notes.add(id(new))
+        self._note_map[id(anote)] = (anote, new)
+        return new
+
+    def __note_index(self, anote):
+        #開始時間で二分探索し、同じ開始時間の中から探す
+        anotes = self.anotes
+        lo, hi = 0, len(anotes)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if anotes[mid].start < anote.start:
+                lo = mid + 1
+            else:
+                hi = mid
+        while lo < len(anotes) and anotes[lo].start == anote.start:
+            if anotes[lo] is anote:
+                return lo
+            lo += 1
+        return None
 
     def unparse(self):
         """ノーマルトラックをアンパースする
@@ -72,13 +337,7 @@ class NormalTrack(object):
         binary += pack('4B', 0x00, 0xff, 0x03, len(data['name'])) + data['name']
 
         # テキストデータの変換
-        text = self.__unparse_text()
-        #step = 119
-        step = 127 - len("DM:....:")
-        for i in range(0, len(text) - 1, step):
-            frame = min(step, len(text) - i)
-            binary += pack("4B", 0x00, 0xff, 0x01, frame + 8)
-            binary += "DM:%04d:" % (i / step) + text[i:i + frame]
+        binary += tools.text2events(self.__unparse_text())
 
         # コントロールチェンジイベントの変換
         for b in data['cc_data']:
@@ -123,10 +382,10 @@ class NormalTrack(object):
                 #各パラメータカーブタグ
                 elif re.compile('.+BPList').match(current_tag):
                     if not current_tag in data:
-                        data[current_tag] = []
+                        data[current_tag] = ([], [])
                     key, value = line.split('=')
-                    data[current_tag].append({'time': int(key),
-                                               'value': int(value)})
+                    data[current_tag][0].append(int(key))
+                    data[current_tag][1].append(int(value))
                 #ID#xxxxタグ
                 elif re.compile('ID#[0-9]{4}').match(current_tag):
                     key, value = line.split('=')
@@ -135,22 +394,27 @@ class NormalTrack(object):
                 elif re.compile('h#[0-9]{4}').match(current_tag):
                     if not current_tag in data['Details']:
                         data['Details'][current_tag] = {}
-                    lines = len(line.split(','))
+                    key, value = line.split('=', 1)
                     #ビブラート情報、歌手情報
-                    if lines == 1:
-                        key, value = line.split('=')
+                    #（ビブラートのDepthBPX等もカンマ区切りなのでキーで判断）
+                    if key != 'L0':
                         data['Details'][current_tag][key] = value
                     #歌詞情報
                     else:
-                        l0 = line.split('=')[1].split(',')
+                        l0 = value.split(',')
                         #lyricとprotectがあれば他は自動的に決まる？
                         data['Details'][current_tag] = {
                                 'lyric': unicode(l0[0][1:-1], "shift-jis"),
                                 'protect': unicode(l0[-1], "shift-jis")}
+        #各パラメータカーブをBPListに変換
+        from bplist import BPList
+        for tag in data.keys():
+            if re.compile('.+BPList').match(tag):
+                data[tag] = BPList.from_arrays(*data[tag])
         if not 'PitchBendBPList' in data:
-            data['PitchBendBPlist'] = {'time': 0, 'value': 0}
+            data['PitchBendBPList'] = BPList([{'time': 0, 'value': 0}])
         if not 'DynamicsBPList' in data:
-            data['DynamicsBPList'] = {'time': 0, 'value': 0}
+            data['DynamicsBPList'] = BPList([{'time': 0, 'value': 0}])
 
         data['EOS'] = data['Events'].pop('EOS')['time']
         return data
@@ -196,8 +460,9 @@ class NormalTrack(object):
         bptags = [tag for tag in data.keys() if bprxp.match(tag)]
         for tag in bptags:
             text += "[%s]\n" % tag
-            for item in data[tag]:
-                text += "%(time)d=%(value)d\n" % item
+            bp = data[tag]
+            text += ''.join(["%d=%d\n" % item
+                             for item in zip(bp.times, bp.values)])
 
         return text
 
@@ -218,6 +483,12 @@ class NormalTrack(object):
             if t == 'Anote':
                 lyric = details[e.pop('LyricHandle')]
                 vibrato = details.pop(e.pop('VibratoHandle', None), None)
+                if vibrato is not None:
+                    from vibratoinfo import Vibrato
+                    vibrato = Vibrato(vibrato)
+                #VibratoDelayはノートとビブラートの長さから求める
+                #（Anote.vibrato_delayを参照）ので、propには持たない
+                e.pop('VibratoDelay', None)
                 for key, value in e.items():
                     e[key] = int(value)
                 params = {
@@ -263,3 +534,15 @@ class NormalTrack(object):
                 details.append(p.singer_event)
             events.append(e)
         return events, details
+
+
+def _start_index(anotes, t):
+    #開始時間がt以上になる最初のノートの番号
+    lo, hi = 0, len(anotes)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if anotes[mid].start < t:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""VSQファイルのパース結果のキャッシュ
+入力バイナリのダイジェストをキーとして、パース結果をスナップショット
+（snapshot.pyを参照）として保持する。
+1段目はプロセス内のLRU（スナップショットの合計サイズで制限）、
+2段目はディレクトリ上のファイル（合計サイズで制限、古いものから削除）。
+取得するたびにスナップショットから復元するので、
+返されるVSQEditorは互いに独立している
+
+Examples:
+    VSQEditor.parse_cache = ParseCache(directory='/tmp/vsqcache')
+    editor = VSQEditor(binary=data)   # 2回目以降はキャッシュから復元される
+    VSQEditor.parse_cache.get_stats()
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+import snapshot
+
+
+class ParseCache(object):
+    """パース結果の2段のキャッシュ
+    Attributes:
+        max_bytes: メモリ上に保持するスナップショットの合計サイズの上限
+        directory: スナップショットを保存するディレクトリ（Noneなら使わない）
+        max_disk_bytes: ディレクトリに保存するスナップショットの合計サイズの上限
+        counters: ヒット・ミス・削除の回数などのディクショナリ
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024, directory=None,
+            max_disk_bytes=1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(
+            ['memory_hits', 'disk_hits', 'misses', 'puts',
+             'memory_evictions', 'disk_evictions'], 0)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def digest(binary):
+        """入力バイナリのキーを求める
+        スナップショットの形式が変われば別のキーになる
+        """
+        return "%s-%d" % (hashlib.sha1(binary).hexdigest(), snapshot.VERSION)
+
+    def get(self, binary):
+        """入力バイナリのパース結果を取得する
+        Args:
+            binary: VSQファイルのバイナリ
+
+        Returns:
+            VSQEditorインスタンス（キャッシュになければNone）
+        """
+        key = self.digest(binary)
+        with self._lock:
+            blob = self._memory.pop(key, None)
+            if blob is not None:
+                self._memory[key] = blob
+                self.counters['memory_hits'] += 1
+        if blob is None:
+            blob = self.__read(key)
+            if blob is None:
+                self.__count('misses')
+                return None
+            self.__count('disk_hits')
+            self.__remember(key, blob)
+        return snapshot.loads(blob)
+
+    def put(self, binary, editor):
+        """パース結果をキャッシュする
+        Args:
+            binary: VSQファイルのバイナリ
+            editor: binaryをパースしたVSQEditorインスタンス
+        """
+        key = self.digest(binary)
+        blob = snapshot.dumps(editor)
+        self.__count('puts')
+        self.__remember(key, blob)
+        self.__write(key, blob)
+
+    def clear(self):
+        """メモリ上とディレクトリのキャッシュを全て削除する"""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            for name, size, mtime in self.__disk_entries():
+                self.__remove(name)
+            self._disk_bytes = 0
+
+    def get_stats(self):
+        """キャッシュの統計を取得する
+        Returns:
+            countersに、メモリ上・ディレクトリの件数と合計サイズを加えた
+            ディクショナリ
+        """
+        with self._lock:
+            stats = dict(self.counters)
+            stats['memory_entries'] = len(self._memory)
+            stats['memory_bytes'] = self._memory_bytes
+        if self.directory:
+            entries = self.__disk_entries()
+            stats['disk_entries'] = len(entries)
+            stats['disk_bytes'] = sum(size for name, size, mtime in entries)
+        return stats
+
+    def __count(self, name):
+        #ロックを取っていないところでカウンタを増やす
+        with self._lock:
+            self.counters[name] += 1
+
+    def __remember(self, key, blob):
+        #メモリ上に保持し、上限を超えた分を古いものから捨てる
+        if len(blob) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_bytes -= len(old)
+            self._memory[key] = blob
+            self._memory_bytes += len(blob)
+            while self._memory_bytes > self.max_bytes:
+                key, old = self._memory.popitem(last=False)
+                self._memory_bytes -= len(old)
+                self.counters['memory_evictions'] += 1
+
+    def __path(self, key):
+        return os.path.join(self.directory, key + '.snap')
+
+    def __read(self, key):
+        if not self.directory:
+            return None
+        try:
+            f = open(self.__path(key), 'rb')
+        except IOError:
+            return None
+        try:
+            blob = f.read()
+        finally:
+            f.close()
+        #最近使ったものとして更新時刻を更新する
+        try:
+            os.utime(self.__path(key), None)
+        except OSError:
+            pass
+        return blob
+
+    def __write(self, key, blob):
+        if not self.directory or len(blob) > self.max_disk_bytes:
+            return
+        path = self.__path(key)
+        if os.path.exists(path):
+            return
+        #書き込み途中のファイルを読まないように、一時ファイルから移動する
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            os.write(fd, blob)
+        finally:
+            os.close(fd)
+        os.rename(tmp, path)
+
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for name, size, mtime
+                                       in self.__disk_entries())
+            else:
+                self._disk_bytes += len(blob)
+            if self._disk_bytes > self.max_disk_bytes:
+                self.__evict_disk()
+
+    def __evict_disk(self):
+        #更新時刻の古いものから、上限に収まるまで削除する
+        #（self._lockを取ってから呼ぶ）
+        entries = sorted(self.__disk_entries(), key=lambda x: x[2])
+        total = sum(size for name, size, mtime in entries)
+        for name, size, mtime in entries:
+            if total <= self.max_disk_bytes:
+                break
+            if self.__remove(name):
+                total -= size
+                self.counters['disk_evictions'] += 1
+        self._disk_bytes = total
+
+    def __disk_entries(self):
+        #(ファイル名, サイズ, 更新時刻)のリスト
+        if not self.directory:
+            return []
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.snap'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((name, st.st_size, st.st_mtime))
+        return entries
+
+    def __remove(self, name):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            return False
+        return True
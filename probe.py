@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""VSQファイルのメタ情報だけを読むモジュール
+ライブラリの一覧表示のように、トラック名・テンポ・拍子・プリメジャー・
+ノート数・長さ・歌手だけが必要な場合に、VSQEditorでパースせずに読む。
+ヘッダとマスタートラックを読み、ノーマルトラックはチャンクのサイズで
+区切りをたどる。各トラックのテキストは[Common], [Master], [EventList],
+[ID#xxxx]（Type, Length, IconHandleだけ）と歌手のh#xxxxまで読んで止め、
+歌詞の詳細やパラメータカーブは読まない
+
+ディレクトリはスレッドプールでまとめて読み、ProbeCacheを渡すと
+更新時刻とサイズが変わっていないファイルは読み直さない
+
+使い方:
+    python probe.py library/                      # 一覧を表示
+    python probe.py --cache probe.cache library/  # キャッシュを使う
+
+Examples:
+    info = probe('test.vsq')
+    info['tempo'] => 120.0
+    info['tracks'][0]['name'] => u'Voice1'
+    cache = ProbeCache('probe.cache')
+    infos = probe_dir('library/', cache=cache)
+    cache.save()
+"""
+import cPickle as pickle
+import os
+import re
+import struct
+import sys
+from header import Header
+from mastertrack import MasterTrack
+from tempomap import TempoMap
+
+bprxp = re.compile('.+BPList')
+idrxp = re.compile('ID#[0-9]{4}')
+hrxp = re.compile('h#[0-9]{4}')
+
+#probe_dirで読むファイルの拡張子
+EXTENSIONS = ('.vsq',)
+#読めないファイルで起こる例外
+PROBE_ERRORS = (IOError, OSError, EOFError, struct.error, ValueError,
+                KeyError, IndexError)
+
+
+def probe(path, cache=None):
+    """VSQファイルのメタ情報を読む
+    Args:
+        path: VSQファイルのパス
+        cache: ProbeCacheインスタンス（Noneなら使わない）
+
+    Returns:
+        {"path": パス, "size": ファイルサイズ, "mtime": 更新時刻,
+         "time_div": 4分音符分のデルタタイム,
+         "tempo": 始端のテンポ（BPM）, "beat": 始端の拍子 [分子, 分母],
+         "pre_measure": プリメジャーの小節数,
+         "start_time": シーケンスの始端時間, "end_time": 終端時間,
+         "duration": 始端から終端までの秒数,
+         "notes": 全トラックのノート数, "singer": 最初の歌手（IDS）,
+         "tracks": [{"name": トラック名, "notes": ノート数,
+                     "singers": 歌手（IDS）のリスト,
+                     "end_time": 最後のノートの終端時間}, ...]}
+        キャッシュから返したディクショナリは変更しないこと
+    """
+    st = os.stat(path)
+    if cache is not None:
+        info = cache.get(path, st)
+        if info is not None:
+            return info
+    fp = open(path, 'rb')
+    try:
+        info = _probe(fp)
+    finally:
+        fp.close()
+    info['path'] = path
+    info['size'] = st.st_size
+    info['mtime'] = st.st_mtime
+    if cache is not None:
+        cache.put(path, st, info)
+    return info
+
+
+def probe_dir(directory, cache=None, threads=8):
+    """ディレクトリ以下のVSQファイルのメタ情報をスレッドプールで読む
+    読めなかったファイルは{"path": パス, "error": メッセージ}になる
+    Args:
+        directory: ディレクトリのパス（サブディレクトリも読む）
+        cache: ProbeCacheインスタンス（Noneなら使わない）
+        threads: スレッドの数
+
+    Returns:
+        probeの結果のリスト（パス順）
+    """
+    from multiprocessing.pool import ThreadPool
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        paths += [os.path.join(root, name) for name in sorted(files)
+                  if os.path.splitext(name)[1].lower() in EXTENSIONS]
+    if not paths:
+        return []
+
+    def safe_probe(path):
+        try:
+            return probe(path, cache)
+        except PROBE_ERRORS, e:
+            return {'path': path, 'error': str(e) or e.__class__.__name__}
+
+    pool = ThreadPool(max(1, min(threads, len(paths))))
+    try:
+        return pool.map(safe_probe, paths)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class ProbeCache(object):
+    """probeの結果のキャッシュ
+    パスをキーとし、更新時刻とサイズが同じ間は結果を再利用する。
+    filenameを指定すると、生成時に読み込み、save()で保存する
+    Attributes:
+        filename: 保存先のパス（Noneなら保存しない）
+        counters: ヒット・ミスの回数のディクショナリ
+    """
+    def __init__(self, filename=None):
+        import threading
+        self.filename = filename
+        self.counters = {'hits': 0, 'misses': 0}
+        self._entries = {}
+        self._lock = threading.Lock()
+        if filename and os.path.exists(filename):
+            try:
+                self._entries = pickle.load(open(filename, 'rb'))
+            except (EOFError, pickle.UnpicklingError):
+                self._entries = {}
+
+    @staticmethod
+    def __key(path, st):
+        return os.path.abspath(path), (st.st_mtime, st.st_size)
+
+    def get(self, path, st):
+        """キャッシュした結果を取得する
+        Args:
+            path: ファイルのパス
+            st: os.statの結果
+
+        Returns:
+            probeの結果（なければ、またはファイルが変わっていればNone）
+        """
+        key, version = self.__key(path, st)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.counters['hits'] += 1
+                return entry[1]
+            self.counters['misses'] += 1
+        return None
+
+    def put(self, path, st, info):
+        """結果をキャッシュする"""
+        key, version = self.__key(path, st)
+        with self._lock:
+            self._entries[key] = (version, info)
+
+    def save(self):
+        """filenameに保存する（書き込み途中のファイルを読まないように、
+        一時ファイルから移動する）
+        """
+        import tempfile
+        if not self.filename:
+            return
+        with self._lock:
+            blob = pickle.dumps(self._entries, pickle.HIGHEST_PROTOCOL)
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            os.write(fd, blob)
+        finally:
+            os.close(fd)
+        os.rename(tmp, self.filename)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _probe(fp):
+    from vsqstream import TrackReader
+    header = Header(fp)
+    master_track = MasterTrack(fp)
+    time_div = header.data['time_div']
+    tracks = []
+    pre_measure = None
+    for i in range(header.data['track_num'] - 1):
+        reader = TrackReader(fp)
+        track, master = _scan_track(reader)
+        reader.skip()
+        tracks.append(track)
+        if pre_measure is None and 'PreMeasure' in master:
+            pre_measure = int(master['PreMeasure'])
+
+    tempo_map = TempoMap.from_master_track(master_track, time_div)
+    start_time = tempo_map.bar_to_tick(pre_measure or 0)
+    ends = [t['end_time'] for t in tracks if t['end_time'] is not None]
+    end_time = max([start_time] + ends)
+    singers = [s for t in tracks[:1] for s in t['singers']]
+    nn, dd = tempo_map.beats[0]
+    return {'time_div': time_div,
+            'tempo': 60000000.0 / tempo_map.tempos[0],
+            'beat': [nn, 2 ** dd],
+            'pre_measure': pre_measure,
+            'start_time': start_time,
+            'end_time': end_time,
+            'duration': (tempo_map.tick_to_seconds(end_time) -
+                         tempo_map.tick_to_seconds(start_time)),
+            'notes': sum(t['notes'] for t in tracks),
+            'singer': singers[0] if singers else None,
+            'tracks': tracks}
+
+
+def _scan_track(reader):
+    """トラックのテキストを必要なところまで読む
+    Returns:
+        (トラックの情報, [Master]の項目のディクショナリ)
+    """
+    common = {}
+    master = {}
+    times = {}
+    scan = {'notes': 0,
+            'last': None,     # 開始時間が最後のノートの(開始時間, 長さ)
+            'singers': [],    # IDS（歌手のh#を読むまではハンドル名）
+            'pending': {}}    # 歌手のハンドル名 → singersの番号
+    tag = None
+    event = None
+    for line in reader.lines():
+        if line.startswith('['):
+            if event is not None:
+                _add_event(scan, event, times.get(tag))
+            tag = line[1:-1]
+            event = {} if idrxp.match(tag) else None
+            #歌手のh#を全て読んだか、パラメータカーブに来たら止める
+            if bprxp.match(tag) or (hrxp.match(tag) and not scan['pending']):
+                break
+            continue
+        key, value = line.split('=', 1)
+        if tag == 'Common':
+            common[key] = value
+        elif tag == 'Master':
+            master[key] = value
+        elif tag == 'EventList':
+            times[value] = int(key)
+        elif event is not None:
+            event[key] = value
+        elif tag in scan['pending'] and key == 'IDS':
+            scan['singers'][scan['pending'].pop(tag)] = \
+                value.decode('shift-jis', 'replace')
+    else:
+        if event is not None:
+            _add_event(scan, event, times.get(tag))
+
+    name = common.get('Name', reader.name)
+    last = scan['last']
+    track = {'name': name.decode('shift-jis', 'replace'),
+             'notes': scan['notes'],
+             'singers': [s for s in scan['singers']
+                         if isinstance(s, unicode)],
+             'end_time': last[0] + last[1] if last else None}
+    return track, master
+
+
+def _add_event(scan, event, time):
+    #読み終えたID#xxxxを、ノートか歌手かで振り分ける
+    t = event.get('Type')
+    if t == 'Anote':
+        scan['notes'] += 1
+        last = scan['last']
+        if time is not None and (last is None or time >= last[0]):
+            scan['last'] = (time, int(event.get('Length', 0)))
+    elif t == 'Singer' and 'IconHandle' in event:
+        scan['pending'][event['IconHandle']] = len(scan['singers'])
+        scan['singers'].append(event['IconHandle'])
+
+
+def main(argv):
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [options] directory")
+    parser.add_option("--cache", metavar="FILE",
+                      help="reuse results while mtime and size are unchanged")
+    parser.add_option("--threads", type="int", default=8)
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("directory is required")
+    cache = ProbeCache(options.cache) if options.cache else None
+    for info in probe_dir(args[0], cache, options.threads):
+        if 'error' in info:
+            print "%s: ERROR %s" % (info['path'], info['error'])
+            continue
+        line = u"%s: %.1fBPM %d/%d %dnotes %.1fs %s [%s]" % (
+            info['path'], info['tempo'], info['beat'][0], info['beat'][1],
+            info['notes'], info['duration'], info['singer'],
+            u", ".join(t['name'] for t in info['tracks']))
+        print line.encode('utf-8')
+    if cache is not None:
+        cache.save()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""実際に歌われる音高とダイナミクスを一定間隔の配列として求めるモジュール
+音高はノートの音高、ピッチベンド（PIT×PBS）、ビブラートを合成した
+絶対音高（セント, ノート番号×100）として求める
+
+Examples:
+    editor = VSQEditor('test.vsq')
+    result = render(editor, track=0, rate=200)
+    result['pitch'] => ノートのない時間はnanになる
+"""
+import math
+import numpy
+import tools
+from vibratoinfo import Vibrato
+
+#既定のサンプリングレート（1秒あたりの点数）
+DEFAULT_RATE = 200.0
+#カーブに点がない場合の値
+DEFAULT_PIT = 0
+DEFAULT_PBS = 2
+DEFAULT_DYN = 64
+
+#ビブラート波形のキャッシュ（ファイル間で共有する）
+_vibrato_cache = tools.LRUCache(1024)
+
+
+def render(editor, track=None, s=None, e=None, rate=DEFAULT_RATE):
+    """トラックの音高とダイナミクスを一定間隔で求める
+    Args:
+        editor: VSQEditorインスタンス
+        track: トラック番号（省略時は操作対象トラック）
+        s: 開始時間（省略時はシーケンスの始端時間）
+        e: 終了時間（省略時はシーケンスの終端時間）
+        rate: 1秒あたりの点数
+
+    Returns:
+        {"seconds": 各点の時刻（秒）,
+         "tick": 各点の時間（小数を含む）,
+         "pitch": 各点の絶対音高（セント）, ノートのない点はnan,
+         "dynamics": 各点のダイナミクス}
+        値は全てnumpy配列
+    """
+    if track is None:
+        normal_track = editor.current_track
+    else:
+        normal_track = editor.normal_tracks[track]
+    tempo_map = editor.tempo_map
+    s = editor.start_time if s is None else s
+    e = editor.end_time if e is None else e
+
+    #時間軸（秒で等間隔）
+    s_sec = tempo_map.tick_to_seconds(s)
+    e_sec = tempo_map.tick_to_seconds(e)
+    count = max(0, int(math.floor((e_sec - s_sec) * rate)) + 1)
+    seconds = s_sec + numpy.arange(count) / float(rate)
+    ticks = tempo_map.seconds_to_ticks(seconds)
+
+    data = normal_track.data
+    pit = sample_curve(data.get('PitchBendBPList'), ticks, DEFAULT_PIT)
+    pbs = sample_curve(data.get('PitchBendSensBPList'), ticks, DEFAULT_PBS)
+    dyn = sample_curve(data.get('DynamicsBPList'), ticks, DEFAULT_DYN)
+
+    #ノートの音高
+    anotes = normal_track.anotes
+    starts = numpy.array([a.start for a in anotes], dtype=numpy.float64)
+    ends = numpy.array([a.end for a in anotes], dtype=numpy.float64)
+    notes = numpy.array([a.note for a in anotes], dtype=numpy.float64)
+    pitch = numpy.empty(count)
+    pitch.fill(numpy.nan)
+    if len(anotes):
+        i = numpy.searchsorted(starts, ticks, side='right') - 1
+        valid = i >= 0
+        i = numpy.maximum(i, 0)
+        valid &= ticks < ends[i]
+        pitch[valid] = notes[i[valid]] * 100.0
+
+    #ピッチベンド（PITはPBS半音を±8192とする）
+    pitch += pit * pbs * 100.0 / 8192.0
+
+    #ビブラート（開始位置を最も近い点に揃えて波形を加算する）
+    for anote in (anotes.filter(s, e) if len(anotes) else []):
+        if not anote.vibrato:
+            continue
+        vs, ve = vibrato_range(anote)
+        vs_sec = tempo_map.tick_to_seconds(vs)
+        ve_sec = tempo_map.tick_to_seconds(ve)
+        length = int(round((ve_sec - vs_sec) * rate))
+        offset = int(round((vs_sec - s_sec) * rate))
+        if length <= 0 or offset + length <= 0 or offset >= count:
+            continue
+        wave = vibrato_wave(anote.vibrato, length, rate)
+        lo = max(0, offset)
+        hi = min(count, offset + length)
+        pitch[lo:hi] += wave[lo - offset:hi - offset]
+
+    return {"seconds": seconds, "tick": ticks,
+            "pitch": pitch, "dynamics": dyn}
+
+
+def sample_curve(bp, ticks, default):
+    """パラメータカーブの各時間での値を求める
+    Args:
+        bp: BPListインスタンス（Noneなら全てdefault）
+        ticks: 時間のnumpy配列
+        default: 最初の点より前の値
+
+    Returns:
+        値のnumpy配列
+    """
+    values = numpy.empty(len(ticks))
+    values.fill(default)
+    if not bp:
+        return values
+    times = numpy.frombuffer(bp.times, dtype=numpy.int32)
+    bp_values = numpy.frombuffer(bp.values, dtype=numpy.int32)
+    i = numpy.searchsorted(times, ticks, side='right') - 1
+    valid = i >= 0
+    values[valid] = bp_values[i[valid]]
+    return values
+
+
+def vibrato_range(anote):
+    """ノートのビブラートの時間範囲を取得する
+    （ノートの終端からビブラートの長さだけ前から、ノートの終端まで）
+    Args:
+        anote: Anoteインスタンス
+
+    Returns:
+        (開始時間, 終了時間)
+    """
+    return anote.start + anote.vibrato_delay, anote.end
+
+
+def vibrato_wave(vibrato, length, rate=DEFAULT_RATE):
+    """ビブラートの音高の変化（セント）を求める
+    同じ形・長さの波形はキャッシュされる
+    Args:
+        vibrato: Anote.vibratoのディクショナリ
+        length: 点数
+        rate: 1秒あたりの点数
+
+    Returns:
+        音高の変化のnumpy配列（変更しないこと）
+    """
+    key = (vibrato.get('StartDepth'), vibrato.get('DepthBPX'),
+           vibrato.get('DepthBPY'), vibrato.get('StartRate'),
+           vibrato.get('RateBPX'), vibrato.get('RateBPY'), length, rate)
+    wave = _vibrato_cache.get(key)
+    if wave is None:
+        x = numpy.arange(length) / float(length)
+        depth = _vibrato_curve(vibrato, 'Depth', x)
+        speed = _vibrato_curve(vibrato, 'Rate', x)
+        #周期（秒）と振幅（セント）はCadenciiの換算式による
+        period = numpy.exp(5.24 - 1.07e-2 * speed) * 2.0 / 1000.0
+        phase = numpy.cumsum(2 * math.pi / (period * rate))
+        phase -= phase[0]
+        wave = depth * 125.0 / 127.0 * numpy.sin(phase)
+        wave.flags.writeable = False
+        _vibrato_cache.set(key, wave)
+    return wave
+
+
+def _vibrato_curve(vibrato, kind, x):
+    #StartXxxとXxxBPX, XxxBPYから、ビブラート内の位置xでの値を求める
+    values = numpy.empty(len(x))
+    values.fill(float(vibrato.get('Start' + kind, 0)))
+    if not isinstance(vibrato, Vibrato):
+        vibrato = Vibrato(vibrato)
+    bpx, bpy = vibrato.curve(kind)
+    if len(bpx):
+        bpx = numpy.frombuffer(bpx.tostring(), dtype=numpy.float64)
+        bpy = numpy.array(bpy, dtype=numpy.float64)
+        i = numpy.searchsorted(bpx, x, side='right') - 1
+        valid = i >= 0
+        values[valid] = bpy[i[valid]]
+    return values
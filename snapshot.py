@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""パース済みのVSQEditorをバイナリのスナップショットとして保存・復元するモジュール
+テキストの解析をせずに復元できるので、パースよりも速く読み込める。
+復元したVSQEditorのunparse()は、保存元のunparse()と同じバイナリになる
+
+フォーマット:
+    MAGIC（8byte）
+    メタ情報のサイズ（>I）
+    メタ情報（marshal）: ヘッダ、マスタートラックのバイナリ、
+        トラックごとの[Common][Master][Mixer]、ノートのプロパティ、
+        ビブラート、歌手変更イベント、適用中のルール適用候補ID、
+        各カラムの位置
+    カラム（arrayのバイナリを8byte境界に揃えて並べたもの）:
+        パラメータカーブの時間と値、コントロールチェンジイベント、
+        ノート表の各列、文字列表
+ディクショナリは順序を保ったまま復元する（通常のディクショナリで順序が
+変わってしまう場合はOrderedDictにする）。
+パース途中のデータ（text, Events, Details）は保存しない
+
+Examples:
+    binary = dumps(editor)
+    editor = loads(binary)
+    editor = load('test.snap')   # mmapで読み込む
+"""
+import marshal
+import mmap
+import sys
+import tools
+from array import array
+from collections import OrderedDict
+from struct import pack, unpack
+from anote import Anote, AnoteList
+from vibratoinfo import Vibrato
+from header import Header
+from mastertrack import MasterTrack
+from normaltrack import NormalTrack
+from singer import Singer
+from bplist import BPList
+from tempomap import TempoMap
+
+MAGIC = 'VSQSNAP1'
+VERSION = 1
+#スナップショットに保存しないトラックデータ（パース途中のデータ）
+SKIP_KEYS = ('text', 'Events', 'Details')
+#順序を保って保存するトラックデータ
+ORDERED_KEYS = ('Common', 'Master', 'Mixer')
+#ノート表の列
+NOTE_COLUMNS = ('start', 'length', 'note', 'dynamics', 'lyric', 'phonetic',
+                'prolong', 'prop', 'vibrato')
+
+
+class _Writer(object):
+    """カラムと文字列表を書き出すためのクラス"""
+    def __init__(self):
+        self.columns = []
+        self.chunks = []
+        self.size = 0
+        self.strings = {}
+        self.string_list = []
+
+    def column(self, typecode, values):
+        #arrayをカラムとして追加し、カラム番号を返す
+        if not isinstance(values, array) or values.typecode != typecode:
+            values = array(typecode, values)
+        raw = values.tostring()
+        self.columns.append((self.size, typecode, len(values)))
+        self.chunks.append(raw + '\x00' * (-len(raw) % 8))
+        self.size += len(raw) + (-len(raw) % 8)
+        return len(self.columns) - 1
+
+    def intern(self, string):
+        #文字列を文字列表に追加し、文字列番号を返す
+        if not string in self.strings:
+            self.strings[string] = len(self.string_list)
+            self.string_list.append(string)
+        return self.strings[string]
+
+    def string_table(self):
+        blobs = [s.encode('utf-8') for s in self.string_list]
+        offsets = [0]
+        for blob in blobs:
+            offsets.append(offsets[-1] + len(blob))
+        return (self.column('B', array('B', ''.join(blobs))),
+                self.column('I', offsets))
+
+
+class _Reader(object):
+    """カラムと文字列表を読み込むためのクラス"""
+    def __init__(self, buf, base, columns):
+        self.buf = buf
+        self.base = base
+        self.columns = columns
+
+    def column(self, i):
+        offset, typecode, count = self.columns[i]
+        values = array(typecode)
+        start = self.base + offset
+        values.fromstring(self.buf[start:start + count * values.itemsize])
+        return values
+
+    def string_table(self, blob_i, offsets_i):
+        offset = self.columns[blob_i][0] + self.base
+        blob = self.buf[offset:offset + self.columns[blob_i][2]]
+        offsets = self.column(offsets_i)
+        return [blob[offsets[i]:offsets[i + 1]].decode('utf-8')
+                for i in xrange(len(offsets) - 1)]
+
+
+def dumps(editor):
+    """VSQEditorをスナップショットのバイナリにする
+    Args:
+        editor: VSQEditorインスタンス
+
+    Returns:
+        スナップショットのバイナリ
+    """
+    writer = _Writer()
+    tracks = [_dump_track(writer, track) for track in editor.normal_tracks]
+    strings = writer.string_table()
+    meta = {
+        'version': VERSION,
+        'byteorder': sys.byteorder,
+        'header': editor.header.data,
+        'master_track': editor.master_track.unparse(),
+        'start_time': editor.start_time,
+        'end_time': editor.end_time,
+        'current': editor.normal_tracks.index(editor.current_track),
+        'tracks': tracks,
+        'strings': strings,
+        'columns': writer.columns}
+    meta = marshal.dumps(meta)
+    return MAGIC + pack('>I', len(meta)) + meta + ''.join(writer.chunks)
+
+
+def loads(buf):
+    """スナップショットのバイナリからVSQEditorを復元する
+    Args:
+        buf: スナップショットのバイナリ（文字列またはmmap）
+
+    Returns:
+        VSQEditorインスタンス
+    スナップショットでなければValueErrorを送出する
+    """
+    from vsq import VSQEditor
+    if buf[:len(MAGIC)] != MAGIC:
+        raise ValueError("not a VSQ snapshot")
+    size = unpack('>I', buf[len(MAGIC):len(MAGIC) + 4])[0]
+    base = len(MAGIC) + 4 + size
+    meta = marshal.loads(buf[len(MAGIC) + 4:base])
+    if meta['version'] != VERSION or meta['byteorder'] != sys.byteorder:
+        raise ValueError("incompatible VSQ snapshot")
+    reader = _Reader(buf, base, meta['columns'])
+    strings = reader.string_table(*meta['strings'])
+
+    editor = VSQEditor()
+    editor._fp = None
+    editor.header = Header.__new__(Header)
+    editor.header.data = meta['header']
+    editor.master_track = MasterTrack(tools.FakeFile(meta['master_track']))
+    editor.normal_tracks = [_load_track(reader, strings, track)
+                            for track in meta['tracks']]
+    editor.tempo_map = TempoMap.from_master_track(
+        editor.master_track, editor.header.data['time_div'])
+    editor.start_time = meta['start_time']
+    editor.end_time = meta['end_time']
+    editor.select_track(meta['current'])
+    return editor
+
+
+def save(editor, filename):
+    """VSQEditorのスナップショットをファイルに書き込む
+    Args:
+        editor: VSQEditorインスタンス
+        filename: 書き込むファイルのパス
+    """
+    f = open(filename, 'wb')
+    try:
+        f.write(dumps(editor))
+    finally:
+        f.close()
+
+
+def load(filename):
+    """スナップショットのファイルをmmapで読み込み、VSQEditorを復元する
+    Args:
+        filename: スナップショットのファイルのパス
+
+    Returns:
+        VSQEditorインスタンス
+    """
+    f = open(filename, 'rb')
+    try:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return loads(buf)
+        finally:
+            buf.close()
+    finally:
+        f.close()
+
+
+def _dump_track(writer, track):
+    data = []
+    for key, value in track.data.items():
+        if key in SKIP_KEYS:
+            continue
+        elif isinstance(value, BPList):
+            value = ('bplist', writer.column('i', value.times),
+                     writer.column('i', value.values))
+        elif key in ORDERED_KEYS:
+            value = ('ordered', value.items())
+        elif key == 'cc_data':
+            cc = array('B')
+            for b in value:
+                cc.extend(b['cc'])
+            value = ('cc', writer.column('i', [b['dtime'] for b in value]),
+                     writer.column('B', cc))
+        else:
+            value = ('raw', value)
+        data.append((key, value))
+
+    #ノート表（プロパティは同じ内容のものを1つにまとめる）
+    props = {}
+    prop_list = []
+    vibratos = []
+    columns = dict((name, []) for name in NOTE_COLUMNS)
+    for a in track.anotes:
+        prop = tuple(a.prop.items())
+        if not prop in props:
+            props[prop] = len(prop_list)
+            prop_list.append(prop)
+        if a.vibrato:
+            columns['vibrato'].append(len(vibratos))
+            vibratos.append(a.vibrato.items())
+        else:
+            columns['vibrato'].append(-1)
+        columns['start'].append(a.start)
+        columns['length'].append(a.length)
+        columns['note'].append(a.note)
+        columns['dynamics'].append(a.dynamics)
+        columns['lyric'].append(writer.intern(a.lyric))
+        columns['phonetic'].append(writer.intern(a.phonetic))
+        columns['prolong'].append(a.is_prolong)
+        columns['prop'].append(props[prop])
+    notes = dict((name, writer.column('b' if name == 'prolong' else 'i',
+                                      columns[name]))
+                 for name in NOTE_COLUMNS)
+
+    #ルール適用を戻すための情報のノートはノート表の位置で保存する
+    positions = dict((id(a), i) for i, a in enumerate(track.anotes))
+    unapply = {}
+    for key, rule_i in track.unapply_dict.items():
+        rule_i = dict(rule_i)
+        rule_i['anotes'] = [positions[id(a)] for a in rule_i['anotes']
+                            if id(a) in positions]
+        unapply[key] = rule_i
+
+    return {'data': data,
+            'notes': notes,
+            'count': len(track.anotes),
+            'props': prop_list,
+            'vibratos': vibratos,
+            'singers': [(s.start, s.params.items()) for s in track.singers],
+            'unapply': unapply,
+            'applied': sorted(track.applied_ids)}
+
+
+def _load_track(reader, strings, meta):
+    track = NormalTrack.__new__(NormalTrack)
+    data = OrderedDict()
+    for key, value in meta['data']:
+        if value[0] == 'bplist':
+            bp = BPList()
+            bp.times = reader.column(value[1])
+            bp.values = reader.column(value[2])
+            data[key] = bp
+        elif value[0] == 'ordered':
+            data[key] = _dict_factory(value[1])()
+        elif value[0] == 'cc':
+            dtimes = reader.column(value[1])
+            cc = reader.column(value[2])
+            data[key] = [{'dtime': dtimes[i], 'cc': tuple(cc[3 * i:3 * i + 3])}
+                         for i in xrange(len(dtimes))]
+        else:
+            data[key] = value[1]
+
+    #ノート表からAnoteを作る（時間順に保存されているので並べ替えない）
+    columns = dict((name, reader.column(i))
+                   for name, i in meta['notes'].items())
+    props = [_dict_factory(pairs) for pairs in meta['props']]
+    vibratos = meta['vibratos']
+    anotes = AnoteList()
+    notes = []
+    new = Anote.__new__
+    for i in xrange(meta['count']):
+        a = new(Anote)
+        start = columns['start'][i]
+        length = columns['length'][i]
+        vibrato = columns['vibrato'][i]
+        a.__dict__ = {
+            '_start': start,
+            '_length': length,
+            '_end': start + length,
+            'note': columns['note'][i],
+            'dynamics': columns['dynamics'][i],
+            '_lyric': strings[columns['lyric'][i]],
+            '_phonetic': strings[columns['phonetic'][i]],
+            '_is_prolong': bool(columns['prolong'][i]),
+            'prop': props[columns['prop'][i]](),
+            'vibrato': Vibrato(vibratos[vibrato]) if vibrato >= 0 else None}
+        notes.append(a)
+    list.extend(anotes, notes)
+
+    unapply_dict = {}
+    for key, rule_i in meta['unapply'].items():
+        rule_i['anotes'] = AnoteList()
+        list.extend(rule_i['anotes'], [notes[i] for i in rule_i['anotes']])
+        unapply_dict[key] = rule_i
+
+    track.data = data
+    track.anotes = anotes
+    track.singers = [Singer(start, _dict_factory(params)())
+                     for start, params in meta['singers']]
+    track.unapply_dict = unapply_dict
+    track.applied_ids = frozenset(meta.get('applied', ()))
+    return track
+
+
+def _dict_factory(pairs):
+    """pairsの順序を保ったディクショナリを作る関数を取得する
+    同じ順序で挿入したディクショナリは同じ順序になるので、
+    一度作ってみて順序が保たれれば通常のディクショナリを、
+    保たれなければOrderedDictを作る関数を返す
+    """
+    if dict(pairs).keys() == [key for key, value in pairs]:
+        return lambda: dict(pairs)
+    return lambda: OrderedDict(pairs)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+import time
+
+
+class Stats(object):
+    """処理ごとの時間とカウンタを記録するクラス
+    Attributes:
+        timers: 処理名をキーとし、
+            {"wall": 経過時間（秒）, "cpu": CPU時間（秒）, "calls": 回数}
+            を値とするディクショナリ
+        counters: カウンタ名をキーとし、値を値とするディクショナリ
+        tracks: トラック番号をキーとし、トラックごとのStatsを値とする
+            ディクショナリ（per_trackがTrueのときのみ）
+        callback: 時間を記録するたびに callback(処理名, 経過時間, CPU時間)
+            として呼ばれる関数
+
+    Examples:
+        stats = Stats()
+        with stats.timer("parse"):
+            ...
+        stats.count("regex_matches", 3)
+        stats.as_dict() => {"timers": {"parse": {...}},
+                            "counters": {"regex_matches": 3}}
+    """
+    enabled = True
+
+    def __init__(self, per_track=False, callback=None, parent=None):
+        self.per_track = per_track
+        self.callback = callback
+        self.parent = parent
+        self.reset()
+
+    def reset(self):
+        """記録を消去する"""
+        self.timers = {}
+        self.counters = {}
+        self.tracks = {}
+
+    def track(self, n):
+        """トラックごとの記録先を取得する
+        記録は全体の記録にも加算される
+        Args:
+            n: トラック番号
+
+        Returns:
+            Statsインスタンス（per_trackがFalseの場合は自身）
+        """
+        if not self.per_track:
+            return self
+        if not n in self.tracks:
+            self.tracks[n] = Stats(parent=self)
+        return self.tracks[n]
+
+    def timer(self, phase):
+        """withブロックの時間を計測するオブジェクトを取得する
+        Args:
+            phase: 処理名
+        """
+        return _Timer(self, phase)
+
+    def add_time(self, phase, wall, cpu):
+        """処理時間を記録する
+        Args:
+            phase: 処理名
+            wall: 経過時間（秒）
+            cpu: CPU時間（秒）
+        """
+        if not phase in self.timers:
+            self.timers[phase] = {"wall": 0.0, "cpu": 0.0, "calls": 0}
+        timer = self.timers[phase]
+        timer["wall"] += wall
+        timer["cpu"] += cpu
+        timer["calls"] += 1
+        if self.parent is not None:
+            self.parent.add_time(phase, wall, cpu)
+        elif self.callback is not None:
+            self.callback(phase, wall, cpu)
+
+    def count(self, name, n=1):
+        """カウンタを加算する
+        Args:
+            name: カウンタ名
+            n: 加算する値
+        """
+        self.counters[name] = self.counters.get(name, 0) + n
+        if self.parent is not None:
+            self.parent.count(name, n)
+
+    def as_dict(self):
+        """記録をディクショナリとして取得する
+        Returns:
+            {"timers": timers, "counters": counters,
+             "tracks": {トラック番号: {"timers": ..., "counters": ...}}}
+        """
+        result = {"timers": dict((k, dict(v))
+                                 for k, v in self.timers.items()),
+                  "counters": dict(self.counters)}
+        if self.tracks:
+            result["tracks"] = dict((n, t.as_dict())
+                                    for n, t in self.tracks.items())
+        return result
+
+    def __getstate__(self):
+        #callbackは関数なのでpickleしない
+        state = self.__dict__.copy()
+        state['callback'] = None
+        return state
+
+
+class NullStats(object):
+    """記録しない場合に使うStatsの代わりのクラス
+    全ての操作は何もしない
+    """
+    enabled = False
+    per_track = False
+    callback = None
+
+    def reset(self):
+        pass
+
+    def track(self, n):
+        return self
+
+    def timer(self, phase):
+        return _NULL_TIMER
+
+    def add_time(self, phase, wall, cpu):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def as_dict(self):
+        return {}
+
+
+class _Timer(object):
+    def __init__(self, stats, phase):
+        self.stats = stats
+        self.phase = phase
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.cpu = time.clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.add_time(self.phase,
+                            time.time() - self.wall,
+                            time.clock() - self.cpu)
+        return False
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+NULL_STATS = NullStats()
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+from array import array
+from bisect import bisect_right
+
+#SMFでテンポイベントがない場合のテンポ（120BPM）と拍子（4/4）
+DEFAULT_TEMPO = 500000
+DEFAULT_BEAT = (4, 2)
+
+
+class TempoMap(object):
+    """テンポと拍子の変化を扱うクラス
+    時間（tick）と秒、小節・拍の相互変換を行う。
+    各変換は変化点の二分探索により O(log n) で行われ、
+    ticks_to_seconds, seconds_to_ticks は配列をまとめて変換する
+
+    Attributes:
+        time_div: 4分音符あたりのtick数
+        tempo_ticks: 各テンポの開始時間（array）
+        tempos: 各テンポ（4分音符あたりのマイクロ秒, array）
+        tempo_seconds: 各テンポの開始時間（秒, array）
+        beat_ticks: 各拍子の開始時間（array）
+        beat_bars: 各拍子の開始小節（0始まり, array）
+        beats: 各拍子の(分子, 分母の2の対数)のリスト
+
+    Examples:
+        tempo_map = TempoMap(480, [(0, 500000), (1920, 250000)])
+        tempo_map.tick_to_seconds(2400) => 2.25
+        tempo_map.seconds_to_tick(2.25) => 2400.0
+        tempo_map.tick_to_bar(2400) => (1, 1, 0)
+        tempo_map.bar_to_tick(4) => 7680
+    """
+    def __init__(self, time_div, tempos=None, beats=None):
+        """コンストラクタ
+        Args:
+            time_div: 4分音符あたりのtick数
+            tempos: (時間, 4分音符あたりのマイクロ秒)のリスト
+            beats: (時間, [nn,dd,...])のリスト
+        時間0にテンポ・拍子がなければ既定値（120BPM, 4/4拍子）を補う
+        """
+        self.time_div = time_div
+        tempos = self.__normalize(tempos, DEFAULT_TEMPO)
+        beats = self.__normalize([(t, tuple(b[:2])) for t, b in beats or []],
+                                 DEFAULT_BEAT)
+
+        self.tempo_ticks = array('l', [t for t, tempo in tempos])
+        self.tempos = array('l', [tempo for t, tempo in tempos])
+        self.tempo_seconds = array('d', [0.0])
+        for i in xrange(1, len(tempos)):
+            self.tempo_seconds.append(self.tempo_seconds[i - 1] +
+                self.__tick_seconds(i - 1) * (tempos[i][0] - tempos[i - 1][0]))
+
+        #拍子の途中で次の拍子に変わる場合は、その小節を1小節と数える
+        self.beat_ticks = array('l', [t for t, beat in beats])
+        self.beats = [beat for t, beat in beats]
+        self.beat_bars = array('l', [0])
+        for i in xrange(1, len(beats)):
+            bar_len = self.bar_length(i - 1)
+            ticks = beats[i][0] - beats[i - 1][0]
+            self.beat_bars.append(self.beat_bars[i - 1] +
+                                  (ticks + bar_len - 1) / bar_len)
+
+    @classmethod
+    def from_master_track(cls, master_track, time_div):
+        """マスタートラックのテンポ・拍子イベントからTempoMapを作る
+        Args:
+            master_track: MasterTrackインスタンス
+            time_div: 4分音符あたりのtick数
+
+        Returns:
+            TempoMapインスタンス
+        """
+        return cls(time_div, master_track.tempos, master_track.beats)
+
+    def __normalize(self, events, default):
+        #時間順に並べ、同じ時間のイベントは後のものを採用する
+        events = sorted(events or [], key=lambda x: x[0])
+        result = []
+        for t, value in events:
+            if result and result[-1][0] == t:
+                result[-1] = (t, value)
+            else:
+                result.append((t, value))
+        if not result or result[0][0] > 0:
+            result.insert(0, (0, default))
+        return result
+
+    def __tick_seconds(self, i):
+        #i番目のテンポでの1tickあたりの秒数
+        return self.tempos[i] / (1000000.0 * self.time_div)
+
+    def tick_to_seconds(self, tick):
+        """時間（tick）を秒に変換する
+        Args:
+            tick: 時間
+
+        Returns:
+            秒
+        """
+        i = max(0, bisect_right(self.tempo_ticks, tick) - 1)
+        return (self.tempo_seconds[i] +
+                (tick - self.tempo_ticks[i]) * self.__tick_seconds(i))
+
+    def seconds_to_tick(self, seconds):
+        """秒を時間（tick）に変換する
+        Args:
+            seconds: 秒
+
+        Returns:
+            時間（小数を含む）
+        """
+        i = max(0, bisect_right(self.tempo_seconds, seconds) - 1)
+        return (self.tempo_ticks[i] +
+                (seconds - self.tempo_seconds[i]) / self.__tick_seconds(i))
+
+    def ticks_to_seconds(self, ticks):
+        """時間（tick）の配列をまとめて秒に変換する
+        numpyがあればnumpyで変換する
+        Args:
+            ticks: 時間のリスト、arrayまたはnumpy配列
+
+        Returns:
+            秒のnumpy配列（numpyがなければリスト）
+        """
+        np = _numpy()
+        if np is None:
+            return [self.tick_to_seconds(t) for t in ticks]
+        ticks = np.asarray(ticks, dtype=np.float64)
+        starts = np.frombuffer(self.tempo_ticks, dtype=np.int_)
+        i = np.maximum(np.searchsorted(starts, ticks, side='right') - 1, 0)
+        rates = (np.frombuffer(self.tempos, dtype=np.int_) /
+                 (1000000.0 * self.time_div))
+        seconds = np.frombuffer(self.tempo_seconds, dtype=np.float64)
+        return seconds[i] + (ticks - starts[i]) * rates[i]
+
+    def seconds_to_ticks(self, seconds):
+        """秒の配列をまとめて時間（tick）に変換する
+        numpyがあればnumpyで変換する
+        Args:
+            seconds: 秒のリスト、arrayまたはnumpy配列
+
+        Returns:
+            時間（小数を含む）のnumpy配列（numpyがなければリスト）
+        """
+        np = _numpy()
+        if np is None:
+            return [self.seconds_to_tick(s) for s in seconds]
+        seconds = np.asarray(seconds, dtype=np.float64)
+        starts = np.frombuffer(self.tempo_seconds, dtype=np.float64)
+        i = np.maximum(np.searchsorted(starts, seconds, side='right') - 1, 0)
+        rates = (np.frombuffer(self.tempos, dtype=np.int_) /
+                 (1000000.0 * self.time_div))
+        ticks = np.frombuffer(self.tempo_ticks, dtype=np.int_)
+        return ticks[i] + (seconds - starts[i]) / rates[i]
+
+    def tempo_at(self, tick):
+        """時間tickでのテンポを取得する
+        Args:
+            tick: 時間
+
+        Returns:
+            4分音符あたりのマイクロ秒
+        """
+        return self.tempos[max(0, bisect_right(self.tempo_ticks, tick) - 1)]
+
+    def beat_at(self, tick):
+        """時間tickでの拍子を取得する
+        Args:
+            tick: 時間
+
+        Returns:
+            (分子, 分母の2の対数)
+        """
+        return self.beats[max(0, bisect_right(self.beat_ticks, tick) - 1)]
+
+    def beat_length(self, i):
+        """i番目の拍子での1拍のtick数"""
+        return self.time_div * 4 / 2 ** self.beats[i][1]
+
+    def bar_length(self, i):
+        """i番目の拍子での1小節のtick数"""
+        return self.beats[i][0] * self.beat_length(i)
+
+    def tick_to_bar(self, tick):
+        """時間（tick）を小節・拍に変換する
+        Args:
+            tick: 時間
+
+        Returns:
+            (小節（0始まり）, 拍（0始まり）, 拍の頭からのtick数)
+        """
+        i = max(0, bisect_right(self.beat_ticks, tick) - 1)
+        bars, rest = divmod(tick - self.beat_ticks[i], self.bar_length(i))
+        beat, offset = divmod(rest, self.beat_length(i))
+        return self.beat_bars[i] + bars, beat, offset
+
+    def bar_to_tick(self, bar, beat=0, offset=0):
+        """小節・拍を時間（tick）に変換する
+        Args:
+            bar: 小節（0始まり）
+            beat: 拍（0始まり）
+            offset: 拍の頭からのtick数
+
+        Returns:
+            時間
+        """
+        i = max(0, bisect_right(self.beat_bars, bar) - 1)
+        return (self.beat_ticks[i] + (bar - self.beat_bars[i]) *
+                self.bar_length(i) + beat * self.beat_length(i) + offset)
+
+
+def _numpy():
+    #numpyは必要になったときに読み込む（なければNone）
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
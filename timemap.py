@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""時間の挿入・削除による、元の時間から現在の時間への対応
+VSQEditor.insert_time, delete_timeは各トラックのTimeMapを置き換えるだけで、
+ノートやカーブの点の時間はトラックのdata, anotesを次に読むときに
+（unparseを含む）まとめて書き換える。挿入・削除の手間は
+溜まっている挿入・削除の数に比例し、ノートや点の数には比例しない
+
+Examples:
+    m = TimeMap().insert(1920, 480).delete(0, 240)
+    m.map(0) => 0          # 削除された範囲は削除した時間に縮む
+    m.map(1920) => 2160
+    m.map_points([0, 100, 2000], [1, 2, 3])
+    => (array('i', [0, 2240]), array('i', [2, 3]))
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+class TimeMap(object):
+    """挿入・削除した時間の対応（元の時間 → 現在の時間）
+    元の時間軸を区間に分け、区間ごとのずれと削除されたかどうかを持つ。
+    insert, deleteは自身を変更せず、新しいTimeMapを返す
+    （fork()したトラック同士で共有できる）
+    Attributes:
+        cuts: 各区間の開始時間（元の時間、昇順）
+        deltas: 各区間のずれ（現在の時間 - 元の時間）
+            削除された区間では、区間の開始時間を削除した時間に移すずれ
+        deleted: 各区間が削除されたかどうか
+    """
+    def __init__(self):
+        self.cuts = [0]
+        self.deltas = [0]
+        self.deleted = [False]
+
+    def __copy(self):
+        m = TimeMap.__new__(TimeMap)
+        m.cuts = list(self.cuts)
+        m.deltas = list(self.deltas)
+        m.deleted = list(self.deleted)
+        return m
+
+    def is_identity(self):
+        """時間が変わらないかどうか"""
+        return not any(self.deltas) and not any(self.deleted)
+
+    def insert(self, t, length):
+        """現在の時間tに長さlengthの時間を挿入する
+        t以降の時間はlengthだけ後ろにずれる
+        Returns:
+            TimeMapインスタンス
+        """
+        m = self.__copy()
+        j = m.__split(t)
+        for i in xrange(j, len(m.cuts)):
+            m.deltas[i] += length
+        return m
+
+    def delete(self, s, e):
+        """現在の時間sからeまで（eを含まない）を削除する
+        範囲内の時間はsに縮み、e以降の時間はe-sだけ前にずれる
+        Returns:
+            TimeMapインスタンス
+        """
+        m = self.__copy()
+        j = m.__split(s)
+        k = m.__split(e)
+        for i in xrange(j, k):
+            m.deleted[i] = True
+            m.deltas[i] = s - m.cuts[i]
+        for i in xrange(k, len(m.cuts)):
+            m.deltas[i] -= e - s
+        return m
+
+    def __split(self, t):
+        """現在の時間tで区間を分け、現在の開始時間がt以上になる
+        最初の区間の番号を返す
+        """
+        starts = [c + d for c, d in zip(self.cuts, self.deltas)]
+        j = bisect_left(starts, t)
+        i = j - 1
+        if i >= 0 and not self.deleted[i]:
+            end = (self.cuts[j] + self.deltas[i]
+                   if j < len(self.cuts) else None)
+            if end is None or t < end:
+                self.cuts.insert(j, t - self.deltas[i])
+                self.deltas.insert(j, self.deltas[i])
+                self.deleted.insert(j, False)
+        return j
+
+    def map(self, x):
+        """元の時間xの現在の時間を求める（削除された時間は削除した時間）"""
+        i = max(0, bisect_right(self.cuts, x) - 1)
+        if self.deleted[i]:
+            return self.cuts[i] + self.deltas[i]
+        return x + self.deltas[i]
+
+    def map_end(self, x):
+        """元の終端時間x（xを含まない）の現在の終端時間を求める
+        tに挿入した場合、tで終わるノートは伸びない
+        """
+        i = max(0, bisect_right(self.cuts, x - 1) - 1)
+        if self.deleted[i]:
+            return self.cuts[i] + self.deltas[i]
+        return x + self.deltas[i]
+
+    def map_points(self, times, values):
+        """カーブの点の時間を書き換える
+        削除された範囲の点は、最後の点（範囲の後に続く値）だけを
+        削除した時間に移す
+        Args:
+            times: 各点の時間（元の時間、昇順）
+            values: 各点の値
+
+        Returns:
+            (時間のarray, 値のarray)
+        """
+        out_t = array('i')
+        out_v = array('i')
+        collapsed = False
+        n = len(self.cuts)
+        for i in xrange(n):
+            lo = bisect_left(times, self.cuts[i])
+            hi = (bisect_left(times, self.cuts[i + 1], lo)
+                  if i + 1 < n else len(times))
+            if hi <= lo:
+                continue
+            d = self.deltas[i]
+            if self.deleted[i]:
+                t = self.cuts[i] + d
+                if collapsed and out_t[-1] == t:
+                    out_t.pop()
+                    out_v.pop()
+                out_t.append(t)
+                out_v.append(values[hi - 1])
+                collapsed = True
+                continue
+            if collapsed and out_t[-1] == times[lo] + d:
+                out_t.pop()
+                out_v.pop()
+            collapsed = False
+            if d:
+                out_t.extend(t + d for t in times[lo:hi])
+            else:
+                out_t.extend(times[lo:hi])
+            out_v.extend(values[lo:hi])
+        return out_t, out_v
@@ -66,89 +66,129 @@ def dtime2binary(dtime):
     return binary
 
 
-#歌詞=>発音記号の変換テーブル
-phonetic_table = {
-        u"あ": u"a", u"い": u"i", u"う": u"M", u"え": u"e", u"お": u"o",
-        u"か": u"k a", u"き": u"k i", u"く": u"k M", u"け": u"k e", u"こ": "k o",
-        u"さ": u"s a", u"し": u"S i", u"す": u"s M", u"せ": u"s e", u"そ": "s o",
-        u"た": u"t a", u"ち": u"tS i", u"つ": u"ts M", u"て": u"t e", u"と": "t o",
-        u"な": u"n a", u"に": u"J i", u"ぬ": u"n M", u"ね": u"n e", u"の": u"n o",
-        u"は": u"h a", u"ひ": u"C i", u"ふ": u"p\ M", u"へ": u"h e", u"ほ": u"h o",
-        u"ま": u"m a", u"み": u"m' i", u"む": u"m M", u"め": u"m e", u"も": u"m o",
-        u"や": u"j a", u"ゆ": u"j M", u"いぇ": u"j e", u"よ": u"j o",
-        u"ら": u"4 a", u"り": u"4' i", u"る": u"4 M", u"れ": u"4 e", u"ろ": u"4 o",
-        u"わ": u"w a", u"うぃ": u"w i", u"うぇ": u"w e", u"を": u"w o",
-        u"ぁ": u"h\ a", u"ぃ": u"h\ i", u"ぅ": u"h\ M", u"ぇ": u"h\ e", u"ぉ": u"h\ o",
-        u"きゃ": u"k' a", u"きゅ": u"k' M", u"きょ": u"k' o",
-        u"しゃ": u"S a", u"すぃ": u"s i", u"しゅ": u"S M", u"しぇ": u"S e", u"しょ": u"S o",
-        u"ちゃ": u"tS a", u"つぃ": u"ts i", u"ちゅ": u"tS M", u"ちぇ": u"tS e", u"ちょ": u"tS o",
-        u"にゃ": u"J a", u"にゅ": u"J M", u"にぇ": u"J e", u"にょ": u"J o",
-        u"ひゃ": u"C a", u"ひゅ": u"C M", u"ひぇ": u"C e", u"ひょ": u"C o",
-        u"ふぁ": u"p\ a", u"ふぃ": u"p\' M", u"ふゅ": u"p\' M", u"ふぇ": u"p\ e", u"ふぉ": u"p\ o",
-        u"みゃ": u"m' a", u"みゅ": u"m' M", u"みぇ": u"m' e", u"みょ": u"m' o",
-        u"りゃ": u"4' a", u"りゅ": u"4' M", u"りょ": u"4' o",
-        u"が": u"g a", u"ぎ": u"g' i", u"ぐ": u"g M", u"げ": u"g e", u"ご": u"g o",
-        u"ざ": u"dZ a", u"じ": u"dZ i", u"ず": u"dz M", u"ぜ": u"dz e", u"ぞ": u"dz o",
-        u"だ": u"d a", u"ぢ": u"d i", u"づ": u"d M", u"で": u"d e", u"ど": u"d o",
-        u"ば": u"b a", u"び": u"b' i", u"ぶ": u"b M", u"べ": u"b e", u"ぼ": u"b o",
-        u"ぱ": u"p a", u"ぴ": u"p' i", u"ぷ": u"p M", u"ぺ": u"p e", u"ぽ": u"p o",
-        u"ん": u"n",
-        u"ぎゃ": u"g' a", u"ぎゅ": u"g' M", u"ぎょ": u"g' o",
-        u"じゃ": u"dZ a", u"ずぃ": u"dz i", u"じゅ": u"dZ M", u"じぇ": u"dZ e", u"じょ": "dZ o",
-        u"でぃ": u"d' i", u"でゅ": u"d' M",
-        u"びゃ": u"b' a", u"びゅ": u"b' M", u"びぇ": u"b' e", u"びょ": u"b' o",
-        u"ぴゃ": u"p' a", u"ぴゅ": u"p' M", u"ぴぇ": u"p' e", u"ぴょ": u"p' o",
-
-        u"てゃ": u"t' a", u"てぃ": u"t' i", u"てゅ": u"t' M", u"てぇ": u"t' e", u"てょ": u"t' o"
-    }
-
-#発音記号=>歌詞（ひらがな）の変換テーブル
-lyric_table = dict(zip(phonetic_table.values(), phonetic_table.keys()))
-
-
-#ローマ字の歌詞が入力されたとき用に更新
-phonetic_table.update({
-    u"a": u"a", u"i": u"i", u"u": u"M", u"e": u"e", u"o": u"o",  # あ行
-    u"ka": u"k a", u"ca": u"k a", u"ki": u"k i", u"ku": u"k M", u"cu": u"k M", u"qu": u"k M", u"ke": u"k e", u"ko": u"k o", u"co": "k o",  # か行
-    u"sa": u"s a", u"si": u"s i", u"shi": u"s i", u"ci": u"s i", u"su": u"s M", u"se": u"s e", u"ce": u"s e", u"so": u"s o",  # さ行
-    u"ta": u"t a", u"ti": u"tS i", u"tu": u"ts M", u"te": u"t e", u"to": u"t o",  # た行
-    u"na": u"n a", u"ni": u"J i", u"nu": u"n M", u"ne": u"n e", u"no": u"n o",  # な行
-    u"ha": u"h a", u"hi": u"C i", u"hu": u"p\ M", u"he": u"h e", u"ho": "h o",  # は行
-    u"ma": u"m a", u"mi": u"m' i", u"mu": u"m M", u"me": u"m e", u"mo": u"m o",   # ま行
-    u"ya": u"j a", u"yu": u"j M", u"ye": u"j e", u"yo": u"j o",  # や行
-    u"ra": u"4 a", u"ri": u"4' i", u"ru": u"4 M", u"re": u"4 e", u"ro": u"4 o",  # ら行
-    u"wa": u"w a", u"wi": u"w i", u"we": u"w e", u"wo": u"w o",  # わ行
-    u"la": "h\ a", u"li": u"h\ i", u"lu": u"h\ M", u"le": u"h\ e", u"lo": u"h\ o", # ぁぃぅぇぉ(la...)
-    u"xa": u"h\ a", u"xi": u"h\ i", u"xu": u"h\ M", u"xe": u"h\ e", u"xo": u"h\ o",  # ぁぃぅぇぉ(xa...)
-    u"kya": u"k' a", u"kyu": u"k' M", u"kyo": u"k' o",  # きゃきゅきょ
-    u"sha": u"S a", u"sya": u"S a", u"shu": u"S M", u"syu": u"S M", u"she": u"tS e", u"sye": u"tS e", u"sho": u"S o", u"syo": u"S o",  # しゃしゅしぇしょ
-    u"cha": u"tS a", u"cya": u"tS a", u"tya": u"tS a", u"chu": u"tS M", u"cyu": u"tS M", u"che": u"tS e", u"tye": u"tS e", u"tyo": u"tS o", u"cho": u"tS o",  # ちゃちゅちぇちょ
-    u"tsa": u"ts a", u"tsi": u"ts i", u"tse": u"ts e", u"tso": u"ts o", # つぁつぃつぇつぉ
-    u"nya": u"J a", u"nyu": u"J M", u"nye": u"J e", u"nyo": u"J o",  # にゃにゅにぇにょ
-    u"hya": u"C a", u"hyu": u"C M", u"hye": u"C e", u"hyo": u"C o",  # ひゃひゅひぇひょ
-    u"fa": u"p\ a", u"fi": u"p\' i", u"fyu": u"p\' M", u"fe": u"p\ e", u"fo": u"p\ o",  # ふぁふぃふゅふぇふぉ
-    u"mya": u"m' a", u"myu": u"m' M", u"mye": u"m' e", u"myo": u"m' o",  # みゃみゅみぇみょ
-    u"rya": u"4' a", u"ryu": u"4' M", u"ryo": u"4' o",  # りゃりゅりょ
-    u"ga": u"g a", u"gi": u"g' i", u"gu": u"g M", u"ge": u"g e", u"go": u"g o",  # がぎぐげご
-    u"nga": u"N a", u"ngi": u"N' i", u"ngu": u"N M", u"nge": u"N e", u"ngo": u"N o",  # nがnぎnぐnげnご
-    u"za": u"dZ a", u"zi": u"dZ i", u"ji": u"dZ i", u"zu": u"dZ M", u"ze": u"dz e", u"zo": u"dz o",  # ざじずぜぞ
-    u"da": u"d a", u"di": u"d i", u"du": u"d M", u"de": u"d e", u"do": u"d o",  # だぢづでど
-    u"ba": u"b a", u"bi": u"b' i", u"bu": u"b M", u"be": u"b e", u"bo": u"b o",  # ばびぶべぼ
-    u"pa": u"p a", u"pi": u"p' i", u"pu": u"p M", u"pe": u"p e", u"po": u"p o",  # ぱぴぷぺぽ
-    u"n": u"n",
-    u"gya": u"g' a", u"gyu": u"g' M", u"gyo": u"g' o",  # ぎゃぎゅぎょ
-    u"ja": u"dZ a", u"zya": u"dZ a", u"ju": u"dZ M", u"zyu": u"dZ M",  u"je": u"dZ e", u"zye": u"dZ e", u"jo": u"dZ o", u"zyo": u"dZ o",  # じゃじゅじぇじょ
-    u"dhi": u"d' i", u"dhu": u"d' M",  # でぃでゅ
-    u"bya": u"b' a", u"byu": u"b' M", u"bye": u"b' e", u"byo": u"b' o",  # びゃびゅびぇびょ
-    u"pya": u"p' a", u"pyu": u"p' M", u"pye": u"p' e", u"pyo": u"p' o",  # ぴゃぴゅぴぇぴょ
-    u"tha": u"t' a", u"thi": u"t' i", u"thu": u"t' M", u"the": u"t' e", u"tho": u"t' o", # てゃてぃてゅてぇてょ
-    })
-
-#その他の歌詞が挿入された場合
-phonetic_table.update({
-    u"-": u"a", u"ー": u"a", u"−": u"a",  # 伸ばし棒 
-    u"s": u"s", u"m": u"m"
-    })
+def text2events(text):
+    """テキスト情報をテキストイベントのバイナリに変換する
+    各イベントは"DM:xxxx:"で始まり、最大127byteに分割される
+    Args:
+        text: トラックのテキスト情報
+
+    Returns:
+        テキストイベントのバイナリ
+    """
+    binary = []
+    i = 0
+    n = 0
+    while i < len(text):
+        prefix = "DM:%04d:" % n
+        frame = text[i:i + 127 - len(prefix)]
+        binary.append(pack("4B", 0x00, 0xff, 0x01, len(prefix) + len(frame)))
+        binary.append(prefix + frame)
+        i += len(frame)
+        n += 1
+    return ''.join(binary)
+
+
+#変換テーブルは最初に使われたときに作る（import時間を短くするため）
+_phonetic_table = None
+_lyric_table = None
+
+
+def _tables():
+    """歌詞<=>発音記号の変換テーブルを取得する
+    Returns:
+        (歌詞=>発音記号のテーブル, 発音記号=>歌詞のテーブル)
+    """
+    global _phonetic_table, _lyric_table
+    if _phonetic_table is None:
+        _phonetic_table, _lyric_table = _build_tables()
+    return _phonetic_table, _lyric_table
+
+
+def _build_tables():
+    #歌詞=>発音記号の変換テーブル
+    phonetic_table = {
+            u"あ": u"a", u"い": u"i", u"う": u"M", u"え": u"e", u"お": u"o",
+            u"か": u"k a", u"き": u"k i", u"く": u"k M", u"け": u"k e", u"こ": "k o",
+            u"さ": u"s a", u"し": u"S i", u"す": u"s M", u"せ": u"s e", u"そ": "s o",
+            u"た": u"t a", u"ち": u"tS i", u"つ": u"ts M", u"て": u"t e", u"と": "t o",
+            u"な": u"n a", u"に": u"J i", u"ぬ": u"n M", u"ね": u"n e", u"の": u"n o",
+            u"は": u"h a", u"ひ": u"C i", u"ふ": u"p\ M", u"へ": u"h e", u"ほ": u"h o",
+            u"ま": u"m a", u"み": u"m' i", u"む": u"m M", u"め": u"m e", u"も": u"m o",
+            u"や": u"j a", u"ゆ": u"j M", u"いぇ": u"j e", u"よ": u"j o",
+            u"ら": u"4 a", u"り": u"4' i", u"る": u"4 M", u"れ": u"4 e", u"ろ": u"4 o",
+            u"わ": u"w a", u"うぃ": u"w i", u"うぇ": u"w e", u"を": u"w o",
+            u"ぁ": u"h\ a", u"ぃ": u"h\ i", u"ぅ": u"h\ M", u"ぇ": u"h\ e", u"ぉ": u"h\ o",
+            u"きゃ": u"k' a", u"きゅ": u"k' M", u"きょ": u"k' o",
+            u"しゃ": u"S a", u"すぃ": u"s i", u"しゅ": u"S M", u"しぇ": u"S e", u"しょ": u"S o",
+            u"ちゃ": u"tS a", u"つぃ": u"ts i", u"ちゅ": u"tS M", u"ちぇ": u"tS e", u"ちょ": u"tS o",
+            u"にゃ": u"J a", u"にゅ": u"J M", u"にぇ": u"J e", u"にょ": u"J o",
+            u"ひゃ": u"C a", u"ひゅ": u"C M", u"ひぇ": u"C e", u"ひょ": u"C o",
+            u"ふぁ": u"p\ a", u"ふぃ": u"p\' M", u"ふゅ": u"p\' M", u"ふぇ": u"p\ e", u"ふぉ": u"p\ o",
+            u"みゃ": u"m' a", u"みゅ": u"m' M", u"みぇ": u"m' e", u"みょ": u"m' o",
+            u"りゃ": u"4' a", u"りゅ": u"4' M", u"りょ": u"4' o",
+            u"が": u"g a", u"ぎ": u"g' i", u"ぐ": u"g M", u"げ": u"g e", u"ご": u"g o",
+            u"ざ": u"dZ a", u"じ": u"dZ i", u"ず": u"dz M", u"ぜ": u"dz e", u"ぞ": u"dz o",
+            u"だ": u"d a", u"ぢ": u"d i", u"づ": u"d M", u"で": u"d e", u"ど": u"d o",
+            u"ば": u"b a", u"び": u"b' i", u"ぶ": u"b M", u"べ": u"b e", u"ぼ": u"b o",
+            u"ぱ": u"p a", u"ぴ": u"p' i", u"ぷ": u"p M", u"ぺ": u"p e", u"ぽ": u"p o",
+            u"ん": u"n",
+            u"ぎゃ": u"g' a", u"ぎゅ": u"g' M", u"ぎょ": u"g' o",
+            u"じゃ": u"dZ a", u"ずぃ": u"dz i", u"じゅ": u"dZ M", u"じぇ": u"dZ e", u"じょ": "dZ o",
+            u"でぃ": u"d' i", u"でゅ": u"d' M",
+            u"びゃ": u"b' a", u"びゅ": u"b' M", u"びぇ": u"b' e", u"びょ": u"b' o",
+            u"ぴゃ": u"p' a", u"ぴゅ": u"p' M", u"ぴぇ": u"p' e", u"ぴょ": u"p' o",
+
+            u"てゃ": u"t' a", u"てぃ": u"t' i", u"てゅ": u"t' M", u"てぇ": u"t' e", u"てょ": u"t' o"
+        }
+
+    #発音記号=>歌詞（ひらがな）の変換テーブル
+    lyric_table = dict(zip(phonetic_table.values(), phonetic_table.keys()))
+
+
+    #ローマ字の歌詞が入力されたとき用に更新
+    phonetic_table.update({
+        u"a": u"a", u"i": u"i", u"u": u"M", u"e": u"e", u"o": u"o",  # あ行
+        u"ka": u"k a", u"ca": u"k a", u"ki": u"k i", u"ku": u"k M", u"cu": u"k M", u"qu": u"k M", u"ke": u"k e", u"ko": u"k o", u"co": "k o",  # か行
+        u"sa": u"s a", u"si": u"s i", u"shi": u"s i", u"ci": u"s i", u"su": u"s M", u"se": u"s e", u"ce": u"s e", u"so": u"s o",  # さ行
+        u"ta": u"t a", u"ti": u"tS i", u"tu": u"ts M", u"te": u"t e", u"to": u"t o",  # た行
+        u"na": u"n a", u"ni": u"J i", u"nu": u"n M", u"ne": u"n e", u"no": u"n o",  # な行
+        u"ha": u"h a", u"hi": u"C i", u"hu": u"p\ M", u"he": u"h e", u"ho": "h o",  # は行
+        u"ma": u"m a", u"mi": u"m' i", u"mu": u"m M", u"me": u"m e", u"mo": u"m o",   # ま行
+        u"ya": u"j a", u"yu": u"j M", u"ye": u"j e", u"yo": u"j o",  # や行
+        u"ra": u"4 a", u"ri": u"4' i", u"ru": u"4 M", u"re": u"4 e", u"ro": u"4 o",  # ら行
+        u"wa": u"w a", u"wi": u"w i", u"we": u"w e", u"wo": u"w o",  # わ行
+        u"la": "h\ a", u"li": u"h\ i", u"lu": u"h\ M", u"le": u"h\ e", u"lo": u"h\ o", # ぁぃぅぇぉ(la...)
+        u"xa": u"h\ a", u"xi": u"h\ i", u"xu": u"h\ M", u"xe": u"h\ e", u"xo": u"h\ o",  # ぁぃぅぇぉ(xa...)
+        u"kya": u"k' a", u"kyu": u"k' M", u"kyo": u"k' o",  # きゃきゅきょ
+        u"sha": u"S a", u"sya": u"S a", u"shu": u"S M", u"syu": u"S M", u"she": u"tS e", u"sye": u"tS e", u"sho": u"S o", u"syo": u"S o",  # しゃしゅしぇしょ
+        u"cha": u"tS a", u"cya": u"tS a", u"tya": u"tS a", u"chu": u"tS M", u"cyu": u"tS M", u"che": u"tS e", u"tye": u"tS e", u"tyo": u"tS o", u"cho": u"tS o",  # ちゃちゅちぇちょ
+        u"tsa": u"ts a", u"tsi": u"ts i", u"tse": u"ts e", u"tso": u"ts o", # つぁつぃつぇつぉ
+        u"nya": u"J a", u"nyu": u"J M", u"nye": u"J e", u"nyo": u"J o",  # にゃにゅにぇにょ
+        u"hya": u"C a", u"hyu": u"C M", u"hye": u"C e", u"hyo": u"C o",  # ひゃひゅひぇひょ
+        u"fa": u"p\ a", u"fi": u"p\' i", u"fyu": u"p\' M", u"fe": u"p\ e", u"fo": u"p\ o",  # ふぁふぃふゅふぇふぉ
+        u"mya": u"m' a", u"myu": u"m' M", u"mye": u"m' e", u"myo": u"m' o",  # みゃみゅみぇみょ
+        u"rya": u"4' a", u"ryu": u"4' M", u"ryo": u"4' o",  # りゃりゅりょ
+        u"ga": u"g a", u"gi": u"g' i", u"gu": u"g M", u"ge": u"g e", u"go": u"g o",  # がぎぐげご
+        u"nga": u"N a", u"ngi": u"N' i", u"ngu": u"N M", u"nge": u"N e", u"ngo": u"N o",  # nがnぎnぐnげnご
+        u"za": u"dZ a", u"zi": u"dZ i", u"ji": u"dZ i", u"zu": u"dZ M", u"ze": u"dz e", u"zo": u"dz o",  # ざじずぜぞ
+        u"da": u"d a", u"di": u"d i", u"du": u"d M", u"de": u"d e", u"do": u"d o",  # だぢづでど
+        u"ba": u"b a", u"bi": u"b' i", u"bu": u"b M", u"be": u"b e", u"bo": u"b o",  # ばびぶべぼ
+        u"pa": u"p a", u"pi": u"p' i", u"pu": u"p M", u"pe": u"p e", u"po": u"p o",  # ぱぴぷぺぽ
+        u"n": u"n",
+        u"gya": u"g' a", u"gyu": u"g' M", u"gyo": u"g' o",  # ぎゃぎゅぎょ
+        u"ja": u"dZ a", u"zya": u"dZ a", u"ju": u"dZ M", u"zyu": u"dZ M",  u"je": u"dZ e", u"zye": u"dZ e", u"jo": u"dZ o", u"zyo": u"dZ o",  # じゃじゅじぇじょ
+        u"dhi": u"d' i", u"dhu": u"d' M",  # でぃでゅ
+        u"bya": u"b' a", u"byu": u"b' M", u"bye": u"b' e", u"byo": u"b' o",  # びゃびゅびぇびょ
+        u"pya": u"p' a", u"pyu": u"p' M", u"pye": u"p' e", u"pyo": u"p' o",  # ぴゃぴゅぴぇぴょ
+        u"tha": u"t' a", u"thi": u"t' i", u"thu": u"t' M", u"the": u"t' e", u"tho": u"t' o", # てゃてぃてゅてぇてょ
+        })
+
+    #その他の歌詞が挿入された場合
+    phonetic_table.update({
+        u"-": u"a", u"ー": u"a", u"−": u"a",  # 伸ばし棒 
+        u"s": u"s", u"m": u"m"
+        })
+    return phonetic_table, lyric_table
 
 
 def lyric2phonetic(lyric):
@@ -160,7 +200,7 @@ def lyric2phonetic(lyric):
         発音記号(unicode)
     """
     try:
-        phonetic = phonetic_table[lyric]
+        phonetic = _tables()[0][lyric]
     except KeyError:
         phonetic = u"a"
     return phonetic
@@ -175,11 +215,30 @@ def phonetic2lyric(phonetic):
         歌詞（ひらがな）（unicode）
     """
     try:
-        lyric = lyric_table[phonetic]
+        lyric = _tables()[1][phonetic]
     except KeyError:
         lyric = u"あ"
     return lyric
 
+def copy_dict(d):
+    """項目の順序を保ったままディクショナリを複製する
+    通常のディクショナリで順序が変わってしまう場合はOrderedDictにする
+    Args:
+        d: ディクショナリ（Noneならそのまま返す）
+
+    Returns:
+        複製したディクショナリ
+    """
+    if d is None:
+        return None
+    items = d.items()
+    copied = dict(items)
+    if copied.keys() != [key for key, value in items]:
+        from collections import OrderedDict
+        copied = OrderedDict(items)
+    return copied
+
+
 class FakeFile(object):
     """文字列アクセスをファイルアクセスのように動作させるクラス"""
     def __init__(self, string=""):
@@ -208,3 +267,51 @@ class FakeFile(object):
             現在の読み出し開始インデックス
         """
         return self._index
+
+
+class LRUCache(object):
+    """最近使われていないものから捨てていくキャッシュ
+    Attributes:
+        size: 保持する要素数の上限
+    """
+    def __init__(self, size=128):
+        from collections import OrderedDict
+        self.size = size
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        """keyに対応する値を取得する
+        Args:
+            key: キー
+            default: キャッシュに無かった場合の戻り値
+
+        Returns:
+            キャッシュされた値
+        """
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = value
+        return value
+
+    def set(self, key, value):
+        """値をキャッシュする
+        上限を超えた場合は最も古いものから捨てる
+        Args:
+            key: キー
+            value: 値
+        """
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
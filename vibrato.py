@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""ノートへのビブラートの一括設定
+条件（長さ・音高・歌詞）に合うノートをnumpy配列で一度に選び、
+プリセットの形のビブラートを付ける。プリセットの項目（カーブの文字列を含む）は
+プリセットごとに一度だけ作り、ノートごとのVibratoは読み込んだカーブを
+共有する。ノートごとに変わるVibratoDelayはunparseのときに
+ノートの長さとビブラートの長さから求める（Anote.vibrato_delayを参照）
+
+Examples:
+    preset = VibratoPreset(depth=64, rate=50, delay=240)
+    editor.set_vibrato(preset, min_length=480)        # 長いノート全てに
+    editor.set_vibrato(PRESETS['deep'], min_length=960, lyric=u'.*[あお]')
+    editor.set_vibrato(None, max_length=240)          # 短いノートから外す
+"""
+import re
+import numpy
+from vibratoinfo import Vibrato
+
+
+class VibratoPreset(object):
+    """ビブラートの形と、ノートのどこから付けるか
+    Attributes:
+        items: Vibratoの項目（値は文字列、LengthはNone）
+        delay: ノートの開始からビブラートの開始までの時間
+            （Noneならratioで決める）
+        ratio: ビブラートをかけるノートの後ろからの割合
+    """
+    def __init__(self, depth=64, rate=50, depth_curve=None, rate_curve=None,
+                 delay=None, ratio=0.5, icon_id='$04040001', ids='normal',
+                 caption='[Normal] Type 1', original=1):
+        """
+        Args:
+            depth: 振幅の開始値
+            rate: 周期の開始値
+            depth_curve: 振幅カーブ（(ビブラート内の位置（0〜1）のリスト,
+                値のリスト)、Noneなら一定）
+            rate_curve: 周期カーブ（同上）
+            delay, ratio: Attributesを参照
+            icon_id, ids, caption, original: ビブラートの形式
+        """
+        self.delay = delay
+        self.ratio = ratio
+        self.items = [('IconID', icon_id), ('IDS', ids),
+                      ('Original', str(original)), ('Caption', caption),
+                      ('Length', None)]
+        for kind, start, curve in [('Depth', depth, depth_curve),
+                                   ('Rate', rate, rate_curve)]:
+            self.items.append(('Start' + kind, str(start)))
+            xs, ys = curve or ([], [])
+            self.items.append((kind + 'BPNum', str(len(xs))))
+            if len(xs):
+                self.items += [
+                    (kind + 'BPX', ','.join('%.6f' % x for x in xs)),
+                    (kind + 'BPY', ','.join('%d' % y for y in ys))]
+
+    @classmethod
+    def from_anote(cls, anote):
+        """ノートに付いているビブラートと同じ形・開始位置のプリセットを作る
+        Args:
+            anote: ビブラートの付いたAnoteインスタンス
+
+        Returns:
+            VibratoPresetインスタンス
+        """
+        preset = cls(delay=anote.vibrato_delay)
+        preset.items = [(key, None if key == 'Length' else value)
+                        for key, value in anote.vibrato.items()]
+        return preset
+
+    def lengths(self, note_lengths):
+        """ノートの長さからビブラートの長さを求める
+        Args:
+            note_lengths: ノートの長さのnumpy配列
+
+        Returns:
+            ビブラートの長さのnumpy配列（0以上）
+        """
+        if self.delay is not None:
+            lengths = note_lengths - self.delay
+        else:
+            lengths = numpy.rint(note_lengths * self.ratio).astype(numpy.int64)
+        return numpy.maximum(lengths, 0)
+
+    def vibratos(self, lengths):
+        """ノートごとのVibratoを作る
+        ノートごとに書き換えられるように別のVibratoにするが、
+        カーブは一度だけ読み込んで共有する
+        Args:
+            lengths: ビブラートの長さの列
+
+        Returns:
+            Vibratoのリスト
+        """
+        base = Vibrato(self.items)
+        base.curve('Depth')
+        base.curve('Rate')
+        return [base.with_length(int(length)) for length in lengths]
+
+
+#よく使う形
+PRESETS = {
+    'normal': VibratoPreset(),
+    'deep': VibratoPreset(depth=64, rate=50, ratio=0.66,
+                          depth_curve=([0.5, 0.75, 1.0], [64, 80, 100]),
+                          rate_curve=([0.5, 1.0], [50, 70])),
+    'light': VibratoPreset(depth=32, rate=60, ratio=0.4,
+                           icon_id='$04040002', caption='[Normal] Type 2')}
+
+
+def select_notes(anotes, min_length=None, max_length=None, low=None,
+                 high=None, lyric=None):
+    """条件に合うノートを選ぶ（条件を指定しなければ全て）
+    長さと音高はnumpy配列でまとめて判定し、歌詞はその後に残ったノートだけ
+    正規表現で判定する
+    Args:
+        anotes: AnoteList
+        min_length: ノートの長さの下限
+        max_length: ノートの長さの上限
+        low: 音高（ノート番号）の下限
+        high: 音高の上限
+        lyric: 歌詞全体がマッチする正規表現
+
+    Returns:
+        (ノートの番号のnumpy配列, ノートの長さのnumpy配列)
+    """
+    n = len(anotes)
+    lengths = numpy.fromiter((a.length for a in anotes), numpy.int64, n)
+    notes = numpy.fromiter((a.note for a in anotes), numpy.int64, n)
+    mask = numpy.ones(n, dtype=bool)
+    if min_length is not None:
+        mask &= lengths >= min_length
+    if max_length is not None:
+        mask &= lengths <= max_length
+    if low is not None:
+        mask &= notes >= low
+    if high is not None:
+        mask &= notes <= high
+    indices = numpy.flatnonzero(mask)
+    if lyric is not None:
+        if isinstance(lyric, str):
+            lyric = lyric.decode('utf-8')
+        rxp = re.compile(u"(?:%s)\Z" % lyric)
+        matched = [bool(rxp.match(anotes[i].lyric)) for i in indices]
+        indices = indices[numpy.array(matched, dtype=bool)]
+    return indices, lengths[indices]
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""ノートのビブラート情報
+OrderedDictを使うのでanote.pyから分け、ビブラートの付いたノートを
+読むまでimportしない（import vsqの時間を抑える）
+"""
+from array import array
+from collections import OrderedDict
+
+
+class Vibrato(OrderedDict):
+    """ビブラート情報（h#xxxxの項目を文字列のまま、順序を保って持つ）
+    DepthBPX, DepthBPYなどのカーブは、curve()で初めて読むときに
+    arrayにして保持する。項目を書き換えると読み直す。
+    読み込んだカーブはcopy(), with_length()の複製と共有する
+
+    Examples:
+        vibrato.curve('Depth') => (array('d', [0.5, 0.75, 1.0]),
+                                   array('i', [64, 80, 100]))
+    """
+    _curves = None
+
+    def curve(self, kind):
+        """カーブを取得する
+        Args:
+            kind: "Depth"（振幅）または"Rate"（周期）
+
+        Returns:
+            (ビブラート内の位置（0〜1）のarray('d'), 値のarray('i'))
+            点がなければ空のarray
+        """
+        if self._curves is None:
+            self._curves = {}
+        curve = self._curves.get(kind)
+        if curve is None:
+            x = array('d')
+            y = array('i')
+            if int(self.get(kind + 'BPNum', 0)) > 0:
+                x.extend(float(v) for v in self[kind + 'BPX'].split(','))
+                y.extend(int(v) for v in self[kind + 'BPY'].split(','))
+            curve = self._curves[kind] = (x, y)
+        return curve
+
+    @property
+    def length(self):
+        return int(self['Length'])
+
+    def copy(self):
+        """複製する（読み込んだカーブは共有する）"""
+        vibrato = Vibrato(self)
+        vibrato._curves = self._curves
+        return vibrato
+
+    def with_length(self, length):
+        """長さ（Length）だけを変えた複製を取得する
+        カーブは長さに依らないので、読み込んだカーブを共有したままにする
+        """
+        vibrato = self.copy()
+        OrderedDict.__setitem__(vibrato, 'Length', str(length))
+        return vibrato
+
+    def __reduce__(self):
+        return (Vibrato, (self.items(),))
+
+    #項目の順序は比較しない
+    def __eq__(self, other):
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    #項目を変更する操作では読み込んだカーブを破棄する
+    def __setitem__(self, key, value):
+        self._curves = None
+        return super(Vibrato, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._curves = None
+        return super(Vibrato, self).__delitem__(key)
+
+    def update(self, *args, **kwargs):
+        self._curves = None
+        return super(Vibrato, self).update(*args, **kwargs)
+
+    def pop(self, *args):
+        self._curves = None
+        return super(Vibrato, self).pop(*args)
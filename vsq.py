@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 import re
+import copy
+from bisect import bisect_left
+from contextlib import contextmanager
 from tools import *
 from vsq_rules import *
 from normaltrack import *
+from stats import NULL_STATS
 from mastertrack import *
 from header import *
 from struct import *
@@ -16,11 +20,41 @@ class VSQEditor(object):
         track_num: ノーマルトラック数
         normaltracks: normaltrackインスタンスのリスト（normaltrack.pyを参照）
         current_track: 操作対象トラック
+        tempo_map: テンポと拍子の変化（tempomap.pyを参照）
         start_time: シーケンスの始端時間
         end_time: シーケンスの終端時間
+        batch_conflicts: 直前のbatchで範囲が重なっていたカーブの編集
+        stats: 処理時間とカウンタの記録先（stats.pyを参照）
+        parse_cache: パース結果のキャッシュ（parsecache.pyを参照）
+            クラス属性に設定すると、全てのVSQEditorのパースで使われる
+        simplify_tolerance: カーブ名をキーとし、カーブを書き込む際に
+            点を間引くときの値の許容誤差を値とするディクショナリ
+            （bplist.simplifyを参照。キーがなければ間引かない）
+            example:
+            {"PitchBendBPList": 16, "DynamicsBPList": 0}
+        simplified_points: 間引いた点の数の合計
     """
+    parse_cache = None
+    _batch = None
+    batch_conflicts = []
+    stats = NULL_STATS
+    simplify_tolerance = None
+    simplified_points = 0
 
-    def __init__(self, filename=None, binary=None):
+    def __init__(self, filename=None, binary=None, stats=None):
+        """コンストラクタ
+        Args:
+            filename: VSQファイルのパス
+            binary: VSQファイルのバイナリデータ
+            stats: Trueまたは Statsインスタンスを指定すると、
+                各処理の時間とカウンタを記録する
+        """
+        if stats is True:
+            from stats import Stats
+            stats = Stats()
+        if stats:
+            self.stats = stats
+        self.simplify_tolerance = {}
         if filename:
             self.parse(filename=filename)
         elif binary:
@@ -35,19 +69,46 @@ class VSQEditor(object):
         両方書いた場合filenameが優先される
         """
         #各チャンクのパース
+        with self.stats.timer('parse'):
+            cache = self.parse_cache
+            if cache is None:
+                self.__parse(filename, binary)
+                return
+            if filename:
+                binary = open(filename, 'rb').read()
+            editor = cache.get(binary)
+            if editor is None:
+                self.stats.count('parse_cache_misses')
+                self.__parse(None, binary)
+                cache.put(binary, self)
+            else:
+                self.stats.count('parse_cache_hits')
+                state = editor.__dict__.copy()
+                state.pop('stats', None)
+                state.pop('simplify_tolerance', None)
+                self.__dict__.update(state)
+
+    def __parse(self, filename, binary):
+        stats = self.stats
         self._fp = open(filename, 'r') if filename else tools.FakeFile(binary)
-        self.header = Header(self._fp)
-        self.master_track = MasterTrack(self._fp)
+        with stats.timer('header'):
+            self.header = Header(self._fp)
+        with stats.timer('master_track'):
+            self.master_track = MasterTrack(self._fp)
         track_num = self.header.data['track_num'] - 1
-        self.normal_tracks = [NormalTrack(self._fp) for i in range(track_num)]
-
-        self.unapply_dict = {}
+        self.normal_tracks = []
+        for i in range(track_num):
+            track_stats = stats.track(i)
+            with track_stats.timer('normal_track'):
+                self.normal_tracks.append(NormalTrack(self._fp, track_stats))
 
         #シーケンスの始端時間（プリメジャータイムを除いた時間）を求める
         pre_measure = int(self.normal_tracks[0].data['Master']['PreMeasure'])
-        nn, dd, _, _ = self.master_track.beat
         time_div = self.header.data['time_div']
-        self.start_time = int(nn / float(2 ** dd) * 4 * pre_measure * time_div)
+        from tempomap import TempoMap
+        self.tempo_map = TempoMap.from_master_track(self.master_track,
+                                                    time_div)
+        self.start_time = self.tempo_map.bar_to_tick(pre_measure)
 
         #シーケンスの終端時間（最後のノートイベントの終端時間）を求める
         self.end_time = self.start_time
@@ -67,16 +128,82 @@ class VSQEditor(object):
             filenameが指定されなかった場合はバイナリ
         """
         #各チャンクのアンパース
-        binary = self.header.unparse()
-        binary += self.master_track.unparse()
-        for track in self.normal_tracks:
-            binary += track.unparse()
+        with self.stats.timer('unparse'):
+            binary = self.header.unparse()
+            binary += self.master_track.unparse()
+            for i, track in enumerate(self.normal_tracks):
+                with self.stats.track(i).timer('unparse_track'):
+                    binary += track.unparse()
+        self.stats.count('bytes_written', len(binary))
 
         if filename:
             open(filename, 'w').write(binary)
         else:
             return binary
 
+    def save_snapshot(self, filename=None):
+        """パース済みのデータをスナップショットとして保存する
+        （snapshot.pyを参照）
+        Args:
+            filename: 書き込むスナップショットのパス
+        Returns:
+            filenameが指定されなかった場合はスナップショットのバイナリ
+        """
+        import snapshot
+        with self.stats.timer('save_snapshot'):
+            binary = snapshot.dumps(self)
+        if filename:
+            open(filename, 'wb').write(binary)
+        else:
+            return binary
+
+    @classmethod
+    def load_snapshot(cls, filename=None, binary=None, stats=None):
+        """スナップショットからVSQEditorを復元する
+        Args:
+            filename: スナップショットのパス（mmapで読み込む）
+            binary: スナップショットのバイナリ
+            stats: コンストラクタのstatsと同じ
+        Returns:
+            VSQEditorインスタンス
+        """
+        import snapshot
+        from stats import Stats
+        stats = Stats() if stats is True else stats
+        with (stats or NULL_STATS).timer('load_snapshot'):
+            if filename:
+                editor = snapshot.load(filename)
+            else:
+                editor = snapshot.loads(binary)
+        if stats:
+            editor.stats = stats
+        return editor
+
+    def get_stats(self):
+        """記録した処理時間とカウンタを取得する
+        Returns:
+            Stats.as_dict()の結果（記録していない場合は空のディクショナリ）
+        """
+        return self.stats.as_dict()
+
+    def __track_stats(self):
+        if not self.stats.per_track:
+            return self.stats
+        return self.stats.track(self.normal_tracks.index(self.current_track))
+
+    @property
+    def unapply_dict(self):
+        """操作対象トラックのルール適用を戻すための情報
+        Returns:
+            ルール適用候補IDをキーとするディクショナリ
+        """
+        return self.current_track.unapply_dict
+
+    @property
+    def applied_ids(self):
+        """操作対象トラックで適用中のルール適用候補IDの集合"""
+        return self.current_track.applied_ids
+
     @property
     def anotes(self):
         """音符リストを取得する
@@ -119,6 +246,24 @@ class VSQEditor(object):
         """
         return self.__get_param_curve('DynamicsBPList', s, e)
 
+    def render(self, s=None, e=None, track=None, rate=None):
+        """sからeまでの実際の音高とダイナミクスを一定間隔で求める
+        （render.pyを参照。numpyが必要）
+        Args:
+            s: 開始時間
+            e: 終了時間
+            track: トラック番号（省略時は操作対象トラック）
+            rate: 1秒あたりの点数
+
+        Returns:
+            {"seconds": 時刻, "tick": 時間, "pitch": 絶対音高（セント）,
+             "dynamics": ダイナミクス}（値はnumpy配列）
+        """
+        import render
+        with self.stats.timer('render'):
+            return render.render(self, track, s, e,
+                                 rate or render.DEFAULT_RATE)
+
     def set_pitch_curve(self, curve, s=None, e=None, stretch=None):
         """sからeまでのピッチ曲線をcurveで置き換える
         Args:
@@ -150,6 +295,37 @@ class VSQEditor(object):
                                         stretch)
 
 
+    def edit_curve(self, ptype, op, s=None, e=None, **kwargs):
+        """sからeまでのカーブを演算で書き換える
+        （curveops.pyを参照。numpyが必要）
+        値はカーブの値の範囲（curveops.LIMITS）に収める。
+        batch内では、同じカーブに溜めている書き換えを反映したカーブに対して
+        演算するので、範囲が重なる演算も呼び出し順に積み重なる
+        Args:
+            ptype: カーブ名（"DynamicsBPList"など）
+            op: 演算名（"add", "multiply", "clamp", "smooth",
+                "crossfade", "blend"）
+            s: 選択開始地点の絶対時間
+            e: 選択終了地点の絶対時間
+            kwargs: 演算の引数
+        sやeを指定しなければ、トラックの先頭と末尾の時間に置き換えられる
+
+        Examples:
+            editor.edit_curve('DynamicsBPList', 'multiply', 1920, 7680,
+                              factor=0.8)
+            editor.edit_curve('PitchBendBPList', 'smooth', width=60,
+                              kernel='gaussian')
+        """
+        import curveops
+        s, e = self.__param_range(s, e)
+        with self.stats.timer('curve_ops'):
+            edit = curveops.edit(self.__pending_curve(ptype), op, s, e,
+                                 limits=curveops.LIMITS.get(ptype), **kwargs)
+        if edit is None:
+            return False
+        self.stats.count('curve_ops')
+        return self.__edit_param_curve(ptype, *edit)
+
     def select_track(self, n):
         """操作対象トラックを変更する
         Args:
@@ -164,63 +340,235 @@ class VSQEditor(object):
             rule_i: get_rule_candsメソッドによって得られたルール適用候補
         """
         anotes = rule_i['anotes']
-        for i, curve in enumerate(rule_i['rule']['dyn_curves']):
-            self.set_dynamics_curve(curve['curve'],
-                                anotes[i].start,
-                                anotes[i].end,
-                                curve['stretch'])
-        for i, curve in enumerate(rule_i['rule']['pit_curves']):
-            self.set_pitch_curve(curve['curve'],
-                                anotes[i].start,
-                                anotes[i].end,
-                                curve['stretch'])
-        anotes[0].prop['PMbPortamentoUse'] = rule_i['rule']['portamento']
-        anotes[0].prop['DEMaccent'] = rule_i['rule']['accent']
+        rule = Rule.compile(rule_i['rule'])
+        for ptype, s, e, points in self.rule_edits(rule_i):
+            self.__put_param_curve(ptype, s, e, *points())
+        anote = self.current_track.writable_note(anotes[0])
+        anote.prop['PMbPortamentoUse'] = rule.portamento
+        anote.prop['DEMaccent'] = rule.accent
+        track = self.current_track
+        track.applied_ids = track.applied_ids | frozenset([rule_i['id']])
+
+    def rule_edits(self, rule_i):
+        """ルールを適用したときのカーブの書き換えを求める
+        書き換える点は求めずに、求める関数を返す（vsqstream.pyで使う）
+        Args:
+            rule_i: get_rule_candsメソッドによって得られたルール適用候補
+
+        Returns:
+            (カーブ名, 開始時間, 終了時間, 点を求める関数)のリスト
+            点を求める関数は(開始時間からの相対時間のリスト, 値のリスト)を返す
+        """
+        anotes = rule_i['anotes']
+        rule = Rule.compile(rule_i['rule'])
+        edits = []
+        for ptype, kind in [('DynamicsBPList', 'dyn'),
+                            ('PitchBendBPList', 'pit')]:
+            for i in range(len(getattr(rule, kind + '_curves'))):
+                edit = self.__rule_edit(ptype, rule, kind, i, anotes[i])
+                if edit is not None:
+                    edits.append(edit)
+        return edits
+
+    def curve_edit(self, ptype, curve, s=None, e=None):
+        """sからeまでのカーブをcurveで置き換える書き換えを求める
+        （rule_editsと同じ形式。書き換えがなければNone）
+        """
+        s, e = self.__param_range(s, e)
+        if e - s < 0 or not curve:
+            return None
+
+        def points():
+            #curveをスケールしながらパラメータを生成
+            with self.stats.timer('rescale'):
+                offsets, values = rescale(curve, e - s)
+                tolerance = self.__tolerance(ptype)
+                if tolerance is not None:
+                    from bplist import simplify
+                    count = len(offsets)
+                    offsets, values = simplify(offsets, values, tolerance)
+                    self.__count_simplified(count - len(offsets))
+            self.stats.count('rescaled_curves')
+            return offsets, values
+        return ptype, s, e, points
 
     def unapply_rule(self, rule_i):
         """ルールの適用をもとに戻す
         Args:
             rule_i: get_rule_candsメソッドによって得られたルール適用候補
         """
-        if not rule_i['id'] in self.unapply_dict:
+        cand_id = rule_i['id']
+        if not cand_id in self.unapply_dict:
             return False
 
-        rule_i = self.unapply_dict[rule_i['id']]
-        anotes = rule_i['anotes']
-        start_time = anotes[0].start
-        end_time = anotes[-1].end
-
-        dynamics_list = self.current_track.data['DynamicsBPList']
-        pitch_list = self.current_track.data['PitchBendBPList']
-        for p in self.get_dynamics_curve(start_time, end_time):
-            self.current_track.data['DynamicsBPList'].remove(p)
-        for p in self.get_pitch_curve(start_time, end_time):
-            self.current_track.data['PitchBendBPList'].remove(p)
-        dynamics_list.extend(rule_i['undyn'])
-        pitch_list.extend(rule_i['unpit'])
-        dynamics_list.sort()
-        pitch_list.sort()
+        rule_i = self.unapply_dict[cand_id]
+        for ptype, key in [('DynamicsBPList', 'undyn'),
+                           ('PitchBendBPList', 'unpit')]:
+            s, e = rule_i[key + '_range']
+            points = rule_i[key]
+            self.__edit_param_curve(ptype, s, e,
+                                    [p['time'] for p in points],
+                                    [p['value'] for p in points],
+                                    False)
+        track = self.current_track
+        track.applied_ids = track.applied_ids - frozenset([cand_id])
         return True
 
+    def select_cands(self, cands, ids):
+        """ルール適用候補のうちidsに含まれるものだけが適用された状態にする
+        適用中の候補（applied_ids）との差分だけを適用・適用解除する。
+        書き換える範囲と重なる適用中の候補は候補の順に適用し直すので、
+        結果は選択した候補を候補の順に適用した場合と同じになる
+
+        Args:
+            cands: get_rule_candsメソッドによって得られたルール適用候補のリスト
+            ids: 適用する候補IDの集合
+
+        Returns:
+            {"applied": 新たに適用した候補IDのリスト,
+             "unapplied": 適用を解除した候補IDのリスト,
+             "ranges": {カーブ名: 書き換えた時間範囲(s, e)のリスト}}
+            時間範囲は重なるものをまとめて時間順に並べたもの
+        """
+        ids = set(ids)
+        applied = self.applied_ids
+        unapply = [c for c in cands if c['id'] in applied and
+                   not c['id'] in ids]
+        apply = [c for c in cands if c['id'] in ids and
+                 not c['id'] in applied]
+        ranges = {'DynamicsBPList': [], 'PitchBendBPList': []}
+
+        def touch(cand):
+            info = self.unapply_dict[cand['id']]
+            ranges['DynamicsBPList'].append(info['undyn_range'])
+            ranges['PitchBendBPList'].append(info['unpit_range'])
+
+        with self.batch():
+            for c in unapply:
+                if self.unapply_rule(c):
+                    touch(c)
+            #書き換える範囲と重なる適用中の候補も、候補の順に適用し直す
+            keep = [c for c in cands if c['id'] in applied and c['id'] in ids]
+            redo = self.__overlapping_cands(keep, unapply + apply)
+            redo.update(c['id'] for c in apply)
+            apply = [c for c in cands if c['id'] in redo]
+            for c in apply:
+                self.apply_rule(c)
+                touch(c)
+        return {"applied": [c['id'] for c in apply
+                            if not c['id'] in applied],
+                "unapplied": [c['id'] for c in unapply],
+                "ranges": dict((ptype, _merge_ranges(rs))
+                               for ptype, rs in ranges.items())}
+
+    def __overlapping_cands(self, cands, changed):
+        """changedの候補が書き換える範囲と（間接的に）重なる候補を求める
+        Args:
+            cands: 調べる候補のリスト
+            changed: 書き換える候補のリスト
+
+        Returns:
+            重なる候補IDの集合
+        """
+        def span(c):
+            info = self.unapply_dict[c['id']]
+            return (min(info['undyn_range'][0], info['unpit_range'][0]),
+                    max(info['undyn_range'][1], info['unpit_range'][1]))
+        found = set()
+        if not cands or not changed:
+            return found
+        from interval import IntervalIndex
+        spans = [span(c) for c in cands]
+        index = IntervalIndex(cands, [s for s, e in spans],
+                              [e for s, e in spans])
+        queue = [span(c) for c in changed if c['id'] in self.unapply_dict]
+        while queue:
+            s, e = queue.pop()
+            for c in index.query(s, e):
+                if not c['id'] in found:
+                    found.add(c['id'])
+                    queue.append(span(c))
+        return found
+
+    @contextmanager
+    def batch(self):
+        """カーブの書き換えをまとめて行う
+        withブロック内のset_pitch_curve, set_dynamics_curve,
+        apply_rule, unapply_ruleによるカーブの書き換えを溜めておき、
+        ブロックを抜けるときにカーブごとに一度のマージで反映する。
+        範囲が重なる書き換えは呼び出し順に反映され、
+        batch_conflictsに記録される。
+        ブロック内で例外が発生した場合、溜めた書き換えは破棄される
+
+        Examples:
+            with editor.batch():
+                for c in cands:
+                    editor.apply_rule(c)
+        """
+        if self._batch is not None:  # 入れ子の場合は外側にまとめる
+            yield
+            return
+
+        self._batch = {}
+        try:
+            yield
+            batch = self._batch
+        finally:
+            self._batch = None
+
+        conflicts = []
+        with self.stats.timer('curve_write'):
+            for track, ptype, edits in batch.values():
+                for c in track.writable_curve(ptype).apply_edits(edits):
+                    conflicts.append((ptype, c))
+        self.batch_conflicts = conflicts
+
     def get_rule_cands(self, *rules):
         """ルール適用候補を取得する
         Arge:
-            rules: ディクショナリとして格納されたルール定義（vsq_rules.pyを参照）
+            rules: Ruleインスタンス、またはディクショナリとして
+            格納されたルール定義（vsq_rules.pyを参照）
             複数でもOK
 
         Returns:
             ルール適用候補（リスト）
         ルール適用候補のキーには重複しないIDが振られている
         """
+        stats = self.__track_stats()
+        with stats.timer('get_rule_cands'):
+            cands = self.__get_rule_cands(rules, stats)
+        stats.count('cands', len(cands))
+        return cands
+
+    def __get_rule_cands(self, rules, stats):
         cands = []
         for rule in rules:
-            rulerxp = re.compile(rule['regexp'])
+            rule = Rule.compile(rule)
+            rulerxp = rule.rxp
             match_len = lambda x, y: (not x or not y) or len(x) == len(y)
 
-            for i, match in enumerate(rulerxp.finditer(self.anotes.lyrics)):
-                s = match.start()
-                e = match.end()
-                match_anotes = self.anotes.filter(lyric_start=s, lyric_end=e)
+            #歌詞文字列上のインデックスからノートを求める
+            offsets = self.anotes.lyric_offsets()
+            l2i = lambda i: bisect_left(offsets, i)
+
+            #音程の条件は音程差の索引でマッチする位置を求めておく
+            contours = self.__rule_contours(rule)
+
+            if rulerxp is None:
+                #歌詞の条件がなければ音程差のパターンにマッチした部分が候補
+                n, starts = contours[-1]
+                spans = [(offsets[j], offsets[j + n]) for j in sorted(starts)
+                         if j + n < len(offsets)]
+            else:
+                with stats.timer('regex'):
+                    spans = [m.span()
+                             for m in rulerxp.finditer(self.anotes.lyrics)]
+            stats.count('regex_matches', len(spans))
+
+            for i, (s, e) in enumerate(spans):
+                match_anotes = self.anotes[l2i(s):l2i(e)]
+                if not match_anotes:
+                    continue
 
                 #各ノートが接続されているか
                 if rule['connect'] and len(match_anotes.split()) != 1:
@@ -230,8 +578,8 @@ class VSQEditor(object):
                     not match_len(rule['pit_curves'], match_anotes)):
                     continue
                 #音階の変化が一致するか
-                if (rule['relative_notes'] and
-                    rule['relative_notes'] !=  match_anotes.relative_notes):
+                if not all(len(match_anotes) == n and l2i(s) in starts
+                           for n, starts in contours):
                     continue
 
                 else:
@@ -240,57 +588,263 @@ class VSQEditor(object):
                             "anotes": match_anotes,
                             "s_index": s,
                             "e_index": e}
-                    u_dyn = self.get_dynamics_curve(
-                            match_anotes[0].start,
-                            match_anotes[-1].end)
-                    u_pit = self.get_pitch_curve(
-                            match_anotes[0].start,
-                            match_anotes[-1].end + match_anotes[-1].length)
-                    un_rule_i = {
-                            "anotes": match_anotes,
-                            "undyn": u_dyn,
-                            "unpit": u_pit}
+                    #元に戻すためのカーブは最初に候補になったときに保存する
                     if not rule_i['id'] in self.unapply_dict:
-                        self.unapply_dict[rule_i['id']] = un_rule_i
+                        u_dyn_range = (match_anotes[0].start,
+                                       match_anotes[-1].end + 1)
+                        u_pit_range = (match_anotes[0].start,
+                                       match_anotes[-1].end +
+                                       match_anotes[-1].length)
+                        un_rule_i = {
+                            "anotes": match_anotes,
+                            "undyn": self.get_dynamics_curve(*u_dyn_range),
+                            "unpit": self.get_pitch_curve(*u_pit_range),
+                            "undyn_range": u_dyn_range,
+                            "unpit_range": u_pit_range}
+                        writable = self.current_track.writable_unapply_dict()
+                        writable[rule_i['id']] = un_rule_i
                     cands.append(rule_i)
 
         return cands
 
+    def __rule_contours(self, rule):
+        """ルールの音程の条件にマッチする位置を求める
+        Returns:
+            (ノートの数, 最初のノートの番号の集合)のリスト
+        """
+        index = self.anotes.contour_index
+        contours = []
+        relative_notes = rule['relative_notes']
+        if relative_notes:
+            starts = set()
+            if relative_notes[0] == 0:
+                starts = set(index.find(relative_notes[1:]))
+            contours.append((len(relative_notes), starts))
+        if rule.contour is not None:
+            contours.append((len(rule.contour) + 1,
+                             set(index.find(rule.contour))))
+        return contours
+
+    def find_contour(self, pattern, lyric=None):
+        """操作対象トラックから音程差のパターンにマッチする部分を取得する
+        （AnoteList.find_contourを参照）
+        Args:
+            pattern: 音程差の条件のリスト（contour.pyを参照）
+                example:
+                [(5, None), (-2, -1)]  # 5半音以上上がった後に1〜2半音下がる
+            lyric: 歌詞の正規表現
+
+        Returns:
+            マッチした部分のAnoteListのリスト
+        """
+        return self.anotes.find_contour(pattern, lyric)
+
+    def get_rule_cands_all(self, rules, tracks=None, processes=None):
+        """複数のトラックのルール適用候補をプロセスプールで並列に取得する
+        Args:
+            rules: ルール定義のリスト
+            tracks: 対象とするトラック番号のリスト（省略時は全トラック）
+            processes: プロセス数（省略時はCPU数、1ならこのプロセスで処理）
+
+        Returns:
+            トラック番号をキーとし、ルール適用候補のリストを値とする
+            ディクショナリ
+        """
+        return self.__run_tracks(rules, tracks, processes, False, None)
+
+    def apply_rules_all(self, rules, tracks=None, select=None,
+            processes=None):
+        """複数のトラックでルール適用候補を求めて適用する処理を
+        プロセスプールで並列に行い、結果をこのエディタに反映する
+        Args:
+            rules: ルール定義のリスト
+            tracks: 対象とするトラック番号のリスト（省略時は全トラック）
+            select: トラック番号をキーとし、適用する候補IDの集合を値とする
+                ディクショナリ（省略時は全ての候補を適用）
+            processes: プロセス数（省略時はCPU数、1ならこのプロセスで処理）
+
+        Returns:
+            トラック番号をキーとし、ルール適用候補のリストを値とする
+            ディクショナリ
+        """
+        return self.__run_tracks(rules, tracks, processes, True, select)
+
+    def __run_tracks(self, rules, tracks, processes, apply, select):
+        if tracks is None:
+            tracks = range(len(self.normal_tracks))
+        jobs = []
+        for n in tracks:
+            ids = select.get(n, ()) if select is not None else None
+            jobs.append((self.__track_editor(n), n, rules, apply, ids))
+
+        if processes == 1 or len(jobs) <= 1:
+            results = map(_track_worker, jobs)
+        else:
+            import multiprocessing
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_track_worker, jobs)
+            finally:
+                pool.close()
+                pool.join()
+
+        #ワーカーで処理したトラックをエディタに戻す
+        cands = {}
+        for n, track, track_cands in results:
+            if self.current_track is self.normal_tracks[n]:
+                self.current_track = track
+            self.normal_tracks[n] = track
+            cands[n] = track_cands
+        return cands
+
+    def fork(self):
+        """パース済みのデータを共有したままエディタを複製する
+        ノートとパラメータカーブは書き換えるまで複製元と共有し
+        （コピーオンライト）、書き換えた側だけが該当する部分を複製する。
+        複製したエディタでのルール適用やカーブの書き換えは複製元に
+        影響しないので、プレビューや比較のためにdeepcopyやunapply_ruleで
+        戻す必要がない。ノートを直接書き換える場合は
+        current_track.writable_anotes()で取得したものを書き換える
+
+        Returns:
+            VSQEditorインスタンス
+
+        Examples:
+            preview = editor.fork()
+            preview.apply_rule(cand)
+            preview.get_pitch_curve(s, e)   # editorのカーブは変わらない
+        """
+        editor = copy.copy(self)
+        editor._fp = None
+        editor._batch = None
+        editor.batch_conflicts = []
+        editor.simplify_tolerance = dict(self.simplify_tolerance or {})
+        editor.normal_tracks = [track.fork() for track in self.normal_tracks]
+        n = self.normal_tracks.index(self.current_track)
+        editor.current_track = editor.normal_tracks[n]
+        self.stats.count('forks')
+        return editor
+
+    def __track_editor(self, n):
+        editor = copy.copy(self)
+        editor._fp = None
+        editor.normal_tracks = [self.normal_tracks[n]]
+        editor.current_track = self.normal_tracks[n]
+        return editor
+
+    def index_cands(self, cands):
+        """ルール適用候補の時間範囲の索引を作る
+        Args:
+            cands: get_rule_candsメソッドによって得られたルール適用候補のリスト
+
+        Returns:
+            IntervalIndex（各要素はルール適用候補）
+            時間窓と重なる候補はquery(s, e)で取得できる
+        """
+        from interval import IntervalIndex
+        #終端時間は次のノートの始端と重ならないように含めない
+        return IntervalIndex(cands,
+                             [c['anotes'][0].start for c in cands],
+                             [c['anotes'][-1].end - 1 for c in cands])
+
+    def rule_conflicts(self, cands):
+        """時間範囲が重なっているルール適用候補を調べる
+        重なっている候補を両方適用すると、後から適用したものが
+        先に適用したもののカーブを上書きする
+
+        Args:
+            cands: get_rule_candsメソッドによって得られたルール適用候補のリスト
+
+        Returns:
+            重なっている候補IDの組のリスト
+            example:
+            [("R0I1", "R4I2")]
+        """
+        return [(a['id'], b['id'])
+                for a, b in self.index_cands(cands).overlaps()]
+
     def __set_param_curve(self, ptype, curve, s, e, stretch):
+        edit = self.curve_edit(ptype, curve, s, e)
+        if edit is None:
+            return False
+        ptype, s, e, points = edit
+        return self.__put_param_curve(ptype, s, e, *points())
+
+    def __rule_edit(self, ptype, rule, kind, i, anote):
+        s, e = self.__param_range(anote.start, anote.end)
+        length = e - s
+        if length < 0:
+            return None
+
+        def points():
+            #同じ長さのノートにはメモ化された伸縮済みカーブを使う
+            with self.stats.timer('rescale'):
+                tolerance = self.__tolerance(ptype)
+                offsets, values = rule.resampled(kind, i, length, tolerance)
+                if tolerance is not None:
+                    self.__count_simplified(
+                        len(rule.resampled(kind, i, length)[0]) -
+                        len(offsets))
+            self.stats.count('rescaled_curves')
+            return offsets, values
+        return ptype, s, e, points
+
+    def __tolerance(self, ptype):
+        #simplify_toleranceを持たない（古いpickleの）エディタでは間引かない
+        return (self.simplify_tolerance or {}).get(ptype)
+
+    def __count_simplified(self, count):
+        self.simplified_points += count
+        self.stats.count('simplified_points', count)
+
+    def __param_range(self, s, e):
         if s == None or s <= self.start_time:
             s = self.start_time + 1
         if e == None or self.end_time <= e:
             e = self.end_time + 1
-        length = e - s
-        if length < 0 or not curve:
-            return False
-        len_ratio = float(length) / len(curve)
+        return s, e
 
-        #curveをスケールしながらパラメータを生成
-        new_bp = []
-        for i, v in enumerate(curve):
-            if int(len_ratio * i) != int(len_ratio * (i - 1)) or i == 0:
-                new_bp.append({'time': s + int(len_ratio * i), 'value': v})
-        select = self.__get_param_curve
-
-        #元の波形の終端の値を新しい波形の終端に追加
+    def __put_param_curve(self, ptype, s, e, offsets, values):
+        #元の波形の終端の値を新しい波形の終端(e+1)に追加して
         #選択範囲以外への影響を抑制する
-        end_value = select(ptype, self.start_time, e)[-1]['value']
-        new_bp.append({'time': e + 1, 'value': end_value})
-
-        param = self.current_track.data[ptype]
-        for p in select(ptype, s, e):
-            param.remove(p)  # 選択範囲の元の波形の除去
-        param.extend(new_bp)  # 新しい波形の追加
-        param.sort()
+        return self.__edit_param_curve(ptype, s, e,
+                                       [s + t for t in offsets],
+                                       values,
+                                       True)
+
+    def __edit_param_curve(self, ptype, s, e, times, values, hold):
+        edit = (s, e, times, values, hold)
+        track = self.current_track
+        self.stats.count('curve_edits')
+        if self._batch is None:
+            with self.stats.timer('curve_write'):
+                track.writable_curve(ptype).apply_edits([edit])
+        else:
+            key = (id(track), ptype)
+            if not key in self._batch:
+                self._batch[key] = (track, ptype, [])
+            self._batch[key][2].append(edit)
         return True
 
+    def __pending_curve(self, ptype):
+        #batch内で溜めている書き換えを反映したカーブ（トラックのカーブは
+        #書き換えずに、arrayを共有した複製に反映する）
+        track = self.current_track
+        bp = track.data[ptype]
+        if self._batch is None or not (id(track), ptype) in self._batch:
+            return bp
+        bp = bp.copy()
+        bp.apply_edits(self._batch[(id(track), ptype)][2])
+        return bp
+
     def __get_param_curve(self, ptype, s, e):
         if s == None:
             s = self.start_time
         if e == None:
             e = self.end_time
-        return [ev for ev in self.current_track.data[ptype] if s <= ev['time'] <= e]
+        points = self.current_track.data[ptype].select(s, e)
+        self.stats.count('bp_points_scanned', len(points))
+        return points
 
     def add_note(self, note, force=True):
         """ノートを追加する関数
@@ -299,12 +853,12 @@ class VSQEditor(object):
             note: Anoteクラスの音符イベント
             force: 前後のノートを削って挿入するかしないか
         """
-        anotes = self.anotes
+        anotes = self.current_track.writable_anotes()
         conflict = lambda prev, next: max(0, prev.end - next.start)
 
         # ノートの追加, ソート
-        anotes.append(note)
-        target = anotes.index(note)
+        target = anotes.add(note)
+        note = anotes[target]
         prev = target - 1
         next = target + 1
 
@@ -320,8 +874,224 @@ class VSQEditor(object):
                 anotes[target].start += conflict(anotes[prev], note)
             if next < len(anotes):
                 anotes[target].length -= conflict(note, anotes[next])
+        anotes.reindex()
         self.end_time = max(anotes[-1].end, self.end_time)
 
+    def set_vibrato(self, preset, min_length=None, max_length=None,
+                    low=None, high=None, lyric=None, track=None):
+        """条件に合う全てのノートにプリセットのビブラートを付ける
+        （vibrato.pyを参照。numpyが必要）
+        ノートの選択とビブラートの長さの計算は配列で一度に行う。
+        ビブラートはノートごとに別のVibratoになる。ビブラートの長さが
+        0になるノートは変更しない
+        Args:
+            preset: VibratoPresetインスタンス（Noneならビブラートを外す）
+            min_length, max_length: ノートの長さの範囲
+            low, high: ノートの音高の範囲
+            lyric: 歌詞全体がマッチする正規表現
+            track: トラック番号（省略時は操作対象トラック）
+
+        Returns:
+            変更したノートの数
+
+        Examples:
+            from vibrato import VibratoPreset, PRESETS
+            editor.set_vibrato(PRESETS['normal'], min_length=480)
+            editor.set_vibrato(VibratoPreset(depth=80, delay=240),
+                               min_length=720, low=60)
+        """
+        import vibrato
+        normal_track = (self.current_track if track is None
+                        else self.normal_tracks[track])
+        with self.stats.timer('set_vibrato'):
+            anotes = normal_track.anotes
+            indices, lengths = vibrato.select_notes(
+                anotes, min_length, max_length, low, high, lyric)
+            if preset is None:
+                indices = [i for i in indices if anotes[i].vibrato]
+                vibratos = [None] * len(indices)
+            else:
+                lengths = preset.lengths(lengths)
+                indices = indices[lengths > 0]
+                vibratos = preset.vibratos(lengths[lengths > 0])
+            for i, v in zip(indices, vibratos):
+                normal_track.writable_note(anotes[i]).vibrato = v
+        self.stats.count('vibrato_notes', len(indices))
+        return len(indices)
+
+    def extract(self, s, e, track=None):
+        """sからeまで（eを含まない）のノート、全てのカーブ、歌手変更を
+        クリップとして切り出す（clip.pyを参照）
+        Args:
+            s: 開始時間
+            e: 終了時間
+            track: トラック番号（省略時は操作対象トラック）
+
+        Returns:
+            Clipインスタンス
+        """
+        import clip
+        normal_track = (self.current_track if track is None
+                        else self.normal_tracks[track])
+        with self.stats.timer('extract'):
+            return clip.Clip.extract(normal_track, s, e,
+                                     self.header.data['time_div'])
+
+    def paste(self, clip, at, track=None):
+        """クリップを時間atから貼り付ける
+        atからクリップの長さ分のノート、カーブ、歌手変更をクリップの
+        内容で置き換える。ノートと歌手変更は一度の連結で、
+        カーブはカーブごとに一度のマージで反映する（batch内ならまとめる）。
+        貼り付け先にないカーブは貼り付けない
+        Args:
+            clip: extractで切り出したClipインスタンス
+            at: 貼り付ける時間
+            track: トラック番号（省略時は操作対象トラック）
+        """
+        from clip import splice_singers
+        if clip.time_div != self.header.data['time_div']:
+            raise ValueError("time division differs: %d != %d" % (
+                clip.time_div, self.header.data['time_div']))
+        current = self.current_track
+        if track is not None:
+            self.current_track = self.normal_tracks[track]
+        try:
+            with self.stats.timer('paste'):
+                normal_track = self.current_track
+                e = at + clip.length
+                for ptype in clip.curves:
+                    bp = normal_track.data.get(ptype)
+                    if bp is None:
+                        continue
+                    s, end, times, values = clip.curve_edit(ptype, at)
+                    #範囲の直後に点がなければ、範囲の後の値を保つ点を加える
+                    i, j = bp.index_range(e, e)
+                    hold = i == j and bp.index_range(None, end)[1] > 0
+                    self.__edit_param_curve(ptype, s, end, times, values,
+                                            hold)
+                normal_track.splice_notes(at, e, clip.placed_anotes(at))
+                normal_track.singers = splice_singers(
+                    normal_track.singers, at, e, clip.placed_singers(at))
+        finally:
+            self.current_track = current
+        if normal_track.anotes:
+            self.end_time = max(self.end_time, normal_track.anotes[-1].end)
+        self.stats.count('pastes')
+
+    def insert_time(self, t, length):
+        """時間tに長さlengthの時間を挿入する（全てのトラックとテンポ・拍子）
+        t以降のノート、カーブの点、テンポ・拍子イベントがlengthだけ後ろにずれ、
+        tをまたぐノートは伸びる。ノートとカーブの点は各トラックで
+        次に読むとき（unparseを含む）にまとめてずらすので、
+        挿入・削除を続けて行ってもノートや点の数に比例する手間はかからない。
+        拍子を保つには小節単位で指定する。
+        ルールを元に戻すための情報は破棄されるので、候補は取得し直すこと
+        Args:
+            t: 挿入する時間（シーケンスの始端時間以降）
+            length: 挿入する長さ
+
+        Examples:
+            #5小節目の頭に（最初の拍子の）1小節を挿入する
+            t = editor.tempo_map.bar_to_tick(4)
+            editor.insert_time(t, editor.tempo_map.bar_length(0))
+        """
+        from timemap import TimeMap
+        if length <= 0:
+            return
+        self.__shift_time(t, TimeMap().insert(t, length),
+                          lambda track: track.insert_time(t, length))
+
+    def delete_time(self, s, e):
+        """時間sからeまで（eを含まない）を削除する（全てのトラックとテンポ・拍子）
+        e以降はe-sだけ前にずれる。範囲内のノートは削除され、範囲にかかる
+        ノートは短くなる。範囲内のカーブの値とテンポ・拍子は、範囲の後に
+        続くものがsから始まる（insert_timeを参照）
+        Args:
+            s: 削除する範囲の開始時間（シーケンスの始端時間以降）
+            e: 削除する範囲の終了時間
+        """
+        from timemap import TimeMap
+        if e <= s:
+            return
+        self.__shift_time(s, TimeMap().delete(s, e),
+                          lambda track: track.delete_time(s, e))
+
+    def __shift_time(self, t, time_map, shift_track):
+        if t < self.start_time:
+            raise ValueError("cannot shift time before the pre-measure")
+        for track in self.normal_tracks:
+            shift_track(track)
+        #マスタートラックはforkしたエディタと共有しているので置き換える
+        from tempomap import TempoMap
+        self.master_track = self.master_track.shifted(time_map)
+        self.tempo_map = TempoMap.from_master_track(
+            self.master_track, self.header.data['time_div'])
+        self.end_time = max(self.start_time, time_map.map_end(self.end_time))
+        self.stats.count('time_shifts')
+
+
+def _merge_ranges(ranges):
+    """重なる時間範囲をまとめる
+    Args:
+        ranges: (s, e)のリスト
+
+    Returns:
+        まとめた(s, e)のリスト（時間順）
+    """
+    merged = []
+    for s, e in sorted(ranges):
+        if merged and s <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(e, merged[-1][1]))
+        else:
+            merged.append((s, e))
+    return merged
+
+
+def diff(a, b):
+    """2つのVSQファイルの差分を求める（vsqdiff.diffを参照）"""
+    import vsqdiff
+    return vsqdiff.diff(a, b)
+
+
+def probe(path, cache=None):
+    """VSQファイルのメタ情報を読む（probe.probeを参照）"""
+    import probe as probe_module
+    return probe_module.probe(path, cache)
+
+
+def probe_dir(directory, cache=None, threads=8):
+    """ディレクトリ以下のVSQファイルのメタ情報を読む
+    （probe.probe_dirを参照）
+    """
+    import probe as probe_module
+    return probe_module.probe_dir(directory, cache, threads)
+
+
+def ProbeCache(filename=None):
+    """probeの結果のキャッシュを作る（probe.ProbeCacheを参照）"""
+    import probe as probe_module
+    return probe_module.ProbeCache(filename)
+
+
+def _track_worker(job):
+    """1トラック分のルール適用候補の取得と適用を行う
+    プロセスプールのワーカーから呼ばれる
+    Args:
+        job: (1トラックのみを持つVSQEditor, トラック番号, ルール定義のリスト,
+              適用するかどうか, 適用する候補IDの集合)
+
+    Returns:
+        (トラック番号, 処理後のトラック, ルール適用候補のリスト)
+    """
+    editor, n, rules, apply, ids = job
+    cands = editor.get_rule_cands(*rules)
+    if apply:
+        with editor.batch():
+            for c in cands:
+                if ids is None or c['id'] in ids:
+                    editor.apply_rule(c)
+    return n, editor.current_track, cands
+
 
 '''
 テストコード:
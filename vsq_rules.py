@@ -3,11 +3,14 @@
 とりあえずルール記述しておく領域
 将来的にはDBにルールを格納するだろうけど
 現時点の仕様
-・各パラメータをディクショナリで定義
-・クラス化したほうがいい気もするのだけど、
-　メソッドが思いつかないので…
+・各パラメータをRuleクラスのコンストラクタに渡して定義
+・ディクショナリで定義したルールもRule.compileでRuleに変換できる
+・Ruleは正規表現をコンパイルして保持し、カーブはarrayで持つ
+・ノートの長さに合わせて伸縮したカーブはRuleごとにメモ化される
+・カーブの定義はリスト（pickleできるデータ）のまま持ち、arrayへの変換は
+  最初に使われたときに行う
 
-以下ディクショナリの要素について
+以下各要素について
 rule_id:
     ルールID,重複しないように注意する必要がある。
     DBを使うようになれば問題ないのだが。
@@ -20,6 +23,8 @@ regexp:
     正規表現。適用する際のカーブをマッチする
     モーラ数分用意しなくてはならないので、
     *や?を使われると困る。
+    contourを指定した場合はNoneにでき、その場合は
+    音程差のパターンだけで適用対象を探す。
 
 connect:
     正規表現にマッチした部分の音符が接続されていることを
@@ -35,6 +40,15 @@ relative_notes:
     相対音程もマッチするところにしかルールが適用されない。
     相対音程を考慮したくない場合はNoneを記述する。
 
+contour:
+    隣り合うノートの音程差の条件のリスト（contour.pyのContourIndexを参照）。
+    各要素は音程差そのもの、(下限, 上限)、または任意を表すNone。
+    マッチした部分のノートの音程差がこの条件を満たすところにしか
+    ルールが適用されない（ノートの数はlen(contour) + 1となる）。
+    例えば5半音以上上がった後に1〜2半音下がる部分は
+    [(5, None), (-2, -1)]となる。
+    考慮したくない場合はNoneを記述する。
+
 dyn_curves:
 pit_curves:
     マッチした部分にルールを適用する際の、適用後
@@ -55,9 +69,17 @@ accent:
 	何も変更したくない場合はNoneを記載する。
 		
 """
+import re
+from array import array
+import tools
 
 
 def curve(curvelist, stretch=None):
+    """カーブを定義する
+    Args:
+        curvelist: カーブを表すリスト
+        stretch: 曲線の伸縮オプション
+    """
     return {"curve": curvelist, "stretch": stretch}
 
 
@@ -73,62 +95,201 @@ def lowpass(l_value, h_value, ratio, stretch=None):
     length = 1000
     p = int(ratio * length)
     d = (h_value - l_value) / 100.0
-    c = [h_value for v in range(p)]
-    c += [int(h_value - d * i) for i in range(100)]
-    c += [l_value for v in range(1000 - 100 - p)]
+    c = [h_value] * p
+    c += [int(h_value - d * i) for i in xrange(100)]
+    c += [l_value] * (length - 100 - p)
     return curve(c, stretch)
 
+
+def rescale(curvelist, length):
+    """カーブをlength時間分に伸縮する
+    同じ時間に複数の値が割り当てられる場合は先頭の値のみを使う
+    Args:
+        curvelist: カーブを表すリスト
+        length: 伸縮後の長さ
+
+    Returns:
+        offsets: 伸縮後の各点の相対時間のリスト
+        values: 伸縮後の各点の値のリスト
+    """
+    len_ratio = float(length) / len(curvelist)
+    offsets = []
+    values = []
+    prev = None
+    for i, v in enumerate(curvelist):
+        t = int(len_ratio * i)
+        if t != prev:
+            offsets.append(t)
+            values.append(v)
+            prev = t
+    return offsets, values
+
+
+class Rule(object):
+    """ルールを扱うクラス
+    正規表現はコンパイル済みのものを、カーブはarrayで保持する。
+    ノートの長さに合わせて伸縮したカーブはLRUでメモ化しておき、
+    同じ長さのノートに適用する際は再計算しない。
+    旧来のディクショナリ形式のルールと同じように
+    rule['name'] のようにもアクセスできる
+
+    Attributes:
+        rule_id, name, regexp, connect, relative_notes, contour,
+        dyn_curves, pit_curves, portamento, accent:
+            モジュールのdocstringを参照
+        rxp: コンパイル済みの正規表現（regexpがNoneならNone）
+    """
+    contour = None
+    _memo = None
+    _memo_size = 64
+
+    def __init__(self, rule_id, name, regexp, connect=False,
+            relative_notes=None, dyn_curves=[], pit_curves=[],
+            portamento=None, accent=None, memo_size=64, contour=None):
+        self.rule_id = rule_id
+        self.name = name
+        self.regexp = regexp
+        self.rxp = re.compile(regexp) if regexp is not None else None
+        self.contour = contour
+        self.connect = connect
+        self.relative_notes = relative_notes
+        self._curve_defs = {"dyn": dyn_curves, "pit": pit_curves}
+        self._curves = {}
+        self.portamento = portamento
+        self.accent = accent
+        #メモは最初に伸縮するときに作る
+        self._memo_size = memo_size
+
+    @classmethod
+    def compile(cls, rule):
+        """ディクショナリで定義されたルールをRuleに変換する
+        Args:
+            rule: ルール定義（ディクショナリ）またはRuleインスタンス
+
+        Returns:
+            Ruleインスタンス
+        """
+        if isinstance(rule, cls):
+            return rule
+        return cls(**rule)
+
+    def __compile_curve(self, c):
+        return {"curve": array('i', c['curve']), "stretch": c['stretch']}
+
+    def __curves(self, ptype):
+        #カーブは最初に使われたときにarrayにする
+        if not ptype in self._curves:
+            self._curves[ptype] = [self.__compile_curve(c)
+                                   for c in self._curve_defs[ptype]]
+        return self._curves[ptype]
+
+    @property
+    def dyn_curves(self):
+        return self.__curves("dyn")
+
+    @property
+    def pit_curves(self):
+        return self.__curves("pit")
+
+    def __getstate__(self):
+        #ワーカーで変換し直さないように、arrayにしてからpickleする
+        state = self.__dict__.copy()
+        state['_curves'] = {"dyn": self.dyn_curves, "pit": self.pit_curves}
+        state['_curve_defs'] = None
+        return state
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __repr__(self):
+        return "<Rule %s>" % self.rule_id
+
+    def resampled(self, ptype, i, length, tolerance=None):
+        """i番目のノートに割り当てるカーブをlength時間分に伸縮したものを取得する
+        Args:
+            ptype: "dyn"（ダイナミクス）または"pit"（ピッチベンド）
+            i: マッチしたノートのインデックス
+            length: 伸縮後の長さ
+            tolerance: 指定すると、値の誤差がtolerance以下になる範囲で
+                点を間引く（bplist.simplifyを参照）
+
+        Returns:
+            offsets: 伸縮後の各点の相対時間（array）
+            values: 伸縮後の各点の値（array）
+        """
+        if self._memo is None:
+            self._memo = tools.LRUCache(self._memo_size)
+        key = (ptype, i, length, tolerance)
+        scaled = self._memo.get(key)
+        if scaled is None:
+            c = getattr(self, ptype + '_curves')[i]['curve']
+            offsets, values = rescale(c, length)
+            if tolerance is None:
+                scaled = (array('i', offsets), array('i', values))
+            else:
+                from bplist import simplify
+                scaled = simplify(offsets, values, tolerance)
+            self._memo.set(key, scaled)
+        return scaled
+
+    def apply(self, editor):
+        """エディタの操作対象トラックにルールを適用する
+        Args:
+            editor: VSQEditorインスタンス
+
+        Returns:
+            適用したルール適用候補のリスト
+        """
+        cands = editor.get_rule_cands(self)
+        for rule_i in cands:
+            editor.apply_rule(rule_i)
+        return cands
+
+
 dyn_curves = [linear(0,100),
               curve(range(30,0,-1)+range(0,100)),
               linear(100,0)]
 
-san_rule = {"rule_id":"R0",
-        "name":"さんの前のdynを下げる",
-        "regexp":u".さn",
-        "connect":True,
-        "relative_notes":None,
-        "dyn_curves":dyn_curves,
-        "pit_curves":[],
-        "portamento":None,
-        "accent":None}
+san_rule = Rule(rule_id="R0",
+        name="さんの前のdynを下げる",
+        regexp=u".さn",
+        connect=True,
+        relative_notes=None,
+        dyn_curves=dyn_curves,
+        pit_curves=[],
+        portamento=None,
+        accent=None)
 
 zuii_dyn_curves = [lowpass(0,100,0.8)]
 zuii_pit_curves = [lowpass(-10000,0,0.8)]
 
 
-zuii_rule = {"rule_id":"R1",
-        "name":"ずぃの最後を下げる",
-        "connect":False,
-        "regexp":u"ずぃ",
-        "relative_notes":None,
-        "dyn_curves":zuii_dyn_curves,
-        "pit_curves":zuii_pit_curves,
-        "portamento":None,
-        "accent":None}
-
-port_rule = {"rule_id":"R3",
-        "name":"ああにポルタメントを付加する",
-        "connect":True,
-        "regexp":u"ああ",
-        "relative_notes":None,
-        "portamento":2,
-        "accent":None,
-        "dyn_curves":[],
-        "pit_curves":[]}
-        
-n_accent_rule = {"rule_id":"R4",
-		"name":"んのアクセントを0にする",
-		"connect":False,
-		"regexp":u"ん",
-		"relative_notes":None,
-		"portamento":None,
-		"accent":0,
-		"dyn_curves":[],
-		"pit_curves":[]}
+zuii_rule = Rule(rule_id="R1",
+        name="ずぃの最後を下げる",
+        connect=False,
+        regexp=u"ずぃ",
+        relative_notes=None,
+        dyn_curves=zuii_dyn_curves,
+        pit_curves=zuii_pit_curves,
+        portamento=None,
+        accent=None)
 
-class Rule(object):
-    def __init__(self):
-        pass
+port_rule = Rule(rule_id="R3",
+        name="ああにポルタメントを付加する",
+        connect=True,
+        regexp=u"ああ",
+        relative_notes=None,
+        portamento=2,
+        accent=None,
+        dyn_curves=[],
+        pit_curves=[])
 
-    def apply(self, editor):
-        pass
+n_accent_rule = Rule(rule_id="R4",
+        name="んのアクセントを0にする",
+        connect=False,
+        regexp=u"ん",
+        relative_notes=None,
+        portamento=None,
+        accent=0,
+        dyn_curves=[],
+        pit_curves=[])
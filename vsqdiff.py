@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""2つのVSQファイルの構造上の差分を求めるモジュール
+同じ番号のトラック同士で、ノートと各パラメータカーブを時間順に
+突き合わせ（O(n + m)）、変更点を報告する
+
+使い方:
+    python vsqdiff.py old.vsq new.vsq   # 差分があれば終了コード1
+
+Examples:
+    result = diff(VSQEditor('old.vsq'), VSQEditor('new.vsq'))
+    result['tracks'][0]['notes']['changed']
+    => [{"start": 1920, "changes": {"lyric": (u"あ", u"い")}}]
+    result['tracks'][0]['curves']['PitchBendBPList']
+    => [(1920, 2400), (3000, None)]    # Noneは最後まで異なる
+"""
+import re
+import sys
+from collections import deque
+
+bprxp = re.compile('.+BPList')
+
+
+def diff(a, b):
+    """2つのVSQファイルの差分を求める
+    Args:
+        a: 変更前のVSQEditorインスタンスまたはVSQファイルのパス
+        b: 変更後のVSQEditorインスタンスまたはVSQファイルのパス
+
+    Returns:
+        {"tracks": [{"track": トラック番号,
+                     "notes": diff_notesの結果,
+                     "curves": {カーブ名: diff_curveの結果}}, ...],
+         "added_tracks": bにだけあるトラック番号のリスト,
+         "removed_tracks": aにだけあるトラック番号のリスト}
+        差分のないトラック・カーブは含まれない
+    """
+    a = _editor(a)
+    b = _editor(b)
+    result = {"tracks": [], "added_tracks": [], "removed_tracks": []}
+    count = min(len(a.normal_tracks), len(b.normal_tracks))
+    for i in range(count):
+        ta = a.normal_tracks[i]
+        tb = b.normal_tracks[i]
+        track = {"track": i, "notes": diff_notes(ta.anotes, tb.anotes),
+                 "curves": {}}
+        tags = set(tag for tag in ta.data.keys() + tb.data.keys()
+                   if bprxp.match(tag))
+        for tag in sorted(tags):
+            spans = diff_curve(ta.data.get(tag), tb.data.get(tag))
+            if spans:
+                track["curves"][tag] = spans
+        if track["curves"] or any(track["notes"].values()):
+            result["tracks"].append(track)
+    result["removed_tracks"] = range(count, len(a.normal_tracks))
+    result["added_tracks"] = range(count, len(b.normal_tracks))
+    return result
+
+
+def diff_notes(a, b):
+    """2つのAnoteListの差分を求める
+    同じ開始時間のノート同士を変更として対応付け、
+    対応しなかったノートのうち歌詞・音高・長さが同じものを移動とする
+    Args:
+        a: 変更前のAnoteList
+        b: 変更後のAnoteList
+
+    Returns:
+        {"added": 追加されたノートのリスト,
+         "removed": 削除されたノートのリスト,
+         "moved": [{"from": 変更前の開始時間, "to": 変更後の開始時間,
+                    "note": 音高, "lyric": 歌詞, "length": 長さ}, ...],
+         "changed": [{"start": 開始時間,
+                      "changes": {項目名: (変更前, 変更後)}}, ...]}
+        ノートは{"start", "length", "note", "lyric"}のディクショナリ
+    """
+    added = []
+    removed = []
+    changed = []
+    i = j = 0
+    n = len(a)
+    m = len(b)
+    while i < n or j < m:
+        if j >= m or (i < n and a[i].start < b[j].start):
+            removed.append(a[i])
+            i += 1
+        elif i >= n or b[j].start < a[i].start:
+            added.append(b[j])
+            j += 1
+        else:
+            #同じ開始時間のノートは順番に対応付ける
+            start = a[i].start
+            while i < n and j < m and a[i].start == start == b[j].start:
+                changes = _note_changes(a[i], b[j])
+                if changes:
+                    changed.append({"start": start, "changes": changes})
+                i += 1
+                j += 1
+
+    #歌詞・音高・長さが同じノートは移動とする
+    sources = {}
+    for anote in removed:
+        sources.setdefault(_move_key(anote), deque()).append(anote)
+    moved = []
+    moved_ids = set()
+    still_added = []
+    for anote in added:
+        candidates = sources.get(_move_key(anote))
+        if candidates:
+            source = candidates.popleft()
+            moved_ids.add(id(source))
+            moved.append({"from": source.start, "to": anote.start,
+                          "note": anote.note, "lyric": anote.lyric,
+                          "length": anote.length})
+        else:
+            still_added.append(anote)
+
+    return {"added": [_note_dict(x) for x in still_added],
+            "removed": [_note_dict(x) for x in removed
+                        if not id(x) in moved_ids],
+            "moved": moved,
+            "changed": changed}
+
+
+def diff_curve(a, b):
+    """2つのパラメータカーブの値が異なる時間範囲を求める
+    各カーブは点の時間から次の点の時間まで値が続くものとして比較するので、
+    値の変わらない点の有無は差分にならない
+    Args:
+        a: 変更前のBPList（Noneなら点なし）
+        b: 変更後のBPList（Noneなら点なし）
+
+    Returns:
+        (開始時間, 終了時間)のリスト
+        終了時間は値が再び一致する時間（その時間を含まない）、
+        最後まで異なる場合はNone
+    """
+    ta, va = (a.times, a.values) if a is not None else ([], [])
+    tb, vb = (b.times, b.values) if b is not None else ([], [])
+    if ta == tb and va == vb:
+        return []
+
+    spans = []
+    start = None
+    cur_a = cur_b = None
+    i = j = 0
+    n = len(ta)
+    m = len(tb)
+    while i < n or j < m:
+        #同じ時間の点をまとめて進める
+        if j >= m or (i < n and ta[i] <= tb[j]):
+            t = ta[i]
+        else:
+            t = tb[j]
+        while i < n and ta[i] == t:
+            cur_a = va[i]
+            i += 1
+        while j < m and tb[j] == t:
+            cur_b = vb[j]
+            j += 1
+        if cur_a != cur_b:
+            if start is None:
+                start = t
+        elif start is not None:
+            spans.append((start, t))
+            start = None
+    if start is not None:
+        spans.append((start, None))
+    return spans
+
+
+def _editor(x):
+    if isinstance(x, basestring):
+        from vsq import VSQEditor
+        return VSQEditor(filename=x)
+    return x
+
+
+def _note_changes(a, b):
+    #同じ開始時間のノートの変更点
+    changes = {}
+    for name in ('note', 'length', 'lyric'):
+        if getattr(a, name) != getattr(b, name):
+            changes[name] = (getattr(a, name), getattr(b, name))
+    #プロパティはunparse後に文字列になるので文字列として比較する
+    for key in set(a.prop.keys() + b.prop.keys()):
+        va = a.prop.get(key)
+        vb = b.prop.get(key)
+        if (None if va is None else str(va)) != \
+           (None if vb is None else str(vb)):
+            changes[key] = (va, vb)
+    if (a.vibrato or None) != (b.vibrato or None):
+        changes['vibrato'] = (a.vibrato, b.vibrato)
+    return changes
+
+
+def _move_key(anote):
+    return (anote.lyric, anote.note, anote.length)
+
+
+def _note_dict(anote):
+    return {"start": anote.start, "length": anote.length,
+            "note": anote.note, "lyric": anote.lyric}
+
+
+def _report(result, out=sys.stdout):
+    #差分を1行ずつ表示する
+    for track in result["tracks"]:
+        prefix = "track %d: " % track["track"]
+        notes = track["notes"]
+        for x in notes["removed"]:
+            out.write(prefix + "- note %(start)d %(note)d %(length)d " % x +
+                      x["lyric"].encode('utf-8') + "\n")
+        for x in notes["added"]:
+            out.write(prefix + "+ note %(start)d %(note)d %(length)d " % x +
+                      x["lyric"].encode('utf-8') + "\n")
+        for x in notes["moved"]:
+            out.write(prefix + "> note %(from)d -> %(to)d " % x +
+                      x["lyric"].encode('utf-8') + "\n")
+        for x in notes["changed"]:
+            for key, (va, vb) in sorted(x["changes"].items()):
+                out.write(prefix + "~ note %d %s: %s -> %s\n" % (
+                    x["start"], key, _text(va), _text(vb)))
+        for tag, spans in sorted(track["curves"].items()):
+            out.write(prefix + "~ %s %s\n" % (tag, " ".join(
+                "%d-%s" % (s, "" if e is None else e) for s, e in spans)))
+    for n in result["removed_tracks"]:
+        out.write("- track %d\n" % n)
+    for n in result["added_tracks"]:
+        out.write("+ track %d\n" % n)
+
+
+def _text(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.stderr.write("usage: python vsqdiff.py old.vsq new.vsq\n")
+        sys.exit(2)
+    result = diff(sys.argv[1], sys.argv[2])
+    _report(result)
+    sys.exit(1 if result["tracks"] or result["added_tracks"] or
+             result["removed_tracks"] else 0)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""ベンチマーク用のVSQファイルを生成するモジュール
+同じ引数（seedを含む）からは常に同じファイルが生成される
+
+使い方:
+    python vsqgen.py out.vsq --notes 2000 --tracks 2
+"""
+import random
+import tools
+from struct import *
+
+#歌詞の種類ごとの候補
+KANA = list(u"あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほ"
+            u"まみむめもやゆよらりるれろわをんがぎぐげござじずぜぞだでどばびぶべぼ"
+            u"ぱぴぷぺぽ")
+YOUON = [u"きゃ", u"しゅ", u"ちょ", u"にゃ", u"ひゅ", u"みょ", u"りゃ",
+         u"ぎゅ", u"じょ", u"びゃ", u"ずぃ", u"てぃ"]
+PROLONG = [u"ー"]
+ROMAJI = [u"a", u"ka", u"sa", u"ta", u"na", u"ha", u"ma", u"ya", u"ra",
+          u"wa", u"n"]
+#vsq_rules.pyのルールにマッチする歌詞の並び
+RULE_PHRASES = [[u"ずぃ"], [u"あ", u"あ"], [u"ん"], [u"か", u"さ", u"n"]]
+
+#歌詞の種類の既定の混ぜ具合
+LYRIC_MIX = {"kana": 0.8, "youon": 0.07, "prolong": 0.03,
+             "romaji": 0.03, "rule": 0.07}
+
+NOTE_LENGTHS = [120, 240, 240, 360, 480, 480, 960]
+TIME_DIV = 480
+PRE_MEASURE = 4
+
+
+def generate(notes=1000, bp_density=16, tracks=1, vibrato=0.2,
+        lyric_mix=None, seed=0):
+    """VSQファイルのバイナリを生成する
+    Args:
+        notes: 1トラックあたりのノート数
+        bp_density: 4分音符あたりのピッチベンド・ダイナミクスの点数
+        tracks: ノーマルトラック数
+        vibrato: ビブラートを付けるノートの割合
+        lyric_mix: 歌詞の種類（LYRIC_MIXのキー）ごとの割合
+        seed: 乱数のシード
+
+    Returns:
+        VSQファイルのバイナリ
+    """
+    rand = random.Random(seed)
+    mix = lyric_mix or LYRIC_MIX
+    binary = pack(">4si3h", "MThd", 6, 1, tracks + 1, TIME_DIV)
+    binary += _master_track()
+    for n in range(tracks):
+        text = _track_text(rand, n, tracks, notes, bp_density, vibrato, mix)
+        binary += _track_chunk("Voice%d" % (n + 1), text)
+    return binary
+
+
+def write(filename, **kwargs):
+    """VSQファイルを生成して書き込む
+    Args:
+        filename: 書き込むVSQファイルのパス
+        kwargs: generateの引数
+    """
+    open(filename, 'wb').write(generate(**kwargs))
+
+
+def _master_track():
+    events = [(0x03, "Master Track"),
+              (0x51, pack('>I', 500000)[1:]),  # 120BPM
+              (0x58, pack('4b', 4, 2, 24, 8)),  # 4/4拍子
+              (0x2f, "")]
+    body = ''.join([tools.dtime2binary(0) + pack('cBB', '\xff', t, len(d)) + d
+                    for t, d in events])
+    return pack('>4sI', 'MTrk', len(body)) + body
+
+
+def _track_chunk(name, text):
+    body = (pack('4B', 0x00, 0xff, 0x03, len(name)) + name +
+            tools.text2events(text) + '\x00\xff\x2f\x00')
+    return pack('>4sI', 'MTrk', len(body)) + body
+
+
+def _lyrics(rand, count, mix):
+    kinds = sorted(mix.keys())
+    total = float(sum(mix.values()))
+    lyrics = []
+    while len(lyrics) < count:
+        r = rand.random() * total
+        for kind in kinds:
+            r -= mix[kind]
+            if r < 0:
+                break
+        if kind == "rule":
+            lyrics.extend(rand.choice(RULE_PHRASES))
+        else:
+            table = {"kana": KANA, "youon": YOUON,
+                     "prolong": PROLONG, "romaji": ROMAJI}[kind]
+            lyrics.append(rand.choice(table))
+    return lyrics[:count]
+
+
+def _track_text(rand, n, tracks, notes, bp_density, vibrato, mix):
+    start = 4 * PRE_MEASURE * TIME_DIV
+    lines = ["[Common]", "Version=DSB301", "Name=Voice%d" % (n + 1),
+             "Color=181,162,123", "DynamicsMode=1", "PlayMode=1",
+             "[Master]", "PreMeasure=%d" % PRE_MEASURE,
+             "[Mixer]", "MasterFeder=0", "MasterPanpot=0", "MasterMute=0",
+             "OutputMode=0", "Tracks=%d" % tracks]
+    for i in range(tracks):
+        lines += ["Feder%d=0" % i, "Panpot%d=0" % i,
+                  "Mute%d=0" % i, "Solo%d=0" % i]
+
+    #ノートの生成
+    time = start
+    note = 67
+    anotes = []
+    for lyric in _lyrics(rand, notes, mix):
+        length = rand.choice(NOTE_LENGTHS)
+        note = max(48, min(84, note + rand.choice([-5, -2, -1, 0, 1, 2, 4])))
+        vib = length >= 240 and rand.random() < vibrato
+        anotes.append((time, length, note, lyric, vib))
+        time += length + (rand.choice([0, 0, 0, 120]))
+    end = time
+
+    #イベントリストとイベント、詳細イベント
+    events = ["[EventList]", "0=ID#0000"]
+    ids = ["[ID#0000]", "Type=Singer", "IconHandle=h#0000"]
+    details = ["[h#0000]", "IconID=$07010000", "IDS=Miku", "Original=0",
+               "Caption=", "Length=1", "Language=0", "Program=0"]
+    handle = 1
+    for i, (time, length, note, lyric, vib) in enumerate(anotes):
+        events.append("%d=ID#%04d" % (time, i + 1))
+        ids += ["[ID#%04d]" % (i + 1), "Type=Anote", "Length=%d" % length,
+                "Note#=%d" % note, "Dynamics=64", "PMBendDepth=8",
+                "PMBendLength=0", "PMbPortamentoUse=0", "DEMdecGainRate=50",
+                "DEMaccent=50", "LyricHandle=h#%04d" % handle]
+        phonetic = tools.lyric2phonetic(lyric)
+        ca = ",".join([str(0 if p in "aiMeo" else 64)
+                       for p in phonetic.split(" ")])
+        details += ["[h#%04d]" % handle,
+                    'L0="%s","%s",0.000000,%s,0' % (
+                        lyric.encode('shift-jis'), str(phonetic), ca)]
+        handle += 1
+        if vib:
+            vlen = length * 2 / 3
+            ids += ["VibratoHandle=h#%04d" % handle,
+                    "VibratoDelay=%d" % (length - vlen)]
+            details += ["[h#%04d]" % handle, "IconID=$04040001",
+                        "IDS=normal", "Original=1",
+                        "Caption=[Normal] Type 1", "Length=%d" % vlen,
+                        "StartDepth=64", "DepthBPNum=3",
+                        "DepthBPX=0.500000,0.750000,1.000000",
+                        "DepthBPY=64,80,100", "StartRate=50",
+                        "RateBPNum=2", "RateBPX=0.500000,1.000000",
+                        "RateBPY=50,70"]
+            handle += 1
+    events.append("%d=EOS" % (end + TIME_DIV))
+
+    #パラメータカーブ
+    step = max(1, TIME_DIV / bp_density)
+    pit = ["[PitchBendBPList]"]
+    dyn = ["[DynamicsBPList]"]
+    value_p = 0
+    value_d = 64
+    for t in xrange(start, end, step):
+        value_p = max(-8192, min(8191, value_p + rand.randint(-200, 200)))
+        value_d = max(0, min(127, value_d + rand.randint(-3, 3)))
+        pit.append("%d=%d" % (t, value_p))
+        dyn.append("%d=%d" % (t, value_d))
+    pbs = ["[PitchBendSensBPList]", "%d=2" % start]
+
+    lines += events + ids + details + pit + pbs + dyn
+    return "\n".join(lines) + "\n"
+
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [options] out.vsq")
+    parser.add_option("--notes", type="int", default=1000)
+    parser.add_option("--bp-density", type="int", default=16)
+    parser.add_option("--tracks", type="int", default=1)
+    parser.add_option("--vibrato", type="float", default=0.2)
+    parser.add_option("--seed", type="int", default=0)
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("output file is required")
+    write(args[0], notes=options.notes, bp_density=options.bp_density,
+          tracks=options.tracks, vibrato=options.vibrato, seed=options.seed)
@@ -0,0 +1,456 @@
+# -*- coding: utf-8 -*-
+"""VSQファイルをストリーミングで書き換えるモジュール
+VSQEditorはファイル全体をパースしてから書き換えるので、長いトラックでは
+テキスト情報やイベントのディクショナリでファイルサイズの何十倍もの
+メモリを使う。このモジュールはトラックチャンクごとにテキストイベントを
+1行ずつデコードし、書き換えた行をそのままテキストイベントとして書き出す
+
+1トラックにつき3回読む
+    1. 全トラックのノートを読んでシーケンスの終端時間を求める
+    2. トラックのノートを読んでルール適用候補と書き換えを求める
+       （カーブの点は求めない）
+    3. 行を書き換えながら書き出す。パラメータカーブは、範囲が重なる
+       書き換えの組（窓）ごとに、窓の中の点だけを読み溜めて書き換える
+
+メモリは1トラック分のノート（Anote）と1つの窓の点で抑えられ、
+カーブの点数やファイルサイズには比例しない。
+カーブの書き換え結果はVSQEditorのbatch内でapply_ruleした場合と同じになる。
+テキストの行はそのまま書き出すので、イベントの番号や項目の順序は元の
+ファイルのまま（VSQEditor.unparseのように振り直さない）。
+ルールのportamento, accentがNoneの場合はプロパティを書き換えない
+
+使い方:
+    python vsqstream.py in.vsq out.vsq   # vsq_rulesの全てのルールを適用
+
+Examples:
+    result = transform('in.vsq', 'out.vsq', [zuii_rule, san_rule])
+    result['tracks'] => {0: ['R0I1', 'R1I0']}   # 適用した候補ID
+    result['max_window'] => 12  # 窓に読み溜めた点の数の最大値
+"""
+import re
+import sys
+import tools
+from collections import deque
+from struct import *
+from anote import *
+from bplist import *
+from header import *
+from mastertrack import *
+from normaltrack import *
+from stats import NULL_STATS
+from tempomap import *
+from vsq_rules import Rule
+
+tagrxp = re.compile('\[.+\]')
+bprxp = re.compile('.+BPList')
+idrxp = re.compile('ID#[0-9]{4}')
+hrxp = re.compile('h#[0-9]{4}')
+
+#ルールが書き換えるパラメータカーブ
+PTYPES = ['DynamicsBPList', 'PitchBendBPList']
+
+
+class TrackReader(object):
+    """ノーマルトラックのチャンクを読むクラス
+    Attributes:
+        fp: vsqファイルポインタ
+        offset: チャンクの開始位置
+        size: チャンクのサイズ（ヘッダを除く）
+        name: トラック名（lines()で読んだ後に設定される）
+        cc_data: コントロールチェンジイベントのリスト（同上）
+        eot: End of Trackイベントのバイナリ（同上）
+    """
+    def __init__(self, fp):
+        """コンストラクタ
+        fpはノーマルトラックのところまでシークしておく必要がある
+        """
+        self.fp = fp
+        self.offset = fp.tell()
+        self.MTrk, self.size = unpack('>4si', fp.read(8))
+        self.name = ''
+        self.cc_data = []
+        self.eot = None
+
+    def skip(self):
+        """次のチャンクの先頭までシークする"""
+        self.fp.seek(self.offset + 8 + self.size)
+
+    def lines(self):
+        """テキスト情報を1行ずつ返すジェネレータ（行末の改行を含まない）
+        テキストイベントを読みながらデコードするので、
+        テキスト情報全体を読み込まない
+        """
+        fp = self.fp
+        fp.seek(self.offset + 8)
+        self.cc_data = []
+        rest = ''
+        while True:
+            dtime = tools.get_dtime(fp)
+            mevent = unpack('3B', fp.read(3))
+            if mevent[1] == 0x2f:
+                self.eot = tools.dtime2binary(dtime) + '\xff\x2f\x00'
+                break
+            #Control Changeイベント
+            if mevent[0] == 0xb0:
+                self.cc_data.append({'dtime': dtime, 'cc': mevent})
+            #TrackNameイベント
+            elif mevent[1] == 0x03:
+                self.name = fp.read(mevent[2])
+            #Textイベント
+            elif mevent[1] == 0x01:
+                text = fp.read(mevent[2])
+                lines = (rest + text[text.index(':', 3) + 1:]).split('\n')
+                rest = lines.pop()
+                for line in lines:
+                    yield line
+
+
+class TextWriter(object):
+    """テキスト情報をテキストイベントとして書き出すクラス
+    tools.text2eventsと同じように"DM:xxxx:"を付けて127byteに分割する
+    """
+    def __init__(self, out):
+        self.out = out
+        self.buf = ''
+        self.n = 0
+
+    def write(self, text):
+        self.buf += text
+        while len(self.buf) >= 127 - len(self.__prefix()):
+            self.__frame()
+
+    def close(self):
+        if self.buf:
+            self.__frame()
+
+    def __prefix(self):
+        return "DM:%04d:" % self.n
+
+    def __frame(self):
+        prefix = self.__prefix()
+        frame = self.buf[:127 - len(prefix)]
+        self.out.write(pack("4B", 0x00, 0xff, 0x01,
+                            len(prefix) + len(frame)))
+        self.out.write(prefix + frame)
+        self.buf = self.buf[len(frame):]
+        self.n += 1
+
+
+class CurveWindow(object):
+    """パラメータカーブの点を時間順に受け取り、書き換えて返すクラス
+    範囲が重なる書き換えの組（窓）ごとに、窓の範囲の元の点と
+    その直前の元の点だけを読み溜め、BPList.apply_editsで書き換える
+    Attributes:
+        clusters: (開始時間, 終了時間, 書き換えのリスト)のdeque
+            （clusters関数を参照）
+        max_window: 読み溜めた点の数の最大値
+    """
+    def __init__(self, clusters):
+        self.clusters = deque(clusters)
+        self.window = []
+        self.before = None
+        self.last = None
+        self.max_window = 0
+
+    def feed(self, t, v):
+        """元の点を渡す
+        Returns:
+            書き出す(時間, 値)のリスト
+        """
+        out = []
+        while self.clusters and t > self.clusters[0][1]:
+            out.extend(self.__flush())
+        if self.clusters and t >= self.clusters[0][0]:
+            if not self.window:
+                self.before = self.last
+            self.window.append((t, v))
+        else:
+            out.append((t, v))
+        self.last = (t, v)
+        return out
+
+    def finish(self):
+        """残りの窓を書き換える
+        Returns:
+            書き出す(時間, 値)のリスト
+        """
+        out = []
+        while self.clusters:
+            out.extend(self.__flush())
+        return out
+
+    def __flush(self):
+        lo, hi, edits = self.clusters.popleft()
+        #範囲外の元の値を参照するので、窓の直前の点も含める
+        before = self.before if self.window else self.last
+        points = ([before] if before is not None else []) + self.window
+        self.max_window = max(self.max_window, len(points))
+        self.window = []
+        bp = BPList.from_arrays([t for t, v in points],
+                                [v for t, v in points])
+        resolved = []
+        for s, e, get_points in edits:
+            offsets, values = get_points()
+            resolved.append((s, e, [s + t for t in offsets], values, True))
+        bp.apply_edits(resolved)
+        return zip(bp.times, bp.values)[1 if before is not None else 0:]
+
+
+def clusters(edits):
+    """カーブの書き換えを範囲が重なる組にまとめる
+    （BPList.apply_editsと同じまとめ方。holdするのでe+1まで含める）
+    Args:
+        edits: (s, e, 点を求める関数)のリスト（指定順に反映される）
+
+    Returns:
+        (開始時間, 終了時間, 書き換えのリスト)のリスト（開始時間の昇順）
+    """
+    order = sorted(range(len(edits)), key=lambda n: edits[n][0])
+    result = []
+    for n in order:
+        lo, hi = edits[n][0], edits[n][1] + 1
+        if result and lo <= result[-1][1]:
+            result[-1][1] = max(hi, result[-1][1])
+            result[-1][2].append(n)
+        else:
+            result.append([lo, hi, [n]])
+    return [(lo, hi, [edits[n] for n in sorted(members)])
+            for lo, hi, members in result]
+
+
+def read_notes(reader):
+    """トラックのノートを読む（パラメータカーブは読み飛ばす）
+    Args:
+        reader: TrackReaderインスタンス
+
+    Returns:
+        (Masterタグの情報, AnoteList, Anoteのidをキーとしイベント番号を
+         値とするディクショナリ)
+    """
+    master = {}
+    events = {}
+    lyrics = {}
+    tag = ''
+    for line in reader.lines():
+        if tagrxp.match(line):
+            tag = line[1:-1]
+        elif bprxp.match(tag):
+            continue
+        elif tag == 'Master':
+            key, value = line.split('=')
+            master[key] = value
+        elif tag == 'EventList':
+            time, event_id = line.split('=')
+            events[event_id] = {'time': time}
+        elif idrxp.match(tag):
+            key, value = line.split('=')
+            events[tag][key] = value
+        elif hrxp.match(tag):
+            key, value = line.split('=', 1)
+            if key == 'L0':
+                lyrics[tag] = unicode(value.split(',')[0][1:-1], "shift-jis")
+
+    anotes = AnoteList()
+    ids = {}
+    for event_id, e in events.items():
+        if e.get('Type') != 'Anote':
+            continue
+        anote = Anote(int(e['time']), int(e['Note#']),
+                      lyrics[e['LyricHandle']], int(e['Length']), prop={})
+        anotes.append(anote)
+        ids[id(anote)] = event_id
+    anotes.sort(key=lambda x: x.start)
+    return master, anotes, ids
+
+
+def transform(src, dst, rules, select=None, curves=None, tolerance=None,
+        stats=NULL_STATS):
+    """VSQファイルにルールを適用して書き出す
+    Args:
+        src: 読み込むVSQファイルのパス
+        dst: 書き込むVSQファイルのパス（srcと同じではいけない）
+        rules: ルール定義のリスト
+        select: トラック番号をキーとし、適用する候補IDの集合を値とする
+            ディクショナリ（省略時は全ての候補を適用）
+        curves: トラック番号をキーとし、ルールの後に行うカーブの置き換え
+            (カーブ名, カーブを表すリスト, s, e)のリストを値とする
+            ディクショナリ（VSQEditor.set_pitch_curveなどと同じ置き換え）
+        tolerance: カーブを書き込む際に点を間引く許容誤差
+            （VSQEditor.simplify_toleranceを参照）
+        stats: 処理時間とカウンタの記録先（stats.pyを参照）
+
+    Returns:
+        {"tracks": {トラック番号: 適用した候補IDのリスト},
+         "max_window": 窓に読み溜めた点の数の最大値}
+    """
+    fp = open(src, 'rb')
+    out = open(dst, 'wb')
+    try:
+        header = Header(fp)
+        master_track = MasterTrack(fp)
+        out.write(header.unparse())
+        out.write(master_track.unparse())
+
+        #1. シーケンスの始端時間と終端時間を求める
+        readers = []
+        ends = []
+        with stats.timer('scan'):
+            for n in range(header.data['track_num'] - 1):
+                reader = TrackReader(fp)
+                master, anotes, ids = read_notes(reader)
+                if n == 0:
+                    pre_measure = int(master['PreMeasure'])
+                if anotes:
+                    ends.append(anotes[-1].end)
+                reader.skip()
+                readers.append(reader)
+        tempo_map = TempoMap.from_master_track(master_track,
+                                               header.data['time_div'])
+        start_time = tempo_map.bar_to_tick(pre_measure)
+        end_time = max([start_time] + ends)
+
+        result = {"tracks": {}, "max_window": 0}
+        for n, reader in enumerate(readers):
+            track_stats = stats.track(n)
+            #2. ルール適用候補と書き換えを求める
+            with track_stats.timer('cands'):
+                editor, ids = _track_editor(reader, start_time, end_time,
+                                            tolerance, track_stats)
+                cands = editor.get_rule_cands(*rules)
+                if select is not None:
+                    selected = set(select.get(n, ()))
+                    cands = [c for c in cands if c['id'] in selected]
+                edits = {}
+                props = {}
+                for c in cands:
+                    for ptype, s, e, points in editor.rule_edits(c):
+                        edits.setdefault(ptype, []).append((s, e, points))
+                    rule = Rule.compile(c['rule'])
+                    prop = props.setdefault(ids[id(c['anotes'][0])], {})
+                    if rule.portamento is not None:
+                        prop['PMbPortamentoUse'] = rule.portamento
+                    if rule.accent is not None:
+                        prop['DEMaccent'] = rule.accent
+                for ptype, curve, s, e in (curves or {}).get(n, []):
+                    edit = editor.curve_edit(ptype, curve, s, e)
+                    if edit is not None:
+                        edits.setdefault(ptype, []).append(edit[1:])
+                track_stats.count('curve_edits',
+                                  sum(map(len, edits.values())))
+            editor = None
+            result["tracks"][n] = [c['id'] for c in cands]
+
+            #3. 書き換えながら書き出す
+            with track_stats.timer('rewrite'):
+                windows = dict((ptype, CurveWindow(clusters(e)))
+                               for ptype, e in edits.items())
+                _write_track(reader, out, windows, props)
+            for window in windows.values():
+                result["max_window"] = max(result["max_window"],
+                                           window.max_window)
+        stats.count('bytes_written', out.tell())
+        return result
+    finally:
+        fp.close()
+        out.close()
+
+
+def _track_editor(reader, start_time, end_time, tolerance, stats):
+    """ルール適用候補を求めるための、ノートだけを持つVSQEditorを作る
+    （パラメータカーブは空なので、元に戻すための情報は使えない）
+    Returns:
+        (VSQEditorインスタンス, read_notesと同じイベント番号の
+         ディクショナリ)
+    """
+    from vsq import VSQEditor
+    master, anotes, ids = read_notes(reader)
+    track = NormalTrack.__new__(NormalTrack)
+    track.data = dict((ptype, BPList()) for ptype in PTYPES)
+    track.anotes = anotes
+    track.singers = []
+    track.unapply_dict = {}
+    editor = VSQEditor(stats=stats)
+    editor.normal_tracks = [track]
+    editor.current_track = track
+    editor.start_time = start_time
+    editor.end_time = end_time
+    if tolerance is not None:
+        editor.simplify_tolerance = tolerance
+    return editor, ids
+
+
+def _write_track(reader, out, windows, props):
+    """トラックのテキストの行を書き換えながらトラックチャンクを書き出す
+    Args:
+        reader: TrackReaderインスタンス
+        out: 書き込むファイル（チャンクのサイズを後から書くのでシークする）
+        windows: カーブ名をキーとし、CurveWindowを値とするディクショナリ
+        props: イベント番号をキーとし、書き換えるプロパティの
+            ディクショナリを値とするディクショナリ
+    """
+    windows = dict(windows)
+    start = out.tell()
+    out.write(pack('>4sI', reader.MTrk, 0))
+    name = reader.name
+    out.write(pack('4B', 0x00, 0xff, 0x03, len(name)) + name)
+
+    writer = TextWriter(out)
+    window = None
+    prop = None
+    for line in reader.lines():
+        if tagrxp.match(line):
+            _close_section(writer, window, prop)
+            tag = line[1:-1]
+            window = windows.pop(tag, None)
+            prop = props.get(tag)
+            writer.write(line + '\n')
+            continue
+        if window is not None:
+            key, value = line.split('=')
+            writer.write(''.join("%d=%d\n" % p
+                                 for p in window.feed(int(key), int(value))))
+        elif prop is not None:
+            key, value = line.split('=')
+            if key in prop:
+                line = "%s=%s" % (key, prop.pop(key))
+            writer.write(line + '\n')
+        else:
+            writer.write(line + '\n')
+    _close_section(writer, window, prop)
+    #カーブがなければVSQEditorと同じように(0, 0)の点だけのカーブとみなす
+    for ptype, window in sorted(windows.items()):
+        writer.write("[%s]\n" % ptype)
+        window.feed(0, 0)
+        _close_section(writer, window, None)
+    writer.close()
+
+    for b in reader.cc_data:
+        out.write(tools.dtime2binary(b['dtime']))
+        out.write(pack('3B', *b['cc']))
+    out.write(reader.eot)
+
+    #トラックサイズを書き込む
+    end = out.tell()
+    out.seek(start + 4)
+    out.write(pack('>I', end - start - 8))
+    out.seek(end)
+
+
+def _close_section(writer, window, prop):
+    #カーブの残りの窓と、元のイベントになかったプロパティを書き出す
+    if window is not None:
+        writer.write(''.join("%d=%d\n" % p for p in window.finish()))
+    if prop:
+        writer.write(''.join("%s=%s\n" % item for item in sorted(prop.items())))
+
+
+if __name__ == '__main__':
+    from vsq_rules import san_rule, zuii_rule, port_rule, n_accent_rule
+    if len(sys.argv) != 3:
+        sys.stderr.write("usage: python vsqstream.py in.vsq out.vsq\n")
+        sys.exit(2)
+    result = transform(sys.argv[1], sys.argv[2],
+                       [san_rule, zuii_rule, port_rule, n_accent_rule])
+    for n, ids in sorted(result["tracks"].items()):
+        print "track %d: %d cands applied" % (n, len(ids))
+    print "max window: %d points" % result["max_window"]